@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+MPDS API usage example:
+the chemical bond length distributions of all the element pairs at once
+
+Every structure is processed once, and its interatomic distances
+update the fixed-bin histograms of all the element pairs present.
+The structures are compiled in the CrystalStage pool while downloading,
+their binned distances are added to the histograms as they arrive,
+and the resulting atlas is saved into a NumPy *npz* file,
+which can be then extended with other queries.
+
+    python bond_atlas.py --elements U -o atlas.npz
+    python bond_atlas.py --classes binary,oxide -o atlas.npz --update
+    python miner_bondlength.py U O --atlas atlas.npz
+
+The lengths are the same as in miner_bondlength.calculate_lengths:
+the distances in the standardized primitive cell, incl. the periodic images,
+rounded to the bin step, below the limit; every pair of atoms
+(also of the same element) is counted once.
+"""
+import os
+import argparse
+from operator import attrgetter
+
+import numpy as np
+
+from structure_fingerprint import StructureGroups
+from crystal_stage import CrystalStage, STANDARD
+from profiling import instrument, profiled, profiled_iter, stage
+
+
+STEP = 0.01 # A, the same as the rounding in miner_bondlength
+LIMIT = 4   # A
+
+
+class BondAtlas(object):
+    """
+    Histograms of the interatomic distances per element pair;
+    the pair (elA, elB) and (elB, elA) is the same
+    """
+    def __init__(self, step=STEP, limit=LIMIT):
+        self.step, self.limit = step, limit
+        self.nbins = int(round(limit / step))
+        self.histograms = {}
+        self.structures = 0
+
+    @staticmethod
+    def pair(elA, elB):
+        return (elA, elB) if elA <= elB else (elB, elA)
+
+    def add(self, ase_obj, weight=1):
+        self.add_binned(self.binned(ase_obj), weight)
+
+    @profiled()
+    def binned(self, ase_obj):
+        """
+        Bins all the distances between the atoms of a periodic structure in one go
+
+        Returns: dict of the element pair -> its non-empty bins and their counts, see add_binned
+        """
+        from ase.neighborlist import neighbor_list
+
+        elements, labels = np.unique(ase_obj.get_chemical_symbols(), return_inverse=True)
+        first, second, dists = neighbor_list('ijd', ase_obj, self.limit)
+        bins = np.rint(dists / self.step).astype(np.int64)
+
+        # every pair of atoms is listed in both directions
+        inside = (bins < self.nbins) & (labels[first] <= labels[second])
+        first, second, bins = labels[first[inside]], labels[second[inside]], bins[inside]
+
+        # ordered pair of the element labels
+        nels = len(elements)
+        codes = first * nels + second
+        counts = np.bincount(codes * self.nbins + bins, minlength=nels * nels * self.nbins).reshape(nels * nels, self.nbins)
+
+        binned = {}
+        for code in np.unique(codes):
+            elA, elB = elements[code // nels], elements[code % nels]
+            nonzero = np.flatnonzero(counts[code])
+            binned[self.pair(elA, elB)] = (nonzero, counts[code][nonzero] // 2 if elA == elB else counts[code][nonzero])
+        return binned
+
+    def add_binned(self, binned, weight=1):
+        """
+        Adds a structure binned by the same atlas (or of the same bins)
+        """
+        self.structures += weight
+        for key, (bins, counts) in binned.items():
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = np.zeros(self.nbins, dtype=np.int64)
+            histogram[bins] += counts * weight
+
+    def merge(self, other):
+        if (self.step, self.limit) != (other.step, other.limit):
+            raise RuntimeError('Cannot merge the atlases of different bins')
+        for key, histogram in other.histograms.items():
+            if key in self.histograms:
+                self.histograms[key] += histogram
+            else:
+                self.histograms[key] = histogram.copy()
+        self.structures += other.structures
+        return self
+
+    def __getitem__(self, pair):
+        return self.histograms.get(self.pair(*pair), np.zeros(self.nbins, dtype=np.int64))
+
+    def __contains__(self, pair):
+        return self.pair(*pair) in self.histograms
+
+    def __len__(self):
+        return len(self.histograms)
+
+    def distribution(self, elA, elB):
+        """
+        Returns: the lengths and their occurrence, only the non-empty bins
+        """
+        histogram = self[elA, elB]
+        nonzero = np.flatnonzero(histogram)
+        return np.round(nonzero * self.step, 10), histogram[nonzero]
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            meta=np.array([self.step, self.limit, self.structures], dtype=np.float64),
+            **{'%s-%s' % key: histogram for key, histogram in self.histograms.items()}
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            step, limit, structures = data['meta']
+            atlas = cls(step=float(step), limit=float(limit))
+            atlas.structures = int(structures)
+            for name in data.files:
+                if name == 'meta':
+                    continue
+                elA, elB = name.split('-')
+                atlas.histograms[atlas.pair(elA, elB)] = data[name].astype(np.int64)
+        return atlas
+
+
+def build_atlas(items, datarow=None, weight=None, step=STEP, limit=LIMIT, processes=None):
+    """
+    Compiles the structures in the CrystalStage pool while they arrive,
+    and bins their distances as soon as they are compiled
+
+    Args:
+        items: (iterable) of the datarows as for standard_crystal, or of any items, given the datarow getter
+        weight: (callable) the weight of an item, taken once all the items are there
+            (e.g. the multiplicity of a structure group); 1 by default
+        processes: (int) pool size, see CrystalStage
+
+    Returns: BondAtlas
+    """
+    atlas = BondAtlas(step=step, limit=limit)
+    compiler = CrystalStage(flavor=STANDARD, processes=processes, ordered=False)
+    results = compiler.map(atlas.binned, items, datarow)
+
+    with stage('bond_atlas') as st:
+        if weight is None:
+            for _, binned in results:
+                atlas.add_binned(binned)
+        else:
+            results = list(results) # the weights are final only at the end, the binned distances are kept till then
+            for item, binned in results:
+                atlas.add_binned(binned, weight(item))
+        st.count(compiler.compiled)
+
+    print(compiler.report())
+    return atlas
+
+
+def bond_atlas(search, dedup=True, weighted=False, step=STEP, limit=LIMIT, processes=None, api_client=None):
+    """
+    Downloads the structures and builds their atlas
+
+    Args:
+        search: (dict) MPDS query, {"props": "atomic structure"} is implied
+        dedup, weighted: (bool) see miner_bondlength.bond_length_distribution
+    """
+    from mpds_prefetch import CachedPrefetchingMPDSDataRetrieval
+
+    client = api_client or instrument(CachedPrefetchingMPDSDataRetrieval())
+
+    search = dict(search, props="atomic structure")
+    answer = profiled_iter(client.get_data(search, fields={'S':['phase_id', 'entry', 'cell_abc', 'sg_n', 'basis_noneq', 'els_noneq']}), 'get_data')
+
+    if not dedup:
+        return build_atlas(answer, step=step, limit=limit, processes=processes)
+
+    # the new structures are compiled while downloading
+    groups = StructureGroups()
+    atlas = build_atlas(
+        groups.stream(answer), datarow=attrgetter('representative'), weight=attrgetter('multiplicity') if weighted else None,
+        step=step, limit=limit, processes=processes
+    )
+    print("Unique structures: %s of %s" % (len(groups), groups.total))
+    return atlas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--elements', help='MPDS elements query, e.g. U or U-O')
+    parser.add_argument('--classes', help='MPDS classes query, e.g. binary')
+    parser.add_argument('-o', '--output', default='mpds_bond_atlas.npz', help='atlas file')
+    parser.add_argument('--update', action='store_true', help='add to the existing atlas file')
+    parser.add_argument('--no-dedup', dest='dedup', action='store_false', help='analyze every entry, even of the equivalent structures')
+    parser.add_argument('--weighted', action='store_true', help='count the equivalent structures by their number of entries')
+    parser.add_argument('--processes', type=int, help='worker processes, all cores by default')
+    args = parser.parse_args(argv)
+
+    search = {key: value for key, value in (('elements', args.elements), ('classes', args.classes)) if value}
+    if not search:
+        parser.error('The query should be narrowed with --elements and/or --classes')
+
+    atlas = bond_atlas(search, dedup=args.dedup, weighted=args.weighted, processes=args.processes)
+
+    if args.update and os.path.exists(args.output):
+        atlas = BondAtlas.load(args.output).merge(atlas)
+
+    atlas.save(args.output)
+    print("Saved %s element pairs from %s structures into %s" % (len(atlas), atlas.structures, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Comparison statistics for the ab initio vs. peer-reviewed data
+harvested by miner_cmp_ab_pr_data.py: the work_outline data are flattened
+into the columnar arrays of the (ab initio, peer-reviewed) pairs,
+and the MAE, RMSE, bias, rank correlation, and outliers are computed
+per property and per crystal system.
+
+Three kinds of values are supported:
+- scalars: the medians per phase are compared
+- labelled scalars, i.e. (refers_to, value) tuples, e.g. effective charges:
+  the medians per phase and label are compared
+- spectra, i.e. the lists of ab initio frequencies, e.g. phonons:
+  each peer-reviewed value is compared to the nearest ab initio one
+"""
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+from scipy.stats import spearmanr
+
+from prop_join import group_reduce, _to_float
+
+
+OUTLIER_MAD_FACTOR = 5
+
+
+def _flat(nested):
+    return np.array([_to_float(x) for x in chain.from_iterable(nested)], dtype=np.float64)
+
+
+def _counts(nested):
+    return np.fromiter((len(x) for x in nested), dtype=np.int64, count=len(nested))
+
+
+def _pair_scalars(ab_values, pr_values):
+    ab_keys = np.repeat(np.arange(len(ab_values)), _counts(ab_values))
+    pr_keys = np.repeat(np.arange(len(pr_values)), _counts(pr_values))
+    ab_flat, pr_flat = _flat(ab_values), _flat(pr_values)
+
+    ab_mask, pr_mask = np.isfinite(ab_flat), np.isfinite(pr_flat)
+    ab_uniq, ab_med, _ = group_reduce(ab_keys[ab_mask], ab_flat[ab_mask])
+    pr_uniq, pr_med, _ = group_reduce(pr_keys[pr_mask], pr_flat[pr_mask])
+
+    common, ab_idx, pr_idx = np.intersect1d(ab_uniq, pr_uniq, assume_unique=True, return_indices=True)
+    return common, np.full(len(common), '', dtype=object), ab_med[ab_idx], pr_med[pr_idx]
+
+
+def _pair_labelled(ab_values, pr_values):
+    ab_labels = np.array([str(x[0]) for x in chain.from_iterable(ab_values)], dtype=object)
+    pr_labels = np.array([str(x[0]) for x in chain.from_iterable(pr_values)], dtype=object)
+    labels, codes = np.unique(np.concatenate([ab_labels, pr_labels]), return_inverse=True)
+    n_labels = max(len(labels), 1)
+
+    ab_keys = np.repeat(np.arange(len(ab_values)), _counts(ab_values)) * n_labels + codes[:len(ab_labels)]
+    pr_keys = np.repeat(np.arange(len(pr_values)), _counts(pr_values)) * n_labels + codes[len(ab_labels):]
+    ab_flat = np.array([_to_float(x[1]) for x in chain.from_iterable(ab_values)], dtype=np.float64)
+    pr_flat = np.array([_to_float(x[1]) for x in chain.from_iterable(pr_values)], dtype=np.float64)
+
+    ab_mask, pr_mask = np.isfinite(ab_flat), np.isfinite(pr_flat)
+    ab_uniq, ab_med, _ = group_reduce(ab_keys[ab_mask], ab_flat[ab_mask])
+    pr_uniq, pr_med, _ = group_reduce(pr_keys[pr_mask], pr_flat[pr_mask])
+
+    common, ab_idx, pr_idx = np.intersect1d(ab_uniq, pr_uniq, assume_unique=True, return_indices=True)
+    return common // n_labels, labels[common % n_labels], ab_med[ab_idx], pr_med[pr_idx]
+
+
+def _pair_spectra(ab_values, pr_values):
+    ab_spectra = list(chain.from_iterable(ab_values))
+    ab_keys = np.repeat(np.repeat(np.arange(len(ab_values)), _counts(ab_values)), _counts(ab_spectra))
+    pr_keys = np.repeat(np.arange(len(pr_values)), _counts(pr_values))
+    ab_flat, pr_flat = _flat(ab_spectra), _flat(pr_values)
+
+    ab_mask, pr_mask = np.isfinite(ab_flat), np.isfinite(pr_flat)
+    ab_keys, ab_flat, pr_keys, pr_flat = ab_keys[ab_mask], ab_flat[ab_mask], pr_keys[pr_mask], pr_flat[pr_mask]
+    if not len(ab_flat) or not len(pr_flat):
+        empty = np.array([], dtype=np.float64)
+        return np.array([], dtype=np.int64), np.array([], dtype=object), empty, empty
+
+    # shift each phase into its own non-overlapping range,
+    # so that a single sorted search finds the nearest values within the phase
+    low = min(ab_flat.min(), pr_flat.min())
+    span = max(ab_flat.max(), pr_flat.max()) - low + 1
+    ab_line = (ab_keys * 3 * span) + (ab_flat - low)
+    pr_line = (pr_keys * 3 * span) + (pr_flat - low)
+    order = np.argsort(ab_line, kind='stable')
+    ab_line, ab_keys, ab_flat = ab_line[order], ab_keys[order], ab_flat[order]
+
+    right = np.clip(np.searchsorted(ab_line, pr_line), 0, len(ab_line) - 1)
+    left = np.clip(right - 1, 0, len(ab_line) - 1)
+    nearest = np.where(np.abs(ab_line[left] - pr_line) < np.abs(ab_line[right] - pr_line), left, right)
+
+    mask = ab_keys[nearest] == pr_keys
+    return pr_keys[mask], np.full(mask.sum(), '', dtype=object), ab_flat[nearest[mask]], pr_flat[mask]
+
+
+def flatten_outline(work_outline):
+    """
+    Turns the harvested work_outline into the columnar pairs table
+
+    Returns: pandas dataframe with the columns
+        property, formula, system, label, ab, pr
+    """
+    frames = []
+
+    for prop, value in work_outline.items():
+        data = value.get('data')
+        if not data:
+            continue
+
+        meta = [item[0] for item in data]
+        ab_values = [item[1] for item in data]
+        pr_values = [item[2] for item in data]
+
+        sample = ab_values[0][0]
+        if isinstance(sample, tuple):
+            phase_idx, labels, ab, pr = _pair_labelled(ab_values, pr_values)
+        elif isinstance(sample, list):
+            phase_idx, labels, ab, pr = _pair_spectra(ab_values, pr_values)
+        else:
+            phase_idx, labels, ab, pr = _pair_scalars(ab_values, pr_values)
+
+        frames.append(pd.DataFrame({
+            'property': prop,
+            'formula': [meta[n][0] for n in phase_idx],
+            'system': [meta[n][1] for n in phase_idx],
+            'label': labels,
+            'ab': ab,
+            'pr': pr
+        }))
+
+    if not frames:
+        return pd.DataFrame(columns=['property', 'formula', 'system', 'label', 'ab', 'pr'])
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def flag_outliers(pairs, by=('property', 'system'), factor=OUTLIER_MAD_FACTOR):
+    """
+    Adds the error and the robust (median absolute deviation) outlier flag per group
+    """
+    pairs = pairs.copy()
+    pairs['error'] = pairs['ab'] - pairs['pr']
+
+    grouped = pairs.groupby(list(by))['error']
+    deviation = (pairs['error'] - grouped.transform('median')).abs()
+    mad = deviation.groupby([pairs[key] for key in by]).transform('median') * 1.4826
+
+    pairs['outlier'] = (deviation > factor * mad) & (mad > 0)
+    return pairs
+
+
+def _spearman(frame):
+    if len(frame) < 3:
+        return np.nan
+    return spearmanr(frame['ab'], frame['pr'])[0]
+
+
+def compare_stats(pairs, by=('property', 'system')):
+    """
+    Returns: pandas dataframe of the statistics per group
+    """
+    if 'error' not in pairs:
+        pairs = flag_outliers(pairs, by)
+
+    by = list(by)
+    pairs = pairs.assign(abs_error=pairs['error'].abs(), sq_error=pairs['error'] ** 2)
+    grouped = pairs.groupby(by)
+
+    stats = grouped.agg(
+        count=('error', 'size'),
+        mae=('abs_error', 'mean'),
+        rmse=('sq_error', 'mean'),
+        bias=('error', 'mean'),
+        outliers=('outlier', 'sum')
+    )
+    stats['rmse'] = np.sqrt(stats['rmse'])
+    stats['spearman'] = grouped[['ab', 'pr']].apply(_spearman)
+
+    return stats.reset_index()
+
+
+def comparison_report(work_outline):
+    """
+    Returns: pairs with the outlier flags, per property stats, per property and crystal system stats
+    """
+    pairs = flatten_outline(work_outline)
+    by_property = compare_stats(flag_outliers(pairs, by=('property',)), by=('property',))
+    pairs = flag_outliers(pairs, by=('property', 'system'))
+    by_system = compare_stats(pairs, by=('property', 'system'))
+    return pairs, by_property, by_system
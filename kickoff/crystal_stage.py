@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""
+Pipeline stage compiling the crystal structures in a process pool:
+the datarows are taken from the get_data generator in chunks,
+not more than max_chunks are in flight, so the download goes on
+while the structures are compiled on all the cores.
+
+    stage = CrystalStage(ordered=False)
+    for datarow, ase_obj in stage(client.get_data({...}, fields={'S': [..., 'cell_abc', 'sg_n', 'basis_noneq', 'els_noneq']})):
+        ...
+    print(stage.report())
+
+The failed compilations are not yielded, but kept in stage.failures.
+Any items can be passed instead of the datarows, given the datarow getter:
+
+    stage(groups, datarow=lambda group: group.representative)
+
+The per-structure descriptors are kept between the runs with an IncrementalState
+(see incremental.py), so that only the new or changed structures are compiled:
+
+    for item, lengths in stage.map(calculate_lengths, items, state=state, entry=itemgetter(1)):
+        ...
+
+The pushing producers (e.g. the consumers of FetchPlanner) feed the stage instead:
+
+    push, finish = stage.feed(calculate_lengths)
+    planner.add({...}, push, fields={...})
+    planner.run()
+    for item, lengths in finish():
+        ...
+
+Spawning the pool takes seconds, so it is shared by all the stages of the run,
+and a few structures are compiled at once, without the pool (see inline_below).
+"""
+import os
+import queue
+import threading
+import multiprocessing
+from itertools import chain, islice
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from profiling import compile_crystal, profiled_iter, worker_call, collect
+
+
+NO_STRUCTURE = 'no structure' # e.g. no basis, see MPDSDataRetrieval.compile_crystal
+
+STANDARD = 'standard' # the flavor of structure_fingerprint.standard_crystal
+
+_executors = {} # pool size -> shared pool
+
+_DONE = object() # end of the fed items
+
+
+def get_executor(workers):
+    """
+    The process pool shared by the stages, created once
+    """
+    executor = _executors.get(workers)
+    if executor is None:
+        # NB not forked, as the download thread of the client is running
+        executor = _executors[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    return executor
+
+
+def _compile_chunk(task):
+    """
+    Worker: list of (crystal, failure reason) per datarow
+    """
+    datarows, flavor = task
+    if flavor == STANDARD:
+        from structure_fingerprint import standard_crystal as compile_standard
+
+    output = []
+    for datarow in datarows:
+        try:
+            crystal = compile_standard(datarow) if flavor == STANDARD else compile_crystal(datarow, flavor)
+        except Exception as error:
+            output.append((None, '%s: %s' % (error.__class__.__name__, error)))
+            continue
+        output.append((crystal, None) if crystal else (None, NO_STRUCTURE))
+    return output
+
+
+def _compile_chunk_measured(task):
+    """
+    Worker: _compile_chunk and the stages measured in the worker, see profiling.collect
+    """
+    return worker_call('compile_chunk', _compile_chunk, task)
+
+
+class CrystalStage(object):
+    """
+    Compiles the structures in a process pool
+
+    Args:
+        flavor: (str) ase or pmg, see MPDSDataRetrieval.compile_crystal,
+            or STANDARD for the setting-independent descriptors
+        processes: (int) pool size, all cores by default; 0 means no pool
+        chunksize: (int) datarows per task
+        max_chunks: (int) tasks in flight, twice the pool size by default
+        ordered: (bool) whether to keep the input order
+        inline_below: (int) fewer datarows are compiled without the pool
+    """
+    def __init__(self, flavor='ase', processes=None, chunksize=16, max_chunks=None, ordered=True, inline_below=200):
+        self.flavor = flavor
+        self.processes = processes
+        self.chunksize = chunksize
+        self.max_chunks = max_chunks
+        self.ordered = ordered
+        self.inline_below = inline_below
+        self.failures = []
+        self.compiled = 0
+
+    def __call__(self, items, datarow=None):
+        """
+        Yields: (item, crystal) for the successfully compiled ones
+        """
+        return profiled_iter(self._run(iter(items), datarow or (lambda item: item)), 'compile_crystal')
+
+    def map(self, func, items, datarow=None, state=None, entry=None):
+        """
+        Yields: (item, func(crystal)) for the successfully compiled ones,
+        first of the new or changed structures, then of the unchanged ones kept in the state
+
+        Args:
+            state: (object) IncrementalState of func results per entry,
+                keyed by the entry(item); the failures are kept as None
+                and retried, so that they are in the failures of every run
+        """
+        datarow = datarow or (lambda item: item)
+
+        if state is None:
+            for item, crystal in self(items, datarow):
+                yield item, func(crystal)
+            return
+
+        unchanged, failed = [], len(self.failures)
+
+        def changed():
+            for item in items:
+                # the digested content is the structure: cell_abc, sg_n, basis_noneq, els_noneq
+                if state.changed(entry(item), datarow(item)[-4:]) or state.result(entry(item)) is None:
+                    yield item
+                else:
+                    unchanged.append(item)
+
+        for item, crystal in self(changed(), datarow):
+            result = func(crystal)
+            state.store(entry(item), datarow(item)[-4:], result)
+            yield item, result
+
+        for item, _ in self.failures[failed:]:
+            state.store(entry(item), datarow(item)[-4:], None)
+
+        for item in unchanged:
+            yield item, state.result(entry(item))
+
+    def feed(self, func, datarow=None, state=None, entry=None):
+        """
+        The map for the pushing producers, compiling in the background thread;
+        push blocks while the stage is behind by max_chunks
+
+        Returns: push(item) and finish(), the latter waits for the rest
+        and returns the list of (item, func(crystal)), see map
+        """
+        workers = self.processes or os.cpu_count() or 1
+        items = queue.Queue(maxsize=(self.max_chunks or 2 * workers) * self.chunksize)
+        output, errors, ended = [], [], []
+
+        def fed():
+            for item in iter(items.get, _DONE):
+                yield item
+            ended.append(True)
+
+        def run():
+            try:
+                output.extend(self.map(func, fed(), datarow, state, entry))
+            except Exception as error:
+                errors.append(error)
+                if not ended: # till finish()
+                    for _ in iter(items.get, _DONE):
+                        pass
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        def finish():
+            items.put(_DONE)
+            thread.join()
+            if errors:
+                raise errors[0]
+            return output
+
+        return items.put, finish
+
+    def _collect(self, chunk, results):
+        for item, (crystal, reason) in zip(chunk, results):
+            if crystal is None:
+                self.failures.append((item, reason))
+                continue
+            self.compiled += 1
+            yield item, crystal
+
+    def _run(self, items, datarow):
+        head = list(islice(items, self.inline_below)) if self.processes != 0 else []
+        items = chain(head, items)
+
+        if self.processes == 0 or len(head) < self.inline_below:
+            for chunk in iter(lambda: list(islice(items, self.chunksize)), []):
+                for output in self._collect(chunk, _compile_chunk(([datarow(item) for item in chunk], self.flavor))):
+                    yield output
+            return
+
+        workers = self.processes or os.cpu_count() or 1
+        max_chunks = self.max_chunks or 2 * workers
+        in_flight = deque() # (future, chunk)
+        exhausted = False
+
+        executor = get_executor(workers)
+        try:
+            while in_flight or not exhausted:
+
+                while not exhausted and len(in_flight) < max_chunks:
+                    chunk = list(islice(items, self.chunksize))
+                    if not chunk:
+                        exhausted = True
+                        break
+                    in_flight.append((executor.submit(_compile_chunk_measured, ([datarow(item) for item in chunk], self.flavor)), chunk))
+
+                if not in_flight:
+                    break
+
+                if self.ordered:
+                    future, chunk = in_flight.popleft()
+                else:
+                    done, _ = wait([future for future, _ in in_flight], return_when=FIRST_COMPLETED)
+                    future, chunk = next(pair for pair in in_flight if pair[0] in done)
+                    in_flight.remove((future, chunk))
+
+                for output in self._collect(chunk, collect(future.result())):
+                    yield output
+
+        except BrokenProcessPool:
+            _executors.pop(workers, None) # not to be reused
+            raise
+
+        finally:
+            for future, _ in in_flight: # if stopped early
+                future.cancel()
+
+    def summary(self):
+        """
+        Returns: number of the failures per reason
+        """
+        return Counter(reason for _, reason in self.failures)
+
+    def report(self):
+        lines = ["Compiled structures: %s, failed: %s" % (self.compiled, len(self.failures))]
+        for reason, count in self.summary().most_common():
+            lines.append("\t%s: %s" % (reason, count))
+        return "\n".join(lines)
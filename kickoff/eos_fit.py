@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+MPDS API usage example:
+pVT-data and equation of state (EoS) fitting for all the phases
+having the experimental bulk modulus and its pressure derivative
+
+This is the batch version of the notebooks/4_eos_fit.ipynb:
+the cell volumes are calculated in a closed form for all the decks at once,
+and the EoS fits are done in a process pool, starting from
+the experimental K0 and K0'. The result is a table of fits
+with the discrepancy flags.
+"""
+import warnings
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from profiling import instrument, stage
+
+
+K0_TOLERANCE = 50  # GPa
+K0P_TOLERANCE = 1.5
+MIN_POINTS = 4
+
+
+def cell_volumes(cellpars):
+    """
+    Calculate V from the cell parameters in a closed form
+
+    Args:
+        cellpars: (array-like) N x 6 matrix of a, b, c, alpha, beta, gamma (degrees)
+
+    Returns: array of N volumes
+    """
+    cellpars = np.asarray(cellpars, dtype=np.float64).reshape(-1, 6)
+    cos_a, cos_b, cos_g = np.cos(np.radians(cellpars[:, 3:6])).T
+    return cellpars[:, 0] * cellpars[:, 1] * cellpars[:, 2] * np.sqrt(np.clip(
+        1 - cos_a**2 - cos_b**2 - cos_g**2 + 2 * cos_a * cos_b * cos_g, 0, None
+    ))
+
+
+def bm3(v, v0, k0, k0p):
+    """
+    Third-order Birch-Murnaghan EoS
+    """
+    f = (v0 / v) ** (2/3)
+    return 1.5 * k0 * (f ** 3.5 - f ** 2.5) * (1 + 0.75 * (k0p - 4) * (f - 1))
+
+
+def vinet(v, v0, k0, k0p):
+    """
+    Vinet EoS
+    """
+    x = (v / v0) ** (1/3)
+    return 3 * k0 * (1 - x) / x**2 * np.exp(1.5 * (k0p - 1) * (1 - x))
+
+
+def murnaghan(v, v0, k0, k0p):
+    """
+    Murnaghan EoS
+    """
+    return k0 / k0p * ((v0 / v) ** k0p - 1)
+
+
+eos_models = {'bm3': bm3, 'vinet': vinet, 'murnaghan': murnaghan}
+
+
+def fit_eos(task):
+    """
+    A worker fitting one phase with one EoS
+
+    Args:
+        task: (tuple) model name, pressures, volumes, K0 and K0' initial guesses
+
+    Returns: v0, k0, k0p, their standard errors, and the convergence flag
+    """
+    from scipy.optimize import curve_fit
+
+    model, p, v, k0, k0p = task
+    p, v = np.asarray(p, dtype=np.float64), np.asarray(v, dtype=np.float64)
+
+    if len(p) < MIN_POINTS:
+        return (np.nan,) * 6 + (False,)
+
+    # warm start: the volume nearest to the ambient pressure, and the experimental moduli
+    guess = [v[np.argmin(np.abs(p))], k0, k0p]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            popt, pcov = curve_fit(eos_models[model], v, p, p0=guess, maxfev=5000)
+        except (RuntimeError, ValueError):
+            return (np.nan,) * 6 + (False,)
+
+    perr = np.sqrt(np.diag(pcov)) if np.all(np.isfinite(pcov)) else (np.nan,) * 3
+    return tuple(popt) + tuple(perr) + (True,)
+
+
+def fit_all(pvts, models=('bm3',), processes=None, chunksize=32):
+    """
+    Fits the EoS models for all the phases in a process pool
+
+    Args:
+        pvts: (dataframe) with the columns Phase, Entry, P, V, avg_k0, avg_k0p
+        models: (tuple) names from eos_models
+        processes: (int) pool size, all cores by default
+
+    Returns: (dataframe) one row per phase and model
+    """
+    import pandas as pd
+
+    tasks, rows = [], []
+    for model in models:
+        for phase, entry, p, v, k0, k0p in zip(pvts['Phase'], pvts['Entry'], pvts['P'], pvts['V'], pvts['avg_k0'], pvts['avg_k0p']):
+            tasks.append((model, p, v, k0, k0p))
+            rows.append((phase, entry, model, len(p), k0, k0p))
+
+    with stage('eos_fit') as st, ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(fit_eos, tasks, chunksize=chunksize))
+        st.count(len(tasks))
+
+    fits = pd.DataFrame(
+        [row + result for row, result in zip(rows, results)],
+        columns=['Phase', 'Entry', 'model', 'npoints', 'avg_k0', 'avg_k0p', 'v0', 'k0', 'k0p', 'v0_err', 'k0_err', 'k0p_err', 'converged']
+    )
+    fits['k0_discrepancy'] = fits['converged'] & ((fits['k0'] - fits['avg_k0']).abs() > K0_TOLERANCE)
+    fits['k0p_discrepancy'] = fits['converged'] & ((fits['k0p'] - fits['avg_k0p']).abs() > K0P_TOLERANCE)
+    return fits
+
+
+K0P_SEARCH = {"classes": "binary", "elements": "O", "props": "pressure derivative of isothermal bulk modulus"}
+K0_SEARCH = {"props": "isothermal bulk modulus"}
+PV_SEARCH = {"props": "cell parameters - pressure diagram"}
+PV_FIELDS = {'P': ['sample.material.phase_id', 'sample.material.entry', 'sample.measurement[0].property.matrix']}
+
+
+def get_pvts(client):
+    """
+    Downloads the experimental K0, K0', and pVT-data
+    for the binary oxides
+
+    Returns: (dataframe) with the columns Phase, Entry, P, V, T, avg_k0, avg_k0p
+    """
+    avg_k0p = median_values(client.get_dataframe(K0P_SEARCH), 'avg_k0p')
+    avg_k0 = median_values(client.get_dataframe(K0_SEARCH, phases=set(avg_k0p['Phase'].tolist())), 'avg_k0')
+    avg_k0 = avg_k0.merge(avg_k0p, how='inner', on='Phase')
+
+    entries = {}
+    collect = matrix_consumer(entries)
+
+    # only those phases we have experimental bulk modulus
+    for matrix in client.get_data(PV_SEARCH, phases=set(avg_k0['Phase'].tolist()), fields=PV_FIELDS):
+        collect(matrix)
+
+    return pvts_dataframe(entries, avg_k0)
+
+
+def pvts_job():
+    """
+    The get_pvts as a job of fetch_planner.run_jobs (three rounds)
+    """
+    import pandas as pd
+    from mpds_client import MPDSDataRetrieval
+
+    rows = []
+    yield [dict(search=K0P_SEARCH, consumer=rows.append)]
+    avg_k0p = median_values(pd.DataFrame(rows, columns=MPDSDataRetrieval.default_titles), 'avg_k0p')
+
+    rows = []
+    yield [dict(search=K0_SEARCH, phases=set(avg_k0p['Phase'].tolist()), consumer=rows.append)]
+    avg_k0 = median_values(pd.DataFrame(rows, columns=MPDSDataRetrieval.default_titles), 'avg_k0')
+    avg_k0 = avg_k0.merge(avg_k0p, how='inner', on='Phase')
+
+    entries = {}
+    yield [dict(search=PV_SEARCH, phases=set(avg_k0['Phase'].tolist()), consumer=matrix_consumer(entries), fields=PV_FIELDS)]
+
+    return pvts_dataframe(entries, avg_k0)
+
+
+def eos_fit_job(models=('bm3',)):
+    """
+    The EoS fits as a job of fetch_planner.run_jobs (three rounds)
+    """
+    pvts = yield from pvts_job()
+    return fit_all(pvts, models=models)
+
+
+def median_values(dfrm, name):
+    """
+    Returns: (dataframe) median value per existing distinct phase, in the *name* column
+    """
+    dfrm = dfrm[np.isfinite(dfrm['Phase'].astype(np.float64))] # only data for the existing distinct phases
+    return dfrm.groupby('Phase')['Value'].median().to_frame().reset_index().rename(columns={'Value': name})
+
+
+def matrix_consumer(entries):
+    """
+    Returns: function keeping the pVT matrix of a phase in the entries dict
+    """
+    def collect(matrix):
+        if not matrix: # other entry types
+            return
+
+        phase_id, entry, decks = matrix
+        if phase_id is None:
+            return
+        if not decks:
+            warnings.warn('Error: there is no expected property in the entry %s' % entry)
+            return
+
+        # TODO here in principle we should do something smarter
+        # than just omitting the data for the same phase
+        if phase_id in entries and len(entries[phase_id][1]) > len(decks):
+            warnings.warn('Skipping entry %s' % entry)
+            return
+
+        entries[phase_id] = (entry, decks)
+
+    return collect
+
+
+def pvts_dataframe(entries, avg_k0):
+    """
+    Returns: (dataframe) of the collected pVT matrices, see get_pvts
+    """
+    import pandas as pd
+
+    phase_ids = list(entries.keys())
+    decks = [deck for phase_id in phase_ids for deck in entries[phase_id][1]]
+    if not decks:
+        return pd.DataFrame(columns=['Phase', 'Entry', 'P', 'V', 'T', 'avg_k0', 'avg_k0p'])
+
+    with stage('cell_volumes') as st:
+        decks = np.array([deck[:8] for deck in decks], dtype=np.float64)
+        volumes = cell_volumes(decks[:, 2:8])
+        st.count(len(decks))
+    bounds = np.cumsum([0] + [len(entries[phase_id][1]) for phase_id in phase_ids])
+
+    pvts = pd.DataFrame({
+        'Phase': phase_ids,
+        'Entry': [entries[phase_id][0] for phase_id in phase_ids],
+        'P': [decks[start:end, 0] for start, end in zip(bounds[:-1], bounds[1:])],
+        'V': [volumes[start:end] for start, end in zip(bounds[:-1], bounds[1:])],
+        'T': [decks[start:end, 1] for start, end in zip(bounds[:-1], bounds[1:])]
+    })
+    return pvts.merge(avg_k0, how='inner', on='Phase')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('models', nargs='*', default=['bm3'], help='EoS models to fit: %s' % ', '.join(sorted(eos_models)))
+    parser.add_argument('-o', '--output', default='mpds_eos_fits.csv', help='CSV file to write the fits')
+    args = parser.parse_args(argv)
+
+    for model in args.models:
+        if model not in eos_models:
+            parser.error('Unknown EoS model %s' % model)
+
+    from mpds_cache import CachedMPDSDataRetrieval
+
+    fits = fit_all(get_pvts(instrument(CachedMPDSDataRetrieval())), models=args.models)
+
+    for n, system in fits[fits['k0_discrepancy']].iterrows():
+        # show the discrepancies, if any
+        print("*" * 30 + " Distinct phase https://mpds.io/#phase_id/%s (%s) " % (system['Phase'], system['model']) + "*" * 30)
+        print("BM_fit: %4.1f \t BM_exp: %4.1f" % (system['k0'], system['avg_k0']))
+        print("BM0p_fit: %1.2f \t BM0p_exp: %1.2f" % (system['k0p'], system['avg_k0p']))
+
+    fits.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+"""
+Planning the downloads of several miners at once:
+the compatible queries are merged into the superset fetches,
+and each download is streamed out to all its consumers.
+
+    planner = FetchPlanner()
+    planner.add({"props": "phase diagram", "classes": "binary"}, nonformers.append, fields={})
+    planner.add({"props": "phase diagram", "classes": "binary", "elements": "Fe-Cr"}, liquidus.append, fields={})
+    planner.run() # one download for both
+
+Two queries are compatible if they have the same data type and
+the same search apart from the *elements*, and one of them
+covers the other: fewer (or the same) elements and no narrower phases.
+Nothing is ever broadened beyond the widest query of the batch.
+The fields of the merged queries are united; every consumer receives
+exactly what its own query would give (i.e. its own fields projection),
+as the phases and elements of the narrower queries are filtered locally.
+
+The incompatible queries of a phases list (e.g. the structures of the phases
+found by the previous query) and of some elements (e.g. the U-O structures)
+still share their common entries: a distinct phase belongs to a single
+chemical system, so the phases met in the elements download are served
+from it, and only the rest of the phases are downloaded then.
+
+The miners depending on their previous downloads are run as the jobs:
+the generators yielding their requests (the FetchPlanner.add arguments)
+round by round, and returning the result, see run_jobs:
+
+    def job():
+        rows = []
+        yield [dict(search={"props": "isothermal bulk modulus"}, consumer=rows.append)]
+        structures = []
+        yield [dict(search={"props": "atomic structure"}, phases={row[0] for row in rows}, consumer=structures.append, fields={...})]
+        return structures
+
+    results, report = run_jobs({'job': (2, job())})
+
+NB the same item may be passed to several consumers,
+so the consumers should not modify it in place.
+"""
+import json
+
+from mpds_client import MPDSDataRetrieval, APIError
+
+from field_paths import parse_path, compile_path, compile_fields, extract
+from profiling import instrument, profiled_iter
+
+
+# where the local filters look for the phase and the elements of an entry
+PHASE_PATHS = {'S': 'phase_id', 'P': 'sample.material.phase_id', 'C': None}
+ELEMENTS_PATHS = {'S': 'els_noneq', 'P': 'sample.material.chemical_elements', 'C': 'chemical_elements'}
+N_HIDDEN = 3 # object type, phase, elements prepended to the merged fields
+
+
+def parse_elements(elements):
+    return frozenset(el.strip() for el in elements.split('-')) if elements else frozenset()
+
+
+def covers(scope, other):
+    """
+    Whether the (elements, phases) scope query returns
+    everything the other scope query does
+    """
+    return scope[0] <= other[0] and (scope[1] is None or (other[1] is not None and other[1] <= scope[1]))
+
+
+def merge_scopes(scope, other):
+    """
+    Returns the narrowest (elements, phases) scope covering both,
+    or None if it would need a broader query than either
+    """
+    if scope[0] == other[0]:
+        return scope[0], (None if scope[1] is None or other[1] is None else scope[1] | other[1])
+    if covers(scope, other):
+        return scope
+    if covers(other, scope):
+        return other
+    return None
+
+
+class FetchJob(object):
+    """
+    A query of a single consumer, the arguments are the same as in MPDSDataRetrieval.get_data;
+    fields={} or None means the raw JSON entries, an empty phases list means nothing to download
+    """
+    def __init__(self, search, consumer, phases=None, fields=MPDSDataRetrieval.default_fields, dtype=None):
+        self.search = dict(search)
+        self.elements = parse_elements(self.search.pop('elements', None))
+        self.phases = frozenset(int(x) for x in phases) if phases is not None else None
+        self.fields = fields or {}
+        self.consumer = consumer
+        self.dtype = dtype
+
+    @property
+    def scope(self):
+        return self.elements, self.phases
+
+    @property
+    def group_key(self):
+        return self.dtype, json.dumps(self.search, sort_keys=True)
+
+    def accepts(self, phase_id, elements):
+        if self.phases is not None and phase_id not in self.phases:
+            return False
+        return self.elements <= set(elements or ())
+
+
+class Fetch(object):
+    """
+    A single download serving one or more jobs
+    """
+    def __init__(self, job):
+        self.search, self.dtype = job.search, job.dtype
+        self.elements, self.phases = job.scope
+        self.jobs = [job]
+        self.residuals = {} # index of an attached job -> its own fetch
+        self.served = set() # phases delivered by the preceding fetches
+
+    def add(self, job):
+        scope = merge_scopes((self.elements, self.phases), job.scope)
+        if scope is None:
+            return False
+        self.elements, self.phases = scope
+        self.jobs.append(job)
+        return True
+
+    def attach(self, fetch):
+        """
+        Serves also the jobs of the phases fetch, which
+        then downloads only the phases not met here
+        """
+        for job in fetch.jobs:
+            self.residuals[len(self.jobs)] = fetch
+            self.jobs.append(job)
+
+    @property
+    def pending_phases(self):
+        return self.phases - self.served if self.phases is not None else None
+
+    @property
+    def query(self):
+        search = dict(self.search)
+        if self.elements:
+            search['elements'] = '-'.join(sorted(self.elements))
+        return search
+
+    @property
+    def raw(self):
+        return any(not job.fields for job in self.jobs)
+
+    def plan_fields(self):
+        """
+        Returns the merged fields and, per job and object type,
+        either the indices of its fields in the merged ones (projected fetch),
+        or its own compiled fields (raw fetch)
+        """
+        if self.raw:
+            return {}, [compile_fields(job.fields) if job.fields else None for job in self.jobs]
+
+        merged = {
+            object_type: [lambda object_type=object_type: object_type, PHASE_PATHS[object_type] or (lambda: None), ELEMENTS_PATHS[object_type]]
+            for object_type in PHASE_PATHS
+        }
+        projections = []
+        for job in self.jobs:
+            projection = {}
+            for object_type, exprs in job.fields.items():
+                target = merged[object_type]
+                indices = []
+                for expr in exprs:
+                    # the paths are merged by value, the callables by identity
+                    for n, known in enumerate(target[N_HIDDEN:], start=N_HIDDEN):
+                        if known is expr or (isinstance(expr, str) and known == expr):
+                            break
+                    else:
+                        n = len(target)
+                        target.append(expr)
+                    indices.append(n)
+                projection[object_type] = indices
+            projections.append(projection)
+        return merged, projections
+
+    def __repr__(self):
+        return "<Fetch %s of %s jobs%s%s>" % (
+            self.query, len(self.jobs),
+            ', %s phases' % len(self.phases) if self.phases else '',
+            ', %s served before' % len(self.served) if self.served else ''
+        )
+
+
+class FetchPlanner(object):
+    """
+    Collects the jobs of several miners,
+    merges them into the fetches and runs these
+    """
+    def __init__(self):
+        self.jobs = []
+
+    def add(self, search, consumer, phases=None, fields=MPDSDataRetrieval.default_fields, dtype=None):
+        """
+        Registers a query, the consumer is called with every item
+        the MPDSDataRetrieval.get_data would return for it
+        """
+        job = FetchJob(search, consumer, phases=phases, fields=fields, dtype=dtype)
+        self.jobs.append(job)
+        return job
+
+    def plan(self):
+        """
+        Returns: list of fetches; the broader jobs come first
+        and absorb the compatible narrower ones,
+        the phases fetches go after the elements fetches they are attached to
+        """
+        groups = {}
+        for job in self.jobs:
+            groups.setdefault(job.group_key, []).append(job)
+
+        fetches = []
+        for jobs in groups.values():
+            group_fetches = []
+            # first the jobs with fewer elements and no phases constraint
+            for job in sorted(jobs, key=lambda job: (len(job.elements), job.phases is not None)):
+                for fetch in group_fetches:
+                    if fetch.add(job):
+                        break
+                else:
+                    group_fetches.append(Fetch(job))
+
+            group_fetches.sort(key=lambda fetch: fetch.phases is not None)
+            for fetch in group_fetches:
+                if fetch.phases is None:
+                    continue
+                for other in group_fetches:
+                    if other.phases is None:
+                        other.attach(fetch)
+
+            fetches.extend(group_fetches)
+        return fetches
+
+    def run(self, client_class=None):
+        """
+        Downloads every fetch once, streaming the items to its consumers
+
+        Args:
+            client_class: MPDSDataRetrieval subclass, CachedPrefetchingMPDSDataRetrieval by default
+
+        Returns: list of (fetch, number of downloaded items)
+        """
+        if client_class is None:
+            from mpds_prefetch import CachedPrefetchingMPDSDataRetrieval as client_class
+
+        report = []
+        for fetch in self.plan():
+            if fetch.phases is not None and not fetch.pending_phases:
+                report.append((fetch, 0)) # all served before, or none at all
+                continue
+            client = instrument(client_class(dtype=fetch.dtype))
+            report.append((fetch, self.run_fetch(client, fetch)))
+        return report
+
+    @staticmethod
+    def run_fetch(client, fetch):
+        fields, projections = fetch.plan_fields()
+        phases = sorted(fetch.pending_phases) if fetch.phases is not None else None
+
+        if fetch.raw:
+            hidden = {
+                object_type: (
+                    compile_path(parse_path(PHASE_PATHS[object_type])) if PHASE_PATHS[object_type] else (lambda item: None),
+                    compile_path(parse_path(ELEMENTS_PATHS[object_type]))
+                )
+                for object_type in PHASE_PATHS
+            }
+        # the consumers, which query is narrower than the fetch, need the local filters
+        narrower = [(job.elements, job.phases) != (fetch.elements, fetch.phases) for job in fetch.jobs]
+        delivered = {id(other): set() for other in fetch.residuals.values()}
+
+        try:
+            answer = client.get_data(fetch.query, phases=phases, fields=fields)
+        except APIError as error:
+            if getattr(error, 'code', None) == 204: # no hits
+                return 0
+            raise
+
+        count = 0
+        for item in profiled_iter(answer, 'get_data'):
+            count += 1
+            if fetch.raw:
+                get_phase, get_elements = hidden[item['object_type']]
+                phase_id, elements = get_phase(item), get_elements(item)
+            else:
+                phase_id, elements = item[1], item[2]
+
+            for n, (job, projection, filtered) in enumerate(zip(fetch.jobs, projections, narrower)):
+                if filtered and not job.accepts(phase_id, elements):
+                    continue
+                if n in fetch.residuals:
+                    if phase_id in fetch.residuals[n].served: # by another elements fetch
+                        continue
+                    delivered[id(fetch.residuals[n])].add(phase_id)
+                if fetch.raw:
+                    job.consumer(extract([item], projection)[0] if projection is not None else item)
+                else:
+                    job.consumer([item[n] for n in projection.get(item[0], [])])
+
+        for other in set(fetch.residuals.values()):
+            other.served |= delivered[id(other)]
+        return count
+
+
+def run_jobs(jobs, client_class=None):
+    """
+    Runs the jobs of several miners together, round by round:
+    the requests of all the jobs in a round are planned at once,
+    and every job gets its data before yielding the next round.
+    The jobs are aligned by their last rounds, usually the bulk downloads
+    (e.g. the structures of the phases found in the previous rounds).
+
+    Args:
+        jobs: dict of name -> (number of rounds, generator), see the module docstring
+        client_class: see FetchPlanner.run
+
+    Returns: dict of name -> result, list of (fetch, number of downloaded items)
+    """
+    total = max([rounds for rounds, _ in jobs.values()] or [0])
+    active = {name: (total - rounds, generator) for name, (rounds, generator) in jobs.items()}
+    results, report = {}, []
+    step = 0
+
+    while active:
+        planner = FetchPlanner()
+        for name, (start, generator) in list(active.items()):
+            if step < start:
+                continue
+            try:
+                requests = next(generator)
+            except StopIteration as stop:
+                results[name] = stop.value
+                del active[name]
+                continue
+            for request in requests:
+                planner.add(**request)
+
+        if planner.jobs:
+            report.extend(planner.run(client_class))
+        step += 1
+
+    return results, report
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+Precompiled accessors for the MPDS JSON fields:
+the dotted paths like 'sample.measurement[0].property.scalar'
+are checked against the mpds.schema.json once, before any download,
+and compiled into the plain Python functions,
+applied to the whole pages of the raw entries.
+
+    fields = compile_fields({'P': ['sample.material.phase_id', 'sample.measurement[0].property.scalar']})
+    decks = extract(page, fields)
+
+    columns = fill_columns(page, ['sample.material.phase_id', 'sample.measurement[0].property.scalar'])
+
+The paths outside of this simple grammar (e.g. the jmespath projections)
+are passed to jmespath as in MPDSDataRetrieval, without checks.
+"""
+import os
+import re
+import json
+from functools import lru_cache
+
+import numpy as np
+import jmespath
+from mpds_client import APIError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+SCHEMA_PATH = os.environ.get('MPDS_SCHEMA', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'mpds.schema.json'))
+
+OBJECT_TYPES = {'S': 'crystal_structure', 'P': 'physical_property', 'C': 'phase_diagram'}
+
+# served by the API, but not (yet) in the schema
+EXTRA_FIELDS = {
+    'S': {'v': {'type': ['number', 'null']}} # cell volume, A^3
+}
+
+_SEGMENT = re.compile(r'^([A-Za-z_]\w*)((?:\[-?\d+\])*)$')
+_INDEX = re.compile(r'\[(-?\d+)\]')
+
+
+def loads(content):
+    """
+    Decodes the API response, with orjson if available
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+@lru_cache(maxsize=None)
+def load_schema(path=SCHEMA_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def parse_path(path):
+    """
+    Splits the dotted path into the dict keys and list indices
+
+    Returns: tuple of steps, or None if this is not a simple path
+    """
+    steps = []
+    for segment in path.split('.'):
+        match = _SEGMENT.match(segment)
+        if not match:
+            return None
+        steps.append(match.group(1))
+        steps.extend(int(index) for index in _INDEX.findall(match.group(2)))
+    return tuple(steps)
+
+
+def _types(node):
+    types = node.get('type')
+    if types is None:
+        return None # anything
+    return {types} if isinstance(types, str) else set(types)
+
+
+def resolve(path, object_type):
+    """
+    Walks the schema of the object type along the path
+
+    Returns: the schema node of the field
+    Raises: ValueError if there is no such field
+    """
+    if path in EXTRA_FIELDS.get(object_type, {}):
+        return EXTRA_FIELDS[object_type][path]
+
+    schema = load_schema()
+    node = schema['definitions'][OBJECT_TYPES[object_type]]
+    steps = parse_path(path)
+    if steps is None:
+        raise ValueError('Unsupported field path %s' % path)
+
+    for step in steps:
+        if '$ref' in node:
+            node = schema['definitions'][node['$ref'].split('/')[-1]]
+        types = _types(node)
+
+        if isinstance(step, int):
+            if types is not None and 'array' not in types:
+                raise ValueError('Field %s of %s-entries: %s is not a list' % (path, object_type, step))
+            node = node.get('items', {})
+
+        else:
+            if types is not None and 'object' not in types:
+                raise ValueError('Field %s of %s-entries: %s is not expected' % (path, object_type, step))
+            if step in node.get('properties', {}):
+                node = node['properties'][step]
+            elif node.get('additionalProperties') is False:
+                raise ValueError('Field %s of %s-entries: unknown %s' % (path, object_type, step))
+            else:
+                node = {}
+
+    if '$ref' in node:
+        node = schema['definitions'][node['$ref'].split('/')[-1]]
+    return node
+
+
+def compile_path(steps):
+    """
+    Makes a function returning the field of an entry, or None if it is absent,
+    the same as jmespath does
+    """
+    # NB the steps are the validated identifiers and integers only
+    source = "def get(item):\n    try:\n        return item%s\n    except (KeyError, IndexError, TypeError):\n        return None\n" % \
+        ''.join('[%r]' % step for step in steps)
+    namespace = {}
+    exec(source, namespace)
+    return namespace['get']
+
+
+def _constant(value):
+    return lambda item: value
+
+
+def compile_fields(fields, validate=True):
+    """
+    The same fields as for MPDSDataRetrieval.get_data,
+    the callables are evaluated once as in the client
+
+    Returns: dict of object types and lists of the accessors
+    Raises: ValueError if a field does not exist in the schema
+    """
+    compiled = {}
+    for object_type, exprs in fields.items():
+        accessors = []
+        for expr in exprs:
+            if not isinstance(expr, str):
+                accessors.append(_constant(expr()))
+                continue
+
+            steps = parse_path(expr)
+            if steps is None: # beyond the dotted paths
+                accessors.append(jmespath.compile(expr).search)
+                continue
+
+            if validate and object_type in OBJECT_TYPES:
+                resolve(expr, object_type)
+            accessors.append(compile_path(steps))
+        compiled[object_type] = accessors
+    return compiled
+
+
+def extract(array, compiled):
+    """
+    The same as MPDSDataRetrieval._massage with the compiled fields
+    """
+    if not compiled:
+        return array
+
+    output = []
+    for item in array:
+        object_type = item.get('object_type')
+        if object_type not in OBJECT_TYPES:
+            raise APIError("API error: unknown entry type")
+        output.append([get(item) for get in compiled.get(object_type, ())])
+    return output
+
+
+def column_dtype(path, object_type='P'):
+    """
+    NumPy type of the field, according to the schema:
+    float64 for anything numeric, int64 for the integers, otherwise object
+    """
+    types = _types(resolve(path, object_type)) or set()
+    types.discard('null')
+    if types == {'integer'}:
+        return np.int64
+    if 'number' in types or 'integer' in types:
+        return np.float64
+    if types == {'boolean'}:
+        return np.bool_
+    return object
+
+
+def _to_float(value):
+    try: return float(value)
+    except (TypeError, ValueError): return np.nan
+
+
+def fill_columns(array, paths, object_type='P', dtypes=None):
+    """
+    Extracts the fields of the object type entries into the typed arrays,
+    the missing values are NaN (then the integer columns become float64)
+
+    Args:
+        array: (list) raw entries, e.g. a page of the API results
+        paths: (list) dotted paths of the fields
+        object_type: (str) S, P, or C, other entries are skipped
+        dtypes: (dict) optional NumPy types per path, instead of the schema types
+
+    Returns: dict of arrays per path
+    """
+    dtypes = dtypes or {}
+    items = [item for item in array if item.get('object_type') == object_type]
+    columns = {}
+
+    for path in paths:
+        steps = parse_path(path)
+        if steps is None:
+            raise ValueError('Unsupported field path %s' % path)
+        get = compile_path(steps)
+        dtype = dtypes.get(path) or column_dtype(path, object_type)
+
+        if dtype == np.float64:
+            columns[path] = np.fromiter((_to_float(get(item)) for item in items), dtype=np.float64, count=len(items))
+
+        elif dtype == np.int64:
+            values = [get(item) for item in items]
+            if any(value is None for value in values):
+                columns[path] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+            else:
+                columns[path] = np.array(values, dtype=np.int64)
+
+        else:
+            column = np.empty(len(items), dtype=dtype)
+            for n, item in enumerate(items):
+                column[n] = get(item)
+            columns[path] = column
+
+    return columns
+
+
+def concat_columns(parts, paths):
+    """
+    Joins the columns filled page by page
+    """
+    output = {}
+    for path in paths:
+        chunks = [part[path] for part in parts]
+        if not chunks:
+            output[path] = np.empty(0)
+        elif any(chunk.dtype != chunks[0].dtype for chunk in chunks): # int64 and float64 with NaN
+            output[path] = np.concatenate([chunk.astype(np.float64) for chunk in chunks])
+        else:
+            output[path] = np.concatenate(chunks)
+    return output
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Incremental re-mining: the per-entry results are kept
+together with the digests of the entries content,
+so that the next run processes only the new or changed entries,
+and the global result is folded from all the kept ones.
+
+    state = IncrementalState.load('nonformers.state')
+    for pd in client.get_data({...}, fields={}):
+        state.process(pd['entry'], {key: pd[key] for key in used_keys}, classify)
+    state.prune() # entries gone from the MPDS
+    state.save('nonformers.state')
+    result = fold(state.results())
+
+NB the MPDS API has no changed-since filter, so all the entries
+are still downloaded, only their processing is skipped. They are downloaded
+without the response cache (see CachedMPDSDataRetrieval), as it would
+replay the entries of the previous runs.
+The processing function must depend on the digested content only.
+If the processing is done elsewhere (e.g. in a process pool), the entries are checked
+with state.changed() and their results kept with state.store(), see CrystalStage.map.
+"""
+import os
+import json
+import pickle
+import hashlib
+
+
+def content_digest(content):
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+    ).hexdigest()
+
+
+class IncrementalState(object):
+    """
+    Entry id -> (content digest, result) of the processed entries
+    """
+    def __init__(self, tag=None):
+        self.tag = tag # e.g. the processing parameters, a changed tag invalidates the state
+        self.records = {}
+        self.seen = set()
+        self.counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'removed': 0}
+
+    def process(self, entry, content, func):
+        """
+        Returns func(content), calculated only if the entry is new or its content changed
+        """
+        if not self.changed(entry, content):
+            return self.result(entry)
+
+        result = func(content)
+        self.store(entry, content, result)
+        return result
+
+    def changed(self, entry, content):
+        """
+        Whether the entry is new or its content changed, so that it is to be processed
+        and its result stored (e.g. if processed elsewhere, in a process pool); marks it seen
+        """
+        self.seen.add(entry)
+
+        record = self.records.get(entry)
+        if record is not None and record[0] == content_digest(content):
+            self.counts['unchanged'] += 1
+            return False
+
+        self.counts['changed' if record is not None else 'new'] += 1
+        return True
+
+    def store(self, entry, content, result):
+        self.records[entry] = (content_digest(content), result)
+
+    def result(self, entry):
+        return self.records[entry][1]
+
+    def prune(self):
+        """
+        Forgets the entries not seen during this run
+        """
+        for entry in set(self.records) - self.seen:
+            del self.records[entry]
+            self.counts['removed'] += 1
+
+    def report(self, title):
+        return ("%s: %%(new)s new, %%(changed)s changed, %%(unchanged)s unchanged, %%(removed)s removed" % title) % self.counts
+
+    def results(self):
+        return [record[1] for record in self.records.values()]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, entry):
+        return entry in self.records
+
+    def save(self, path):
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'tag': self.tag, 'records': self.records}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, tag=None):
+        """
+        Returns the state saved at the path, or an empty one
+        (also if it was saved with another tag)
+        """
+        state = cls(tag)
+        if not path or not os.path.exists(path):
+            return state
+
+        with open(path, 'rb') as f:
+            stored = pickle.load(f)
+
+        if stored['tag'] == tag:
+            state.records = stored['records']
+        return state
@@ -0,0 +1,158 @@
+"""
+Vectorized NumPy K-Means with the automatic choice of k:
+the candidate k values are scored in parallel on a sample
+(silhouette, inertia), and the full set is clustered
+starting from the sample centroids of the best k.
+
+    labels, centroids, scores = kmeans_auto(X)
+
+See kmeans.py for the pure-Python version.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+K_RANGE = range(2, 13)
+SAMPLE = 2000 # points to score the k values, silhouette is quadratic
+
+
+def sq_distances(X, centroids):
+    """
+    Squared distances of every point to every centroid, (n, k)
+    """
+    return np.maximum(
+        (X ** 2).sum(axis=1)[:, None] - 2 * X @ centroids.T + (centroids ** 2).sum(axis=1)[None, :],
+        0
+    )
+
+
+def init_centroids(X, k, rng):
+    """
+    k-means++ seeding
+    """
+    centroids = np.empty((k, X.shape[1]))
+    centroids[0] = X[rng.integers(len(X))]
+    closest = sq_distances(X, centroids[:1])[:, 0]
+    for n in range(1, k):
+        total = closest.sum()
+        index = rng.choice(len(X), p=closest / total) if total > 0 else rng.integers(len(X))
+        centroids[n] = X[index]
+        closest = np.minimum(closest, sq_distances(X, centroids[n:n + 1])[:, 0])
+    return centroids
+
+
+def lloyd(X, centroids, max_iter=100, tol=1e-6):
+    """
+    Lloyd iterations from the given centroids;
+    an emptied cluster keeps its previous centroid
+
+    Returns: labels, centroids, inertia
+    """
+    centroids = np.array(centroids, dtype=np.float64)
+    k = len(centroids)
+    for _ in range(max_iter):
+        labels = sq_distances(X, centroids).argmin(axis=1)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, X)
+        updated = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids)
+        shift = np.abs(updated - centroids).max()
+        centroids = updated
+        if shift <= tol:
+            break
+
+    dists = sq_distances(X, centroids)
+    labels = dists.argmin(axis=1)
+    return labels, centroids, dists[np.arange(len(X)), labels].sum()
+
+
+def fit(X, k, n_init=4, seed=None, centroids=None):
+    """
+    The best of n_init k-means++ runs, or a single run from the given centroids
+
+    Returns: labels, centroids, inertia
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if k > len(X): raise RuntimeError("Not enough points")
+    if centroids is not None:
+        return lloyd(X, centroids)
+
+    rng = np.random.default_rng(seed)
+    best = None
+    for _ in range(n_init):
+        result = lloyd(X, init_centroids(X, k, rng))
+        if best is None or result[2] < best[2]:
+            best = result
+    return best
+
+
+def silhouette(X, labels):
+    """
+    Mean silhouette coefficient, the singleton clusters score 0
+    """
+    X = np.asarray(X, dtype=np.float64)
+    k = labels.max() + 1
+    dists = np.sqrt(sq_distances(X, X))
+    counts = np.bincount(labels, minlength=k)
+
+    # sum of the distances of every point to every cluster
+    sums = dists @ np.eye(k)[labels]
+
+    own = counts[labels]
+    a = sums[np.arange(len(X)), labels] / np.maximum(own - 1, 1)
+    means = sums / np.where(counts > 0, counts, 1)
+    means[np.arange(len(X)), labels] = np.inf
+    means[:, counts == 0] = np.inf
+    b = means.min(axis=1)
+
+    scores = np.where(own > 1, (b - a) / np.maximum(np.maximum(a, b), 1e-12), 0)
+    return scores.mean()
+
+
+def score_k(task):
+    """
+    Worker: (k, silhouette, inertia, centroids) on the sample
+    """
+    sample, k, n_init, seed = task
+    labels, centroids, inertia = fit(sample, k, n_init=n_init, seed=seed)
+    return k, silhouette(sample, labels), inertia, centroids
+
+
+def select_k(X, k_range=K_RANGE, sample=SAMPLE, n_init=4, seed=None, processes=None):
+    """
+    Scores the k values on a random sample of the points
+
+    Args:
+        processes: (int) pool size, all cores by default; 0 means no pool
+
+    Returns: best k, its sample centroids, and {k: (silhouette, inertia)}
+    """
+    X = np.asarray(X, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    if len(X) > sample:
+        X = X[rng.choice(len(X), sample, replace=False)]
+
+    tasks = [(X, k, n_init, int(rng.integers(2**31))) for k in k_range if 1 < k < len(X)]
+    if not tasks: raise RuntimeError("Not enough points")
+
+    if processes == 0:
+        results = list(map(score_k, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(score_k, tasks))
+
+    best = max(results, key=lambda result: result[1])
+    return best[0], best[3], {k: (score, inertia) for k, score, inertia, _ in results}
+
+
+def kmeans_auto(X, k_range=K_RANGE, sample=SAMPLE, n_init=4, seed=None, processes=None):
+    """
+    Clusters the points with the best k, see select_k
+
+    Returns: labels, centroids, {k: (silhouette, inertia)}
+    """
+    X = np.asarray(X, dtype=np.float64)
+    k, centroids, scores = select_k(X, k_range, sample, n_init, seed, processes)
+    labels, centroids, _ = fit(X, k, centroids=centroids) # warm start
+    return labels, centroids, scores
@@ -0,0 +1,123 @@
+"""
+Bounded-memory join of the two streams of records on a key (e.g. phase_id):
+each stream is spilled into the sorted runs on disk,
+then the runs are merged and the streams are merge-joined.
+The records are kept pickled, and a run is spilled as soon as
+its pickles exceed run_bytes, so the memory is bounded by the bytes
+(not the number) of the records, whatever their payloads.
+The payloads of a key come in the order they were added.
+
+    with SortedRuns() as left, SortedRuns() as right:
+        for deck in ...: left.add(deck[2], deck[3])
+        for deck in ...: right.add(deck[2], deck[3])
+        for phase_id, left_values, right_values in merge_join(left, right):
+            ...
+"""
+import os
+import heapq
+import pickle
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+
+
+DEFAULT_RUN_BYTES = 16 * 1024 * 1024 # pickled records kept in memory before spilling
+
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                break
+
+
+class SortedRuns(object):
+    """
+    Accumulates (key, payload) records, spilling them sorted by key
+    into a temporary file every run_bytes of pickles (or every run_size records);
+    iterating yields all the records sorted by key
+    """
+    def __init__(self, run_bytes=DEFAULT_RUN_BYTES, run_size=None, tmp_dir=None):
+        self.run_bytes = run_bytes
+        self.run_size = run_size
+        self.tmp_dir = tmp_dir
+        self.count = 0
+        self._buffer = [] # (key, pickled record)
+        self._buffer_bytes = 0
+        self._runs = []
+
+    def add(self, key, payload):
+        blob = pickle.dumps((key, payload), protocol=pickle.HIGHEST_PROTOCOL)
+        self._buffer.append((key, blob))
+        self._buffer_bytes += len(blob)
+        self.count += 1
+        if self._buffer_bytes >= self.run_bytes or (self.run_size and len(self._buffer) >= self.run_size):
+            self._spill()
+
+    def _spill(self):
+        if not self._buffer:
+            return
+        self._buffer.sort(key=itemgetter(0)) # NB stable
+
+        fd, path = tempfile.mkstemp(suffix='.run', dir=self.tmp_dir)
+        with os.fdopen(fd, 'wb') as f:
+            for _, blob in self._buffer:
+                f.write(blob)
+
+        self._runs.append(path)
+        self._buffer, self._buffer_bytes = [], 0
+
+    def spilled(self):
+        return len(self._runs)
+
+    def __iter__(self):
+        self._buffer.sort(key=itemgetter(0))
+        in_memory = (pickle.loads(blob) for _, blob in self._buffer)
+        if not self._runs:
+            return in_memory
+
+        # NB heapq.merge is stable, the earlier runs go first
+        return heapq.merge(*([_read_run(path) for path in self._runs] + [in_memory]), key=itemgetter(0))
+
+    def close(self):
+        for path in self._runs:
+            try: os.unlink(path)
+            except OSError: pass
+        self._runs, self._buffer, self._buffer_bytes = [], [], 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def grouped(records):
+    """
+    Turns the key-sorted (key, payload) records into (key, [payloads])
+    """
+    for key, group in groupby(records, key=itemgetter(0)):
+        yield key, [payload for _, payload in group]
+
+
+def merge_join(left, right):
+    """
+    Inner join of the two key-sorted record streams
+
+    Yields: key, left payloads, right payloads
+    """
+    left, right = grouped(left), grouped(right)
+    left_item, right_item = next(left, None), next(right, None)
+
+    while left_item is not None and right_item is not None:
+        if left_item[0] < right_item[0]:
+            left_item = next(left, None)
+
+        elif left_item[0] > right_item[0]:
+            right_item = next(right, None)
+
+        else:
+            yield left_item[0], left_item[1], right_item[1]
+            left_item, right_item = next(left, None), next(right, None)
@@ -1,43 +1,78 @@
 #!/usr/bin/env python3
-
+"""
+MPDS API usage example:
+analysis of the raw ab initio electronic transport simulation data
+"""
 import io
-
-import requests
-from mpds_client import MPDSDataRetrieval, MPDSDataTypes
+import logging
+import argparse
 
 from etransport_raw import analyze_raw # this is given in the supplied file "etransport_raw.py"
+from profiling import instrument, profiled_iter, stage
 
-# the raw simulation data on the MPDS are in 7z format
-# so we need the latest dev version of pylzma
-# pip install git+https://github.com/fancycode/pylzma
-# then py7zlib is available
 
-from py7zlib import Archive7z
+def analyze_etransport(api_client=None):
+    """
+    Yields: phase, result of the raw data analysis
+    """
+    import requests
+    from mpds_client import MPDSDataTypes
+    from mpds_prefetch import CachedPrefetchingMPDSDataRetrieval
 
+    # the raw simulation data on the MPDS are in 7z format
+    # so we need the latest dev version of pylzma
+    # pip install git+https://github.com/fancycode/pylzma
+    # then py7zlib is available
 
-mpds_api = MPDSDataRetrieval(dtype=MPDSDataTypes.AB_INITIO)
+    from py7zlib import Archive7z
 
-for entry in mpds_api.get_data({'props': 'electrical conductivity'}, fields={}):
+    mpds_api = api_client or instrument(CachedPrefetchingMPDSDataRetrieval(dtype=MPDSDataTypes.AB_INITIO))
 
-    archive_url = entry['sample']['measurement'][0]['raw_data'] # this is the raw data archive field in the MPDS JSON P-entries
+    for item in profiled_iter(mpds_api.get_data({'props': 'electrical conductivity'}, fields={'P': [
+        'sample.measurement[0].raw_data', # this is the raw data archive field in the MPDS JSON P-entries
+        'sample.material.entry',
+        'sample.material.phase'
+    ]}), 'get_data'):
 
-    p = requests.get(archive_url)
-    if p.status_code != 200:
-        logging.critical('ARCHIVE %s IS UNAVAILABLE' % archive_url)
-        continue
-
-    print('Analyzing the raw data for %s' % entry['sample']['material']['entry'])
+        if not item: # not a P-entry
+            continue
 
-    archive = Archive7z(io.BytesIO(p.content))
-    for virtual_path in archive.files:
+        archive_url, entry, phase = item
+        if not archive_url:
+            continue
 
-        if virtual_path.filename != 'TRANSPORT/SIGMA.DAT': # raw simulation output log file
+        with stage('raw_data') as st:
+            p = requests.get(archive_url)
+            st.add_bytes(len(p.content))
+        if p.status_code != 200:
+            logging.critical('ARCHIVE %s IS UNAVAILABLE' % archive_url)
             continue
 
-        # this is how we extract data from the 7z-archive
-        member = archive.getmember(virtual_path.filename)
-        rawdata = io.StringIO(member.read().decode('ascii'))
-        result = analyze_raw(rawdata)
-        rawdata.seek(0)
+        print('Analyzing the raw data for %s' % entry)
+
+        archive = Archive7z(io.BytesIO(p.content))
+        for virtual_path in archive.files:
+
+            if virtual_path.filename != 'TRANSPORT/SIGMA.DAT': # raw simulation output log file
+                continue
+
+            # this is how we extract data from the 7z-archive
+            member = archive.getmember(virtual_path.filename)
+            rawdata = io.StringIO(member.read().decode('ascii'))
+            with stage('analysis'):
+                result = analyze_raw(rawdata)
+            rawdata.seek(0)
+
+            yield phase, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args(argv)
+
+    for phase, result in analyze_etransport():
+        print(phase, result)
+
 
-        print(entry['sample']['material']['phase'], result)
+if __name__ == "__main__":
+    main()
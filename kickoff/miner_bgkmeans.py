@@ -5,50 +5,128 @@ clustering the band gaps of binary compounds
 
 https://developer.mpds.io/#Clustering
 """
+import argparse
 
-from ase.data import chemical_symbols
+from element_groups import get_element_group
+from profiling import instrument, stage
 
-from mpds_client import MPDSDataRetrieval, MPDSExport
 
-from kmeans import Point, kmeans, k_from_n
-from element_groups import get_element_group
+BANDGAP_SEARCH = {"classes": "binary", "props": "band gap"}
+BANDGAP_FIELDS = {'P': [
+    'sample.material.chemical_formula',
+    'sample.material.chemical_elements',
+    'sample.material.condition[0].scalar[0].value',
+    'sample.measurement[0].property.units',
+    'sample.measurement[0].property.scalar'
+]}
+BANDGAP_COLUMNS = ['Formula', 'Elements', 'SG', 'Units', 'Bandgap']
+
+def element_groups_lookup():
+    """
+    Returns: dict of the element group per chemical symbol
+    """
+    from ase.data import chemical_symbols
+
+    return {symbol: get_element_group(num) for num, symbol in enumerate(chemical_symbols) if num}
+
+
+def featurize(dfrm):
+    """
+    Average band gap per formula and the sorted groups of its two elements,
+    sorted by formula
+
+    Returns: (n, 3) array of [groupA, groupB, bandgap], and the formulae
+    """
+    import numpy as np
+
+    dfrm = dfrm.groupby('Formula', sort=True).agg(Elements=('Elements', 'first'), AvgBandgap=('Bandgap', 'mean'))
+    lookup = element_groups_lookup()
+
+    groups = np.sort(np.column_stack([
+        dfrm['Elements'].str[0].map(lookup).to_numpy(dtype=np.float64),
+        dfrm['Elements'].str[1].map(lookup).to_numpy(dtype=np.float64)
+    ]), axis=1)
+    return np.column_stack([groups, dfrm['AvgBandgap'].round(2).to_numpy()]), dfrm.index.tolist()
+
+
+def cluster_bandgaps(k=None, seed=None, processes=None, api_client=None):
+    """
+    Clusters the binary compounds by the groups
+    of their elements and the average band gap
+
+    Args:
+        k: (int) number of clusters, chosen automatically if not given (see kmeans_vec)
+        seed: (int) random seed
+        processes: (int) pool size for scoring the k values
+
+    Returns: list of [groupA, groupB, bandgap, compound, cluster]
+    """
+    from mpds_cache import CachedMPDSDataRetrieval
+
+    client = api_client or instrument(CachedMPDSDataRetrieval())
+
+    return cluster_dataframe(client.get_dataframe(BANDGAP_SEARCH, fields=BANDGAP_FIELDS, columns=BANDGAP_COLUMNS), k, seed, processes)
+
+
+def band_gap_job(k=None, seed=None, processes=None):
+    """
+    The cluster_bandgaps as a job of fetch_planner.run_jobs (a single round)
+    """
+    import pandas as pd
+
+    rows = []
+    yield [dict(search=BANDGAP_SEARCH, consumer=rows.append, fields=BANDGAP_FIELDS)]
+
+    return cluster_dataframe(pd.DataFrame(rows, columns=BANDGAP_COLUMNS), k, seed, processes)
+
+
+def cluster_dataframe(dfrm, k=None, seed=None, processes=None):
+    """
+    Clusters the downloaded band gaps, see cluster_bandgaps
+
+    Args:
+        dfrm: (dataframe) with the BANDGAP_COLUMNS
+    """
+    import numpy as np
+    from kmeans_vec import fit, kmeans_auto
+
+    dfrm = dfrm[dfrm['Units'] == 'eV']
+    dfrm = dfrm[(dfrm['Bandgap'] > 0) & (dfrm['Bandgap'] < 20)]
 
+    with stage('featurization') as st:
+        fitdata, formulae = featurize(dfrm)
+        st.count(len(fitdata))
 
-client = MPDSDataRetrieval()
+    with stage('kmeans') as st:
+        if k:
+            labels, _, _ = fit(fitdata, k, seed=seed)
+        else:
+            labels, _, scores = kmeans_auto(fitdata, seed=seed, processes=processes)
+            for n in sorted(scores):
+                print("k = %s: silhouette %.3f, inertia %.1f" % (n, scores[n][0], scores[n][1]))
+        st.count(len(fitdata))
 
-dfrm = client.get_dataframe(
-    {"classes": "binary", "props": "band gap"},
-    fields={'P': [
-        'sample.material.chemical_formula',
-        'sample.material.chemical_elements',
-        'sample.material.condition[0].scalar[0].value',
-        'sample.measurement[0].property.units',
-        'sample.measurement[0].property.scalar'
-    ]},
-    columns=['Formula', 'Elements', 'SG', 'Units', 'Bandgap']
-)
-dfrm = dfrm[dfrm['Units'] == 'eV']
-dfrm = dfrm[(dfrm['Bandgap'] > 0) & (dfrm['Bandgap'] < 20)]
+    # the non-empty clusters are numbered from 1, the points follow by cluster
+    _, clusters = np.unique(labels, return_inverse=True)
+    export_data = []
+    for n in np.argsort(clusters, kind='stable'):
+        export_data.append(fitdata[n].tolist() + [formulae[n], int(clusters[n]) + 1])
 
-avgbgfrm = dfrm.groupby('Formula')['Bandgap'].mean().to_frame().reset_index().rename(columns={'Bandgap': 'AvgBandgap'})
+    return export_data
 
-dfrm = dfrm.merge(avgbgfrm, how='outer', on='Formula')
-dfrm.drop_duplicates('Formula', inplace=True)
-dfrm.sort_values('Formula', inplace=True)
 
-fitdata, export_data = [], []
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', type=int, help='number of clusters, chosen by the silhouette score if not given')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('--processes', type=int, help='worker processes scoring the k values, all cores by default')
+    args = parser.parse_args(argv)
 
-for n, row in dfrm.iterrows():
-    groupA, groupB = \
-        get_element_group(chemical_symbols.index(row['Elements'][0])), \
-        get_element_group(chemical_symbols.index(row['Elements'][1]))
-    fitdata.append(Point(sorted([groupA, groupB]) + [round(row['AvgBandgap'], 2)], reference=row['Formula']))
+    from mpds_client import MPDSExport
 
-clusters = kmeans(fitdata, k_from_n(len(fitdata)))
+    export = MPDSExport.save_plot(cluster_bandgaps(args.k, args.seed, args.processes), ['groupA', 'groupB', 'bandgap', 'compound', 'cluster'], 'plot3d')
+    print(export)
 
-for cluster_n, cluster in enumerate(clusters, start=1):
-    for pnt in cluster.points:
-        export_data.append(pnt.coords + [pnt.reference] + [cluster_n])
 
-export = MPDSExport.save_plot(export_data, ['groupA', 'groupB', 'bandgap', 'compound', 'cluster'], 'plot3d')
-print(export)
+if __name__ == "__main__":
+    main()
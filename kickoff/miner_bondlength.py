@@ -5,41 +5,169 @@ the uranium-oxygen chemical bond length distribution
 
 https://developer.mpds.io/#Probability-density
 """
+import argparse
+from functools import partial
+from operator import attrgetter, itemgetter
 
-import pandas as pd
+from structure_fingerprint import StructureGroups
+from crystal_stage import CrystalStage, STANDARD
+from profiling import instrument, profiled, profiled_iter, stage
 
-from mpds_client import MPDSDataRetrieval, MPDSExport
 
+STRUCTURE_FIELDS = {'S':['phase_id', 'entry', 'chemical_formula', 'cell_abc', 'sg_n', 'basis_noneq', 'els_noneq']}
 
+@profiled()
 def calculate_lengths(ase_obj, elA, elB, limit=4):
+    """
+    The elA-elB distances below the limit, incl. the periodic images,
+    so that they do not depend on the cell setting and origin,
+    per elA atom of the (standardized primitive) cell
+    """
+    import numpy as np
+    from ase.neighborlist import neighbor_list
+
     assert elA != elB
-    lengths = []
-    for n, atom in enumerate(ase_obj):
-        if atom.symbol == elA:
-            for m, neighbor in enumerate(ase_obj):
-                if neighbor.symbol == elB:
-                    dist = round(ase_obj.get_distance(n, m), 2) # NB occurrence <-> rounding
-                    if dist < limit:
-                        lengths.append(dist)
-    return lengths
-
-client = MPDSDataRetrieval()
-
-answer = client.get_data(
-    {"elements": "U-O", "props": "atomic structure"},
-    fields={'S':['phase_id', 'entry', 'chemical_formula', 'cell_abc', 'sg_n', 'basis_noneq', 'els_noneq']}
-)
-
-lengths = []
-
-for item in answer:
-    crystal = MPDSDataRetrieval.compile_crystal(item, 'ase')
-    if not crystal: continue
-    lengths.extend( calculate_lengths(crystal, 'U', 'O') )
-
-dfrm = pd.DataFrame(sorted(lengths), columns=['length'])
-dfrm['occurrence'] = dfrm.groupby('length')['length'].transform('count')
-dfrm.drop_duplicates('length', inplace=True)
-
-export = MPDSExport.save_plot(dfrm, ['length', 'occurrence'], 'bar')
-print(export)
+    symbols = np.array(ase_obj.get_chemical_symbols())
+    first, second, dists = neighbor_list('ijd', ase_obj, limit)
+    selected = (symbols[first] == elA) & (symbols[second] == elB)
+    return [round(dist, 2) for dist in dists[selected].tolist()] # NB occurrence <-> rounding
+
+
+def bond_length_distribution(elA='U', elB='O', limit=4, dedup=True, weighted=False, processes=None, state_path=None, api_client=None):
+    """
+    Args:
+        elA, elB: (str) chemical elements
+        limit: (float) maximal bond length, A
+        dedup: (bool) whether to analyze the equivalent structures once
+        weighted: (bool) whether to count the lengths of the equivalent structures
+            by their number of entries (with dedup)
+        processes: (int) structures compiling pool size, see CrystalStage
+        state_path: (str) file of the per-structure lengths for the incremental mode
+
+    Returns: pandas dataframe of the lengths and their occurrence
+    """
+    from mpds_prefetch import PrefetchingMPDSDataRetrieval, CachedPrefetchingMPDSDataRetrieval
+
+    # NB the incremental runs are not cached, so that they see the changed structures
+    client_class = PrefetchingMPDSDataRetrieval if state_path else CachedPrefetchingMPDSDataRetrieval
+    client = api_client or instrument(client_class())
+
+    answer = profiled_iter(client.get_data({"elements": "%s-%s" % (elA, elB), "props": "atomic structure"}, fields=STRUCTURE_FIELDS), 'get_data')
+
+    # the new structures are compiled while downloading
+    groups = StructureGroups() if dedup else None
+    compiler, kwargs = lengths_compiler(elA, elB, limit, dedup, processes, state_path)
+    results = list(compiler.map(items=groups.stream(answer, entry=itemgetter(1)) if dedup else answer, **kwargs))
+
+    return length_distribution(results, compiler, groups, weighted, kwargs['state'], state_path)
+
+
+def bond_length_job(elA='U', elB='O', limit=4, dedup=True, weighted=False, processes=None, state_path=None):
+    """
+    The bond_length_distribution as a job of fetch_planner.run_jobs (a single round)
+    """
+    groups = StructureGroups() if dedup else None
+    compiler, kwargs = lengths_compiler(elA, elB, limit, dedup, processes, state_path)
+    push, finish = compiler.feed(**kwargs)
+
+    yield [dict(
+        search={"elements": "%s-%s" % (elA, elB), "props": "atomic structure"},
+        consumer=groups.consumer(push, entry=itemgetter(1)) if dedup else push, fields=STRUCTURE_FIELDS
+    )]
+
+    return length_distribution(finish(), compiler, groups, weighted, kwargs['state'], state_path)
+
+
+def lengths_compiler(elA, elB, limit=4, dedup=True, processes=None, state_path=None):
+    """
+    Returns: CrystalStage and the keyword arguments of its map or feed,
+    for the structure groups (with dedup) or the datarows
+    """
+    from incremental import IncrementalState
+
+    kwargs = dict(
+        func=partial(calculate_lengths, elA=elA, elB=elB, limit=limit),
+        state=IncrementalState.load(state_path, tag=('bondlength', STANDARD, elA, elB, limit)) if state_path else None
+    )
+    if dedup:
+        kwargs.update(datarow=attrgetter('representative'), entry=lambda group: group.representative[1])
+    else:
+        kwargs.update(entry=itemgetter(1))
+
+    # the order does not matter, as the lengths are summed up;
+    # the standard form gives the same lengths for all the entries of a group
+    return CrystalStage(flavor=STANDARD, processes=processes, ordered=False), kwargs
+
+
+def length_distribution(results, compiler, groups=None, weighted=False, state=None, state_path=None):
+    """
+    Args:
+        results: list of (structure group or datarow, lengths), see lengths_compiler
+        groups: (object) StructureGroups with dedup
+        weighted: (bool) whether to count the lengths of a group by its number of entries
+        state: (object) IncrementalState of the lengths, saved into the state_path
+
+    Returns: pandas dataframe of the lengths and their occurrence
+    """
+    import pandas as pd
+
+    if groups is not None:
+        print("Unique structures: %s of %s" % (len(groups), groups.total))
+    print(compiler.report())
+    if state is not None:
+        state.prune()
+        state.save(state_path)
+        print(state.report("Structures"))
+
+    lengths, weights = [], []
+    for item, item_lengths in results:
+        # the multiplicities are final, as the download is over
+        weight = item.multiplicity if groups is not None and weighted else 1
+        lengths.extend(item_lengths)
+        weights.extend([weight] * len(item_lengths))
+
+    with stage('analysis') as st:
+        dfrm = pd.DataFrame({'length': lengths, 'occurrence': weights})
+        dfrm = dfrm.groupby('length', as_index=False)['occurrence'].sum()
+        st.count(len(lengths))
+
+    return dfrm
+
+
+def atlas_distribution(path, elA='U', elB='O', limit=4):
+    """
+    The same dataframe from the atlas saved by bond_atlas.py
+    """
+    import pandas as pd
+    from bond_atlas import BondAtlas
+
+    lengths, occurrence = BondAtlas.load(path).distribution(elA, elB)
+    dfrm = pd.DataFrame({'length': lengths, 'occurrence': occurrence})
+    return dfrm[dfrm['length'] < limit]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('elA', nargs='?', default='U', help='first chemical element')
+    parser.add_argument('elB', nargs='?', default='O', help='second chemical element')
+    parser.add_argument('--limit', type=float, default=4, help='maximal bond length, A')
+    parser.add_argument('--no-dedup', dest='dedup', action='store_false', help='analyze every entry, even of the equivalent structures')
+    parser.add_argument('--weighted', action='store_true', help='count the equivalent structures by their number of entries')
+    parser.add_argument('--atlas', help='take the distribution from the atlas file of bond_atlas.py instead of the API')
+    parser.add_argument('--processes', type=int, help='worker processes compiling the structures, all cores by default')
+    parser.add_argument('--state', help='file of the per-structure lengths, to compile only the new or changed structures')
+    args = parser.parse_args(argv)
+
+    from mpds_client import MPDSExport
+
+    if args.atlas:
+        dfrm = atlas_distribution(args.atlas, args.elA, args.elB, args.limit)
+    else:
+        dfrm = bond_length_distribution(args.elA, args.elB, args.limit, args.dedup, args.weighted, args.processes, args.state)
+
+    export = MPDSExport.save_plot(dfrm, ['length', 'occurrence'], 'bar')
+    print(export)
+
+
+if __name__ == "__main__":
+    main()
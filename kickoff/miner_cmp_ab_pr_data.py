@@ -7,41 +7,19 @@ for the further comparison
 import os.path
 import pickle
 import math
+import argparse
 
-from mpds_client import MPDSDataRetrieval, MPDSDataTypes
+from merge_join import SortedRuns, merge_join
+from phase_registry import PhaseRegistry
+from profiling import instrument, profiled_iter, stage
 
 
 result_cache = 'mpds_cmp_ab_pr.pkl'
+phases_cache = 'mpds_phases.pkl'
 
 MILLIEV_TO_INVCM = 8.06554
 INVMM_TO_INVCM = 10
 
-MPDSDataRetrieval.chilouttime = 0.5
-
-
-def sg_to_label(num):
-    if   195 <= num <= 230: return 'cub'
-    elif 168 <= num <= 194: return 'hex'
-    elif 143 <= num <= 167: return 'trig'
-    elif 75  <= num <= 142: return 'tet'
-    elif 16  <= num <= 74:  return 'orth'
-    elif 3   <= num <= 15:  return 'monocl'
-    elif 1   <= num <= 2:   return 'tricl'
-    else: raise RuntimeError(f'Space group number {num} is invalid')
-
-
-def short_formula(given_string, round_brackets_strip=True):
-    given_string = given_string.split()[0].strip().replace("x", "")
-
-    if given_string.startswith("[") and len(given_string.split("[")) == 2 and given_string.endswith("]"):
-        given_string = given_string.strip("[]")
-
-    if round_brackets_strip:
-        given_string = given_string.strip("()")
-
-    given_string = given_string.replace("(", "[").replace(")", "]")
-    return given_string
-
 
 def is_scalar(value):
     try: float(value)
@@ -98,7 +76,8 @@ def pr_prop_massage_6(deck):
     return deck
 
 
-phases_known_bg_type = set()
+phase_registry = PhaseRegistry() # filled by the harvesting or loaded from phases_cache
+phases_known_bg_type = set() # per run, filled by bg_filter_2 and used by bg_filter_3
 
 def bg_filter_1(deck):
     if deck[4] != 'eV':
@@ -109,7 +88,8 @@ def bg_filter_1(deck):
 def bg_filter_2(deck):
     if deck[4] != 'eV':
         return None
-    phases_known_bg_type.add(deck[2])
+    if deck[2] is not None:
+        phases_known_bg_type.add(deck[2])
     return deck
 
 
@@ -231,7 +211,27 @@ work_outline = {
     # 'Raman spectra': {}    # TODO after new data 2022 release
 }
 
-phase_formulae = {}
+def harvest_values(runs, mpds_api, prop_name, prop_conds, prop_massage, interval):
+    """
+    Streams the decks of a property into the phase-keyed sorted runs,
+    applying the massage (e.g. units filter) and the interval check on the fly
+    """
+    for deck in profiled_iter(mpds_api.get_data({'props': prop_name}, fields={'P': prop_conds}), 'get_data'):
+        if prop_massage:
+            deck = prop_massage(deck)
+            if not deck:
+                continue
+
+        if is_scalar(deck[3]) and not interval[0] < float(deck[3]) < interval[1]:
+            print('Skipping value: %s' % str(deck))
+            continue
+
+        if deck[2] is None: # no distinct phase to join on
+            continue
+
+        runs.add(deck[2], deck[3])
+        phase_registry.add(deck[2], deck[0], deck[1])
+
 
 def get_ab_pr_values(
     ab_prop_name,
@@ -242,73 +242,69 @@ def get_ab_pr_values(
     ab_prop_massage=None,
     pr_prop_massage=None
 ):
+    """
+    Returns: list of (phase, ab initio values, peer-reviewed values)
+    """
+    from mpds_client import MPDSDataTypes
+    from mpds_prefetch import CachedPrefetchingMPDSDataRetrieval
+
     if not pr_prop_name:
         pr_prop_name = ab_prop_name
 
-    ab_data, pr_data = {}, {}
+    data = []
 
-    print('#' * 50, 'downloading', ab_prop_name)
+    with SortedRuns() as ab_data, SortedRuns() as pr_data:
 
-    mpds_api = MPDSDataRetrieval(dtype=MPDSDataTypes.AB_INITIO)
-    for deck in mpds_api.get_data({'props': ab_prop_name}, fields={'P': ab_prop_conds or [
-        'sample.material.chemical_formula',
-        'sample.material.condition[0].scalar[0].value',
-        'sample.material.phase_id',
-        'sample.measurement[0].property.scalar'
-    ]}):
-        if ab_prop_massage:
-            deck = ab_prop_massage(deck)
-            if not deck:
-                continue
+        print('#' * 50, 'downloading', ab_prop_name)
 
-        if is_scalar(deck[3]) and not interval[0] < deck[3] < interval[1]:
-            print('Skipping value: %s' % str(deck))
-            continue
+        harvest_values(ab_data, instrument(CachedPrefetchingMPDSDataRetrieval(dtype=MPDSDataTypes.AB_INITIO)), ab_prop_name, ab_prop_conds or [
+            'sample.material.chemical_formula',
+            'sample.material.condition[0].scalar[0].value',
+            'sample.material.phase_id',
+            'sample.measurement[0].property.scalar'
+        ], ab_prop_massage, interval)
 
-        ab_data.setdefault(deck[2], []).append(deck[3])
-        phase_formulae[deck[2]] = (short_formula(deck[0]), sg_to_label(deck[1]))
-
-    print('#' * 50, 'downloading', pr_prop_name)
-
-    mpds_api = MPDSDataRetrieval(dtype=MPDSDataTypes.PEER_REVIEWED)
-    for deck in mpds_api.get_data({'props': pr_prop_name}, fields={'P': pr_prop_conds or [
-        'sample.material.chemical_formula',
-        'sample.material.condition[0].scalar[0].value',
-        'sample.material.phase_id',
-        'sample.measurement[0].property.scalar',
-        'sample.measurement[0].property.units',
-        'sample.measurement[0].condition[0].units',
-        'sample.measurement[0].condition[0].name',
-        'sample.measurement[0].condition[0].scalar'
-    ]}):
-        if pr_prop_massage:
-            deck = pr_prop_massage(deck)
-            if not deck:
-                continue
+        print('#' * 50, 'downloading', pr_prop_name)
 
-        if is_scalar(deck[3]) and not interval[0] < float(deck[3]) < interval[1]:
-            print('Skipping value: %s' % str(deck))
-            continue
+        harvest_values(pr_data, instrument(CachedPrefetchingMPDSDataRetrieval(dtype=MPDSDataTypes.PEER_REVIEWED)), pr_prop_name, pr_prop_conds or [
+            'sample.material.chemical_formula',
+            'sample.material.condition[0].scalar[0].value',
+            'sample.material.phase_id',
+            'sample.measurement[0].property.scalar',
+            'sample.measurement[0].property.units',
+            'sample.measurement[0].condition[0].units',
+            'sample.measurement[0].condition[0].name',
+            'sample.measurement[0].condition[0].scalar'
+        ], pr_prop_massage, interval)
 
-        pr_data.setdefault(deck[2], []).append(deck[3])
-        phase_formulae[deck[2]] = (short_formula(deck[0]), sg_to_label(deck[1]))
+        for phase_id, ab_values, pr_values in profiled_iter(merge_join(ab_data, pr_data), 'merge_join'):
 
-    for phase_id in ab_data:
-        if phase_id not in pr_data:
-            continue
+            #print("%s: %s vs. %s" % (phase_registry[phase_id], ab_values, pr_values))
+            data.append((phase_registry[phase_id], ab_values, pr_values))
 
-        #print("%s: %s vs. %s" % (phase_formulae[phase_id], ab_data[phase_id], pr_data[phase_id]))
-        work_outline[ab_prop_name].setdefault('data', []).append(
-            (phase_formulae[phase_id], ab_data[phase_id], pr_data[phase_id])
-        )
+    return data
 
 
-if __name__ == "__main__":
+def compare_ab_pr(result_cache=result_cache, phases_cache=phases_cache):
+    """
+    Harvests the data of all the work_outline properties (unless cached)
+    and compares them
+
+    Returns: pairs, by_property, by_system (see cmp_stats.comparison_report)
+    """
+    global phase_registry
+
+    from cmp_stats import comparison_report
+
+    phase_registry = PhaseRegistry.load(phases_cache)
+    phases_known_bg_type.clear()
 
     if not os.path.exists(result_cache):
 
+        harvested = {} # the same keys as work_outline, without the meta (for pickling)
+
         for key, value in work_outline.items():
-            get_ab_pr_values(
+            harvested[key] = {'data': get_ab_pr_values(
                 key,
                 pr_prop_name=value['meta'].get('pr_prop_name'),
                 interval=value['meta'].get('interval'),
@@ -316,18 +312,41 @@ if __name__ == "__main__":
                 pr_prop_conds=value['meta'].get('pr_prop_conds'),
                 ab_prop_massage=value['meta'].get('ab_prop_massage'),
                 pr_prop_massage=value['meta'].get('pr_prop_massage')
-            )
-            del work_outline[key]['meta'] # for pickling
+            )}
+
+        phase_registry.save(phases_cache)
 
         # saving as a cache for future re-use
         with open(result_cache, 'wb') as pickle_file:
-            pickle.dump(work_outline, pickle_file, protocol=2)
+            pickle.dump(harvested, pickle_file, protocol=2)
 
     with open(result_cache, 'rb') as pickle_file:
-        work_outline = pickle.load(pickle_file)
+        harvested = pickle.load(pickle_file)
+
+    with stage('analysis') as st:
+        pairs, by_property, by_system = comparison_report(harvested)
+        st.count(len(pairs))
+
+    return pairs, by_property, by_system
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--result-cache', default=result_cache, help='pickled harvested data, re-used if exists')
+    parser.add_argument('--phases-cache', default=phases_cache, help='pickled phases registry, re-used if exists')
+    args = parser.parse_args(argv)
 
-    for key, value in work_outline.items():
+    pairs, by_property, by_system = compare_ab_pr(args.result_cache, args.phases_cache)
 
-        print('#' * 50, 'comparing', key)
-        for item in value['data']:
-            print(item)
+    print('#' * 50, 'comparing per property')
+    print(by_property.to_string(index=False))
+
+    print('#' * 50, 'comparing per property and crystal system')
+    print(by_system.to_string(index=False))
+
+    print('#' * 50, 'outliers')
+    print(pairs[pairs['outlier']].to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,47 +11,53 @@ The following MPDS API JSON fields are considered:
 - shapes: is_solid
 - shapes: svgpath
 """
-import sys
-import numpy
-import matplotlib.pyplot as plt
-plt.switch_backend('agg')
-from mpds_client import MPDSDataRetrieval
+import argparse
 
 from miner_nonformers import pd_svg_to_points
+from profiling import instrument, profiled_iter
 
 
 MARGIN_EDGES_COMP = 0.1
 MARGIN_EDGES_TEMP = 5
 
-if __name__ == "__main__":
-    try:
-        ela, elb = list(set([sys.argv[1], sys.argv[2]]))
-    except IndexError:
-        raise RuntimeError('Chemical element symbols should be given.')
-    elements = sorted([ela, elb])
-    print("Elements: %s" % elements)
-
-    api_client = MPDSDataRetrieval()
-
-    plt.xlabel('Composition')
-    plt.ylabel('Temperature')
-    plt.annotate(ela, xy=(-0.05, -0.1), xycoords='axes fraction')
-    plt.annotate(elb, xy=(1.05, -0.1), xycoords='axes fraction')
-    ymin, ymax = 500, 700
-
-    for pd in api_client.get_data({"props": "phase diagram", "classes": "binary", "elements": "-".join(elements)}, fields={}): # fields={} means all fields
+class LiquidusPlot(object):
+    """
+    Collects the reported liquidus lines of the ela-elb system,
+    one phase diagram at a time
+    """
+    def __init__(self, ela, elb):
+        import matplotlib.pyplot as plt
+        plt.switch_backend('agg')
+
+        self.elements = sorted([ela, elb])
+        print("Elements: %s" % self.elements)
+
+        self.figure, self.ax = plt.subplots()
+        self.ax.set_xlabel('Composition')
+        self.ax.set_ylabel('Temperature')
+        self.ax.annotate(ela, xy=(-0.05, -0.1), xycoords='axes fraction')
+        self.ax.annotate(elb, xy=(1.05, -0.1), xycoords='axes fraction')
+        self.ymin, self.ymax = 500, 700
+
+    @property
+    def search(self):
+        return {"props": "phase diagram", "classes": "binary", "elements": "-".join(self.elements)}
+
+    def add(self, pd):
+        import numpy
+
         # Consider only full-composition diagrams
         if pd['comp_range'] != [0, 100]:
-            continue
+            return
 
         # Consider only a relatively large temperature range
         if pd['temp'][1] - pd['temp'][0] < 300:
-            continue
+            return
 
         print("*"*50, pd['entry'], "*"*50)
         done_liquidus = False
-        if pd['temp'][0] < ymin: ymin = pd['temp'][0]
-        if pd['temp'][1] > ymax: ymax = pd['temp'][1]
+        if pd['temp'][0] < self.ymin: self.ymin = pd['temp'][0]
+        if pd['temp'][1] > self.ymax: self.ymax = pd['temp'][1]
 
         for area in pd['shapes']:
             # Discard the paths without the semantic meaning
@@ -83,10 +89,62 @@ if __name__ == "__main__":
                 liquidus_line.sort(key=lambda x: x[0])
                 #print(liquidus_line)
                 x, y = numpy.transpose(numpy.array(liquidus_line)).tolist()
-                plt.plot(x, y, c=numpy.random.rand(3,), lw=1, label=pd['entry'])
-                #plt.scatter(x, y, c=numpy.random.rand(3,), s=3, label=pd['entry'])
+                self.ax.plot(x, y, c=numpy.random.rand(3,), lw=1, label=pd['entry'])
+                #self.ax.scatter(x, y, c=numpy.random.rand(3,), s=3, label=pd['entry'])
+
+    def save(self, output=None):
+        """
+        Returns: path to the saved picture
+        """
+        import matplotlib.pyplot as plt
+
+        self.ax.axis([0, 100, self.ymin, self.ymax])
+        self.ax.legend()
+        self.ax.set_title('Reported liquidus lines for %s system' % "-".join(self.elements))
+        output = output or 'liquidus_%s.png' % "-".join(self.elements)
+        self.figure.savefig(output, dpi=250)
+        plt.close(self.figure)
+        return output
+
+
+def plot_liquidus(ela, elb, output=None, api_client=None):
+    """
+    Plots all the reported liquidus lines of the ela-elb system
+
+    Returns: path to the saved picture
+    """
+    from mpds_cache import CachedMPDSDataRetrieval
 
-    plt.axis([0, 100, ymin, ymax])
-    plt.legend()
-    plt.title('Reported liquidus lines for %s system' % "-".join(elements))
-    plt.savefig('liquidus_%s.png' % "-".join(elements), dpi=250)
\ No newline at end of file
+    plot = LiquidusPlot(ela, elb)
+    api_client = api_client or instrument(CachedMPDSDataRetrieval())
+
+    for pd in profiled_iter(api_client.get_data(plot.search, fields={}), 'get_data'): # fields={} means all fields
+        plot.add(pd)
+
+    return plot.save(output)
+
+
+def liquidus_job(ela, elb, output=None):
+    """
+    The plot_liquidus as a job of fetch_planner.run_jobs (a single round)
+    """
+    plot = LiquidusPlot(ela, elb)
+    yield [dict(search=plot.search, consumer=plot.add, fields={})]
+    return plot.save(output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('ela', help='first chemical element')
+    parser.add_argument('elb', help='second chemical element')
+    parser.add_argument('-o', '--output', help='picture file name, default liquidus_<system>.png')
+    args = parser.parse_args(argv)
+
+    if args.ela == args.elb:
+        parser.error('Two different chemical element symbols should be given.')
+
+    print(plot_liquidus(args.ela, args.elb, args.output))
+
+
+if __name__ == "__main__":
+    main()
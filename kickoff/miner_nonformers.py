@@ -15,7 +15,9 @@ import os
 import re
 import time
 import json
-from mpds_client import MPDSDataRetrieval
+import argparse
+
+from profiling import instrument, profiled, profiled_iter
 
 
 # Within this composition tolerance (%), a phase near a pure element
@@ -41,85 +43,192 @@ def almost_equal(x, y, tol=0.1):
     return True if abs(x - y) < tol else False
 
 
-def get_nonformers(api_client):
+# the phase diagram fields the verdict depends on
+DIAGRAM_KEYS = ('comp_range', 'temp', 'chemical_elements', 'shapes')
+
+NONFORMER, FORMER, MAYBE_NONFORMER = 'nonformer', 'former', 'maybe'
+
+DIAGRAMS_SEARCH = {"props": "phase diagram", "classes": "binary"}
+
+
+@profiled()
+def classify_diagram(pd):
     """
-    Main procedure:
-    phase diagram extraction and massage
+    Verdict of a single phase diagram
+
+    Returns: (system, verdict), or None if the diagram is not suitable
     """
     from shapely.geometry import Polygon
 
-    true_nonformers, maybe_nonformers, formers = set(), set(), set()
+    # Only full-composition diagrams
+    if pd['comp_range'] != [0, 100]:
+        return None
+
+    # Only a relatively large temperature range
+    if pd['temp'][1] - pd['temp'][0] < 300:
+        return None
+
+    fingerprint = tuple(sorted(pd['chemical_elements']))
 
-    for pd in api_client.get_data({"props": "phase diagram", "classes": "binary"}, fields={}):
+    for area in pd['shapes']:
 
-        # Only full-composition diagrams
-        if pd['comp_range'] != [0, 100]:
+        # Discard paths without the semantic meaning
+        if area['kind'] == 'drawing':
             continue
 
-        # Only a relatively large temperature range
-        if pd['temp'][1] - pd['temp'][0] < 300:
+        # Discard liquid and gas phases
+        if not area.get('is_solid'):
             continue
 
-        fingerprint = tuple(sorted(pd['chemical_elements']))
-        #print('|'*50 + pd['entry'])
+        if area.get('nphases') == 1:
+
+            points = pd_svg_to_points(area['svgpath'])
+            if len(points) == 2:
+                # This is a line compound
+                x0, y0 = points[0]
+                x1, y1 = points[1]
+            else:
+                # This is a phase area polygon
+                poly = Polygon(points)
+                x0, y0, x1, y1 = poly.bounds
+
+            # Here we have a continuous solid solution case, e.g. Au-Cu
+            if almost_equal(x1 - x0, 100):
+                return fingerprint, NONFORMER
+
+            # Here we discard the elementary phases
+            # which may spread over a relatively large range
+            elif (almost_equal(x0, 0, ELEMENT_TOL) and almost_equal(x1, 0, ELEMENT_TOL)) \
+                or (almost_equal(x0, 100, ELEMENT_TOL) and almost_equal(x1, 100, ELEMENT_TOL)):
+                continue
 
-        for area in pd['shapes']:
+            return fingerprint, FORMER
 
-            # Discard paths without the semantic meaning
-            if area['kind'] == 'drawing':
-                continue
+    # Here we have no single phases: complete insolubility case, e.g. La-Mn
+    return fingerprint, MAYBE_NONFORMER
 
-            # Discard liquid and gas phases
-            if not area.get('is_solid'):
-                continue
 
-            if area.get('nphases') == 1:
+def fold_verdicts(verdicts):
+    """
+    Different pd's may give different impression, so we compare globally
+
+    Returns: set of the nonformer systems
+    """
+    by_verdict = {NONFORMER: set(), FORMER: set(), MAYBE_NONFORMER: set()}
+    for verdict in verdicts:
+        if verdict:
+            by_verdict[verdict[1]].add(verdict[0])
 
-                points = pd_svg_to_points(area['svgpath'])
-                if len(points) == 2:
-                    # This is a line compound
-                    x0, y0 = points[0]
-                    x1, y1 = points[1]
-                else:
-                    # This is a phase area polygon
-                    poly = Polygon(points)
-                    x0, y0, x1, y1 = poly.bounds
+    return by_verdict[NONFORMER] | (by_verdict[MAYBE_NONFORMER] - by_verdict[FORMER])
 
-                # Here we have a continuous solid solution case, e.g. Au-Cu
-                if almost_equal(x1 - x0, 100):
-                    true_nonformers.add(fingerprint)
-                    break
 
-                # Here we discard the elementary phases
-                # which may spread over a relatively large range
-                elif (almost_equal(x0, 0, ELEMENT_TOL) and almost_equal(x1, 0, ELEMENT_TOL)) \
-                    or (almost_equal(x0, 100, ELEMENT_TOL) and almost_equal(x1, 100, ELEMENT_TOL)):
-                    continue
+def get_nonformers(api_client, state=None):
+    """
+    Main procedure:
+    phase diagram extraction and massage
+
+    Args:
+        api_client: (object) MPDSDataRetrieval instance
+        state: (object) IncrementalState, to classify only the new or changed diagrams
+    """
+    verdicts = []
+    consumer = diagram_consumer(verdicts, state)
 
-                formers.add(fingerprint)
-                break
+    for pd in profiled_iter(api_client.get_data(DIAGRAMS_SEARCH, fields={}), 'get_data'):
+        consumer(pd)
 
-            # Here we have no single phases: complete insolubility case, e.g. La-Mn
+    return finish_verdicts(verdicts, state)
 
-        else: maybe_nonformers.add(fingerprint)
 
-    # different pd's may give different impression, so we compare globally
-    true_nonformers |= (maybe_nonformers - formers)
-    return true_nonformers
+def diagram_consumer(verdicts, state=None):
+    """
+    Returns: function classifying a phase diagram into the verdicts list,
+    or into the state in the incremental mode
+    """
+    if state is None:
+        return lambda pd: verdicts.append(classify_diagram(pd))
+    return lambda pd: state.process(pd['entry'], {key: pd[key] for key in DIAGRAM_KEYS}, classify_diagram)
 
 
-if __name__ == "__main__":
+def finish_verdicts(verdicts, state=None):
+    """
+    Returns: set of the nonformer systems, see fold_verdicts
+    """
+    if state is not None:
+        state.prune()
+        verdicts = state.results()
+
+    return fold_verdicts(verdicts)
+
+
+def nonformers_job(state_path=None):
+    """
+    The get_nonformers as a job of fetch_planner.run_jobs (a single round)
+
+    Args:
+        state_path: (str) file of the per-diagram verdicts for the incremental mode
+    """
+    from incremental import IncrementalState
+
+    state = IncrementalState.load(state_path, tag=('nonformers', ELEMENT_TOL)) if state_path else None
+    verdicts = []
+
+    yield [dict(search=DIAGRAMS_SEARCH, consumer=diagram_consumer(verdicts, state), fields={})]
+
+    nonformers = finish_verdicts(verdicts, state)
+    if state is not None:
+        state.save(state_path)
+        print(state.report("Phase diagrams"))
+    return nonformers
+
+
+def find_nonformers(output="mpds_bin_nonformers.json", state_path=None, api_client=None):
+    """
+    Saves the sorted list of the binary nonformers into the *output* JSON file
 
-    OUTPUT = "mpds_bin_nonformers.json"
-    assert not os.path.exists(OUTPUT), "%s exists!" % OUTPUT
+    Args:
+        output: (str) JSON file, must not exist, unless the incremental mode is used
+        state_path: (str) file of the per-diagram verdicts for the incremental mode
+
+    Returns: set of the nonformer systems
+    """
+    from mpds_client import MPDSDataRetrieval
+    from mpds_cache import CachedMPDSDataRetrieval
+    from incremental import IncrementalState
+
+    if not state_path:
+        assert not os.path.exists(output), "%s exists!" % output
 
     starttime = time.time()
 
-    nonformers = get_nonformers(MPDSDataRetrieval())
+    state = IncrementalState.load(state_path, tag=('nonformers', ELEMENT_TOL)) if state_path else None
+
+    # NB the incremental runs are not cached, so that they see the changed entries
+    client_class = MPDSDataRetrieval if state_path else CachedMPDSDataRetrieval
+
+    nonformers = get_nonformers(api_client or instrument(client_class()), state)
+
+    if state is not None:
+        state.save(state_path)
+        print(state.report("Phase diagrams"))
 
     print("Binary nonformers:", len(nonformers))
-    f = open(OUTPUT, "w")
+    f = open(output, "w")
     f.write(json.dumps(sorted(list(nonformers)), indent=4))
     f.close()
 
     print("Done in %1.2f sc" % (time.time() - starttime))
+    return nonformers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', default="mpds_bin_nonformers.json", help='JSON file to write, must not exist unless --state is given')
+    parser.add_argument('--state', help='file of the per-diagram verdicts, to re-classify only the new or changed diagrams')
+    args = parser.parse_args(argv)
+
+    find_nonformers(args.output, args.state)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,18 @@
 #!/usr/bin/env python
-
+"""
+MPDS API usage example:
+calculating the Pilling-Bedworth ratio of a metal
+"""
 from __future__ import division
-import sys
+import argparse
 
-import numpy
-from numpy.linalg import det
-from mpds_client import MPDSDataRetrieval
+from crystal_stage import CrystalStage
+from profiling import instrument, profiled_iter, stage
 
 
 supported_arities = {1: 'unary', 2: 'binary', 3: 'ternary', 4: 'quaternary', 5: 'quinary'}
-mpds_api = MPDSDataRetrieval()
-
-def get_cell_v_for_t(elements, t0=250, t1=350):
-    """
-    Extracts the cell volumes within the certain temperature
-
-    Args:
-        elements: (list) chemical elements to retrieve, the first is metal
-        t0, t1: (numeric) temperature boundaries, K
 
-    Returns: dict of volumes per phase
-    """
-    phases_volumes = {}
-
-    for item in mpds_api.get_data(dict(elements='-'.join(elements), classes=supported_arities[len(elements)]), fields={
+CELL_V_FIELDS = {
     'P': [
         lambda: 'P',
         'sample.material.phase_id',
@@ -46,49 +35,130 @@ def get_cell_v_for_t(elements, t0=250, t1=350):
         'sg_n',
         'basis_noneq',
         'els_noneq'
-    ]}):
-        if not item or not item[1] or item[3] != 'Temperature' or item[4] != 'K':
-            # Other entry type, or no phase assigned, or irrelevant condition given
-            continue
-
-        if item[0] == 'P':
-            # P-entry, TODO: consider temperature
-            if item[5] and (item[5] < t0 or item[5] > t1):
-                print('Phase %s, P: OUT OF BOUNDS TEMPERATURE: %s K (%s)' % (item[1], item[5], item[6]))
-
-        else:
-            # S-entry
-            if item[5] and item[5][0] and (item[5][0] < t0 or item[5][0] > t1):
-                print('Phase %s, S: OUT OF BOUNDS TEMPERATURE: %s K (%s)' % (item[1], item[5][0], item[6]))
-                continue
+    ]
+}
+
+def cell_v_search(elements):
+    return dict(elements='-'.join(elements), classes=supported_arities[len(elements)])
+
+
+def get_cell_v_for_t(elements, t0=250, t1=350, processes=None, api_client=None):
+    """
+    Extracts the cell volumes within the certain temperature
+
+    Args:
+        elements: (list) chemical elements to retrieve, the first is metal
+        t0, t1: (numeric) temperature boundaries, K
+        processes: (int) structures compiling pool size, see CrystalStage
+        api_client: (object) MPDSDataRetrieval instance, created if not given
+
+    Returns: dict of volumes per phase
+    """
+    from mpds_prefetch import CachedPrefetchingMPDSDataRetrieval
+
+    mpds_api = api_client or instrument(CachedPrefetchingMPDSDataRetrieval())
+    answer = mpds_api.get_data(cell_v_search(elements), fields=CELL_V_FIELDS)
+
+    return cell_volumes(profiled_iter(answer, 'get_data'), elements[0], t0, t1, processes)
+
 
-            ase_obj = MPDSDataRetrieval.compile_crystal(item, 'ase')
-            if not ase_obj:
+def cell_volumes(items, metal, t0=250, t1=350, processes=None):
+    """
+    Args:
+        items: iterable of the CELL_V_FIELDS datarows
+
+    Returns: dict of volumes per phase, see get_cell_v_for_t
+    """
+    from numpy.linalg import det
+
+    phases_volumes = {}
+
+    def structures():
+        """
+        S-entries within the temperature boundaries, to be compiled
+        """
+        for item in items:
+            if not item or not item[1] or item[3] != 'Temperature' or item[4] != 'K':
+                # Other entry type, or no phase assigned, or irrelevant condition given
                 continue
-            n_metal_atoms = len([p for p in ase_obj if p.symbol == elements[0]])
-            phases_volumes.setdefault(item[1], []).append(det(ase_obj.cell) / n_metal_atoms)
 
+            if item[0] == 'P':
+                # P-entry, TODO: consider temperature
+                if item[5] and (item[5] < t0 or item[5] > t1):
+                    print('Phase %s, P: OUT OF BOUNDS TEMPERATURE: %s K (%s)' % (item[1], item[5], item[6]))
+
+            else:
+                # S-entry
+                if item[5] and item[5][0] and (item[5][0] < t0 or item[5][0] > t1):
+                    print('Phase %s, S: OUT OF BOUNDS TEMPERATURE: %s K (%s)' % (item[1], item[5][0], item[6]))
+                    continue
+                yield item
+
+    compiler = CrystalStage(processes=processes)
+
+    for item, ase_obj in compiler(structures()):
+        n_metal_atoms = len([p for p in ase_obj if p.symbol == metal])
+        phases_volumes.setdefault(item[1], []).append(det(ase_obj.cell) / n_metal_atoms)
+
+    print(compiler.report())
     return phases_volumes
 
+
+def pilling_bedworth_ratio(metal, processes=None, api_client=None):
+    from mpds_prefetch import CachedPrefetchingMPDSDataRetrieval
+
+    api_client = api_client or instrument(CachedPrefetchingMPDSDataRetrieval())
+
+    out_metal = get_cell_v_for_t([metal], processes=processes, api_client=api_client)
+    out_oxide = get_cell_v_for_t([metal, 'O'], processes=processes, api_client=api_client)
+    return volumes_ratio(out_metal, out_oxide)
+
+
+def pb_ratio_job(metal, processes=None):
+    """
+    The pilling_bedworth_ratio as a job of fetch_planner.run_jobs (a single round)
+    """
+    metal_items, oxide_items = [], []
+    yield [
+        dict(search=cell_v_search([metal]), consumer=metal_items.append, fields=CELL_V_FIELDS),
+        dict(search=cell_v_search([metal, 'O']), consumer=oxide_items.append, fields=CELL_V_FIELDS)
+    ]
+    return volumes_ratio(
+        cell_volumes(metal_items, metal, processes=processes),
+        cell_volumes(oxide_items, metal, processes=processes)
+    )
+
+
+def volumes_ratio(out_metal, out_oxide):
+    """
+    Returns: Pilling-Bedworth ratio of the median volumes of the metal and oxide phases
+    """
+    import numpy
+
+    with stage('analysis'):
+        volumes_metal = []
+        for phase_id in out_metal:
+            v_metal = numpy.median(out_metal[phase_id])
+            volumes_metal.append(v_metal)
+
+        volumes_oxide = []
+        for phase_id in out_oxide:
+            v_oxide = numpy.median(out_oxide[phase_id])
+            volumes_oxide.append(v_oxide)
+
+        # Get Pilling-Bedworth ratio
+        return numpy.median(volumes_oxide) / numpy.median(volumes_metal)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('metal', help='chemical element symbol')
+    parser.add_argument('--processes', type=int, help='worker processes compiling the structures, all cores by default')
+    args = parser.parse_args(argv)
+
+    print("Element: %s" % args.metal)
+    print(pilling_bedworth_ratio(args.metal, args.processes))
+
+
 if __name__ == "__main__":
-    try:
-        metal = sys.argv[1]
-    except IndexError:
-        raise RuntimeError('A chemical element symbol should be given.')
-    print("Element: %s" % metal)
-
-    out = get_cell_v_for_t([metal])
-    volumes_metal = []
-    for phase_id in out:
-        v_metal = numpy.median(out[phase_id])
-        volumes_metal.append(v_metal)
-
-    out = get_cell_v_for_t([metal, 'O'])
-    volumes_oxide = []
-    for phase_id in out:
-        v_oxide = numpy.median(out[phase_id])
-        volumes_oxide.append(v_oxide)
-
-    # Get Pilling-Bedworth ratio
-    pbr = numpy.median(volumes_oxide) / numpy.median(volumes_metal)
-    print(pbr)
\ No newline at end of file
+    main()
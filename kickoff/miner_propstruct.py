@@ -8,69 +8,180 @@ https://developer.mpds.io/#QSAR-QSPR
 """
 
 from __future__ import division
+import argparse
+from operator import attrgetter, itemgetter
+from collections import Counter
 
-import numpy as np
-import pandas as pd
-from ase.data import chemical_symbols, covalent_radii
+from structure_fingerprint import StructureGroups
+from crystal_stage import CrystalStage, STANDARD
+from profiling import instrument, profiled, profiled_iter, stage
 
-from mpds_client import MPDSDataRetrieval
 
+STRUCTURE_FIELDS = {'S':['phase_id', 'entry', 'chemical_formula', 'cell_abc', 'sg_n', 'basis_noneq', 'els_noneq']}
 
+@profiled()
 def get_APF(ase_obj):
     """
     Example crystal structure descriptor:
     https://en.wikipedia.org/wiki/Atomic_packing_factor
     """
+    import numpy as np
+    from ase.data import chemical_symbols, covalent_radii
+
     volume = 0.0
     for atom in ase_obj:
         volume += 4/3 * np.pi * covalent_radii[chemical_symbols.index(atom.symbol)]**3
     return volume/abs(np.linalg.det(ase_obj.cell))
 
+@profiled()
 def get_Wiener(ase_obj):
     """
     Example crystal structure descriptor:
     https://en.wikipedia.org/wiki/Wiener_index
-    defined per a unit cell
+    defined per a (standardized primitive) unit cell,
+    with the minimum image distances, so that it does not depend on the origin
+    """
+    import numpy as np
+
+    return np.sum(ase_obj.get_all_distances(mic=True)) * 0.5
+
+
+def get_descriptors(ase_obj):
+    return get_APF(ase_obj), get_Wiener(ase_obj)
+
+
+def prop_struct_correlations(search={"classes": "transitional, oxide", "props": "isothermal bulk modulus"}, units='GPa', processes=None, state_path=None, api_client=None):
+    """
+    Args:
+        processes: (int) structures compiling pool size, see CrystalStage
+        state_path: (str) file of the per-structure descriptors for the incremental mode
+
+    Returns: Pearson and Kendall correlation matrices of the property vs. descriptors
+    """
+    from mpds_prefetch import PrefetchingMPDSDataRetrieval, CachedPrefetchingMPDSDataRetrieval
+
+    # NB the incremental runs are not cached, so that they see the changed structures
+    client_class = PrefetchingMPDSDataRetrieval if state_path else CachedPrefetchingMPDSDataRetrieval
+    client = api_client or instrument(client_class())
+
+    dfrm = select_values(client.get_dataframe(search), units)
+
+    answer = profiled_iter(client.get_data({"props": "atomic structure"}, phases=set(dfrm['Phase'].tolist()), fields=STRUCTURE_FIELDS), 'get_data')
+
+    # the new structures are compiled while downloading
+    groups = StructureGroups()
+    compiler, kwargs = descriptors_compiler(processes, state_path)
+    results = list(compiler.map(items=groups.stream(answer, entry=itemgetter(0)), **kwargs))
+
+    return correlations(dfrm, results, compiler, kwargs['state'], state_path)
+
+
+def prop_struct_job(search={"classes": "transitional, oxide", "props": "isothermal bulk modulus"}, units='GPa', processes=None, state_path=None):
+    """
+    The prop_struct_correlations as a job of fetch_planner.run_jobs (two rounds)
+    """
+    import pandas as pd
+    from mpds_client import MPDSDataRetrieval
+
+    rows = []
+    yield [dict(search=search, consumer=rows.append)]
+
+    dfrm = select_values(pd.DataFrame(rows, columns=MPDSDataRetrieval.default_titles), units)
+
+    groups = StructureGroups()
+    compiler, kwargs = descriptors_compiler(processes, state_path)
+    push, finish = compiler.feed(**kwargs)
+
+    yield [dict(
+        search={"props": "atomic structure"}, phases=set(dfrm['Phase'].tolist()),
+        consumer=groups.consumer(push, entry=itemgetter(0)), fields=STRUCTURE_FIELDS
+    )]
+
+    return correlations(dfrm, finish(), compiler, kwargs['state'], state_path)
+
+
+def descriptors_compiler(processes=None, state_path=None):
+    """
+    Returns: CrystalStage and the keyword arguments of its map or feed for the structure groups
+    """
+    from incremental import IncrementalState
+
+    kwargs = dict(
+        func=get_descriptors, datarow=attrgetter('representative'), entry=lambda group: group.representative[1],
+        state=IncrementalState.load(state_path, tag=('propstruct', STANDARD, 'APF', 'Wiener')) if state_path else None
+    )
+    # the standard form gives the same descriptors for all the entries of a group
+    return CrystalStage(flavor=STANDARD, processes=processes, ordered=False), kwargs
+
+
+def select_values(dfrm, units):
+    """
+    Only the positive values in the given units, of the distinct phases
+    """
+    import numpy as np
+
+    dfrm = dfrm[np.isfinite(dfrm['Phase'].astype(np.float64))]
+    dfrm = dfrm[dfrm['Units'] == units]
+    return dfrm[dfrm['Value'] > 0]
+
+
+def correlations(dfrm, results, compiler, state=None, state_path=None):
+    """
+    Args:
+        dfrm: (dataframe) property values, see select_values
+        results: list of (structure group, descriptors) of the phases structures, see descriptors_compiler
+        state: (object) IncrementalState of the descriptors, saved into the state_path
+
+    Returns: Pearson and Kendall correlation matrices of the property vs. descriptors
     """
-    return np.sum(ase_obj.get_all_distances()) * 0.5
+    import pandas as pd
+
+    print(compiler.report())
+    if state is not None:
+        state.prune()
+        state.save(state_path)
+        print(state.report("Structures"))
+
+    # the descriptors are calculated once per unique structure,
+    # and weighted by its number of entries per phase, final as the download is over
+    descriptors = []
+    for group, (apf, wiener) in results:
+        for phase_id, weight in Counter(group.entries).items():
+            descriptors.append(( phase_id, apf * weight, wiener * weight, weight ))
 
-client = MPDSDataRetrieval()
+    with stage('analysis') as st:
+        descriptors = pd.DataFrame(descriptors, columns=['Phase', 'APF', 'Wiener', 'Weight']).groupby('Phase').sum()
+        st.count(len(descriptors))
 
-dfrm = client.get_dataframe({"classes": "transitional, oxide", "props": "isothermal bulk modulus"})
-dfrm = dfrm[np.isfinite(dfrm['Phase'])]
-dfrm = dfrm[dfrm['Units'] == 'GPa']
-dfrm = dfrm[dfrm['Value'] > 0]
+        d1 = (descriptors['APF'] / descriptors['Weight']).to_frame('APF').reset_index()
+        d2 = (descriptors['Wiener'] / descriptors['Weight']).to_frame('Wiener').reset_index()
 
-phases = set(dfrm['Phase'].tolist())
-answer = client.get_data(
-    {"props": "atomic structure"},
-    phases=phases,
-    fields={'S':['phase_id', 'entry', 'chemical_formula', 'cell_abc', 'sg_n', 'basis_noneq', 'els_noneq']}
-)
+        dfrm = dfrm.groupby('Phase')['Value'].mean().to_frame().reset_index()
+        dfrm = dfrm.merge(d1, how='outer', on='Phase')
+        dfrm = dfrm.merge(d2, how='outer', on='Phase')
 
-descriptors = []
+        dfrm.drop('Phase', axis=1, inplace=True)
+        dfrm.rename(columns={'Value': 'Prop'}, inplace=True)
 
-for item in answer:
-    crystal = MPDSDataRetrieval.compile_crystal(item, 'ase')
-    if not crystal: continue
-    descriptors.append(( item[0], get_APF(crystal), get_Wiener(crystal) ))
+        return dfrm.corr(method='pearson'), dfrm.corr(method='kendall')
 
-descriptors = pd.DataFrame(descriptors, columns=['Phase', 'APF', 'Wiener'])
 
-d1 = descriptors.groupby('Phase')['APF'].mean().to_frame().reset_index()
-d2 = descriptors.groupby('Phase')['Wiener'].mean().to_frame().reset_index()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--classes', default='transitional, oxide', help='materials classes to consider')
+    parser.add_argument('--prop', default='isothermal bulk modulus', help='physical property')
+    parser.add_argument('--units', default='GPa', help='units of the property')
+    parser.add_argument('--processes', type=int, help='worker processes compiling the structures, all cores by default')
+    parser.add_argument('--state', help='file of the per-structure descriptors, to compile only the new or changed structures')
+    args = parser.parse_args(argv)
 
-dfrm = dfrm.groupby('Phase')['Value'].mean().to_frame().reset_index()
-dfrm = dfrm.merge(d1, how='outer', on='Phase')
-dfrm = dfrm.merge(d2, how='outer', on='Phase')
+    corr_pearson, corr_kendall = prop_struct_correlations({"classes": args.classes, "props": args.prop}, args.units, args.processes, args.state)
 
-dfrm.drop('Phase', axis=1, inplace=True)
-dfrm.rename(columns={'Value': 'Prop'}, inplace=True)
+    print("Pearson. Prop vs. APF = \t%s" % corr_pearson.loc['Prop']['APF'])
+    print("Pearson. Prop vs. Wiener = \t%s" % corr_pearson.loc['Prop']['Wiener'])
+    print("Kendall Tau. Prop vs. APF = \t%s" % corr_kendall.loc['Prop']['APF'])
+    print("Kendall Tau. Prop vs. Wiener = \t%s" % corr_kendall.loc['Prop']['Wiener'])
 
-corr_pearson = dfrm.corr(method='pearson')
-corr_kendall = dfrm.corr(method='kendall')
 
-print("Pearson. Prop vs. APF = \t%s" % corr_pearson.loc['Prop']['APF'])
-print("Pearson. Prop vs. Wiener = \t%s" % corr_pearson.loc['Prop']['Wiener'])
-print("Kendall Tau. Prop vs. APF = \t%s" % corr_kendall.loc['Prop']['APF'])
-print("Kendall Tau. Prop vs. Wiener = \t%s" % corr_kendall.loc['Prop']['Wiener'])
+if __name__ == "__main__":
+    main()
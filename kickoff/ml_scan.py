@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+MPDS API usage example:
+unusual materials phases from the machine learning,
+i.e. the phases having the extreme values of several properties
+
+This is the scheduled version of the notebooks/3_mpds_ml_scan.ipynb:
+the properties are downloaded by a bounded pool of workers,
+each returning its own partial result, merged at the end.
+Usage (e.g. from cron):
+
+    python ml_scan.py [output.json]
+"""
+import time
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from profiling import instrument, profiled_iter, stage
+
+
+ml_data = {
+    'isothermal bulk modulus': {'bounds': [5, 265], 'units': 'GPa'},
+    'enthalpy of formation': {'bounds': [-325, 0], 'units': 'kJ g-at.-1'},
+    'heat capacity at constant pressure': {'bounds': [11, 28], 'units': 'J K-1 g-at.-1'},
+    'Seebeck coefficient': {'bounds': [-150, 225], 'units': 'muV K-1'},
+    'values of electronic band gap': {'bounds': [0.5, 10], 'units': 'eV'}, # NB both direct & indirect
+    'temperature for congruent melting': {'bounds': [300, 2700], 'units': 'K'},
+    'Debye temperature': {'bounds': [175, 1100], 'units': 'K'},
+    'linear thermal expansion coefficient': {'bounds': [1.0E-06, 9.5E-05], 'units': 'K-1'}
+}
+
+bound_tolerance_factor = 15
+
+MAX_WORKERS = 2 # keep the load on the MPDS API moderate
+
+ML_FIELDS = {'P':[
+    'sample.material.entry',
+    'sample.material.phase_id',
+    'sample.material.chemical_formula',
+    'sample.measurement[0].property.scalar'
+]}
+
+
+def adjusted_bounds(bounds, factor=bound_tolerance_factor):
+    """
+    Narrows the bounds to match the entries near the margin
+    """
+    margin = (bounds[1] - bounds[0]) / factor
+    return [bounds[0] + margin, bounds[1] - margin]
+
+
+def scan_property(prop, min_bound, max_bound, client_class=None, limiter=None):
+    """
+    A parallelizable worker, sharing nothing with the others
+    but the rate limiter
+
+    Args:
+        client_class: MPDSDataRetrieval subclass, CachedPrefetchingMPDSDataRetrieval by default
+
+    Returns: prop, extreme entries, number of scanned entries, elapsed time
+    """
+    from mpds_client import MPDSDataTypes
+
+    if client_class is None:
+        from mpds_prefetch import CachedPrefetchingMPDSDataRetrieval as client_class
+
+    starttime = time.time()
+    client = instrument(client_class(dtype=MPDSDataTypes.MACHINE_LEARNING, verbose=False))
+    if limiter:
+        limiter.attach(client)
+
+    extreme_entries, count = [], 0
+    collect = extremes_consumer(extreme_entries, min_bound, max_bound)
+
+    for item in profiled_iter(client.get_data({"props": prop}, fields=ML_FIELDS), 'get_data'):
+        count += 1
+        collect(item)
+
+    return prop, extreme_entries, count, time.time() - starttime
+
+
+def extremes_consumer(extreme_entries, min_bound, max_bound):
+    """
+    Returns: function keeping the entries out of the bounds
+    """
+    def collect(item):
+        if item[3] < min_bound or item[3] > max_bound:
+            extreme_entries.append(item)
+
+    return collect
+
+
+def merge_extremes(partials, props_order):
+    """
+    Merges the per-property extreme entries
+    in a deterministic (properties) order
+
+    Returns: dict of phase_id -> list of [prop, entry, formula, value]
+    """
+    extremes, extremes_intersects = {}, {}
+
+    for prop in props_order:
+        for item in partials.get(prop, []):
+            keep_info = [prop, item[0]] + item[2:]
+
+            if item[1] in extremes:
+                extremes_intersects.setdefault(item[1], []).append(keep_info)
+            else:
+                extremes[item[1]] = keep_info
+
+    for phase_id in extremes_intersects:
+        extremes_intersects[phase_id].append(extremes[phase_id])
+
+    return extremes_intersects
+
+
+def ml_scan(props=None, max_workers=MAX_WORKERS, client_class=None):
+    """
+    Scans the ML properties for the phases with several extreme values
+
+    Args:
+        client_class: see scan_property
+
+    Returns: dict of phase_id -> extreme values cards, dict of timings per property
+    """
+    from mpds_prefetch import RateLimiter
+
+    props = props or ml_data
+    partials, timings = {}, {}
+    limiter = RateLimiter() # the workers together keep the API rate policy
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(scan_property, prop, *adjusted_bounds(props[prop]['bounds']), client_class=client_class, limiter=limiter)
+            for prop in props
+        ]
+        for done, future in enumerate(as_completed(futures), start=1):
+            prop, extreme_entries, count, elapsed = future.result()
+            partials[prop], timings[prop] = extreme_entries, elapsed
+            print("---[%s/%s] %s: %s entries, %s extreme, %1.2f sc" % (
+                done, len(futures), prop, count, len(extreme_entries), elapsed
+            ))
+
+    with stage('analysis'):
+        return merge_extremes(partials, list(props)), timings
+
+
+def ml_scan_job(props=None):
+    """
+    The ml_scan as a job of fetch_planner.run_jobs (a single round)
+
+    Returns: dict of phase_id -> extreme values cards
+    """
+    from mpds_client import MPDSDataTypes
+
+    props = props or ml_data
+    partials = {prop: [] for prop in props}
+
+    yield [
+        dict(
+            search={"props": prop}, fields=ML_FIELDS, dtype=MPDSDataTypes.MACHINE_LEARNING,
+            consumer=extremes_consumer(partials[prop], *adjusted_bounds(props[prop]['bounds']))
+        ) for prop in props
+    ]
+
+    with stage('analysis'):
+        return merge_extremes(partials, list(props))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', nargs='?', help='JSON file to write the results')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help='number of the concurrent downloads')
+    args = parser.parse_args(argv)
+
+    starttime = time.time()
+
+    extremes_intersects, timings = ml_scan(max_workers=args.workers)
+
+    for phase_id in sorted(extremes_intersects.keys()):
+
+        print("*" * 30 + " Distinct phase https://mpds.io/#phase_id/%s " % phase_id + "*" * 30)
+
+        for card in extremes_intersects[phase_id]:
+            print("%s (%s) %s = %s %s" % (
+                card[2], card[1], card[0], card[3], ml_data[card[0]]['units']
+            ))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json.dumps({
+                'timestamp': int(starttime),
+                'timings': timings,
+                'phases': {str(phase_id): cards for phase_id, cards in extremes_intersects.items()}
+            }, indent=4))
+
+    print("Done in %1.2f sc" % (time.time() - starttime))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+Transparent caching of the MPDS API responses:
+an in-memory LRU tier in front of an on-disk tier,
+both bounded by the age (TTL) and the size of the stored responses.
+
+CachedMPDSDataRetrieval is a drop-in replacement of MPDSDataRetrieval:
+
+    client = CachedMPDSDataRetrieval()
+    for deck in client.get_data({"props": "phase diagram", "classes": "binary"}, fields={}):
+        ...
+    print(client.cache.stats())
+
+The responses are keyed on the query, phases, fields, data type
+and API key, so the different access levels never share the cache.
+The "No hits" answers are cached, too, and raise the same APIError.
+A response can be also stored and read part by part (e.g. page by page),
+see CacheWriter and ResponseCache.iter_parts, and
+mpds_prefetch.CachedPrefetchingMPDSDataRetrieval for the streaming client.
+The disk tier location is given by the MPDS_CACHE_DIR environment variable
+(default is .mpds_cache in the current directory), set it to an empty string
+to keep the cache in memory only.
+"""
+import os
+import io
+import time
+import json
+import pickle
+import hashlib
+import threading
+from itertools import chain
+from collections import OrderedDict
+
+from mpds_client import MPDSDataRetrieval, APIError
+
+
+DEFAULT_CACHE_DIR = '.mpds_cache'
+DEFAULT_TTL = 7 * 24 * 3600 # the MPDS data are updated not so often
+DEFAULT_MEMORY_BYTES = 256 * 1024 * 1024
+DEFAULT_DISK_BYTES = 4 * 1024 * 1024 * 1024
+
+_DEFAULT = object()
+
+
+def cache_key(search, phases=None, fields=_DEFAULT, dtype=None, api_key=None):
+    """
+    A stable hash of everything determining the API response;
+    the callables in fields (constant columns) are evaluated,
+    as the MPDS client does
+    """
+    if fields is _DEFAULT:
+        fields = 'default'
+
+    elif fields:
+        fields = {
+            key: [expr if isinstance(expr, str) else {'const': expr()} for expr in value]
+            for key, value in fields.items()
+        }
+
+    payload = json.dumps([
+        search,
+        sorted(set(int(x) for x in phases)) if phases else None,
+        fields,
+        dtype,
+        hashlib.sha1((api_key or '').encode('utf-8')).hexdigest()
+    ], sort_keys=True, default=str)
+
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def _iter_parts(f):
+    """
+    The stored response is a sequence of the pickled parts
+    """
+    try:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+    finally:
+        f.close()
+
+
+def _join_parts(parts):
+    if len(parts) == 1:
+        return parts[0]
+    return list(chain.from_iterable(parts))
+
+
+class CacheWriter(object):
+    """
+    Stores a response part by part, e.g. the pages as they arrive;
+    the response is only visible in the cache after commit()
+    """
+    def __init__(self, cache, key):
+        self.cache, self.key = cache, key
+        self.parts, self.size = [], 0 # parts are dropped if too large for the memory tier
+        self.tmp_path = None
+        self._file = None
+
+        if cache.cache_dir:
+            self.tmp_path = cache._path(key) + '.%s.%s.tmp' % (os.getpid(), threading.get_ident())
+            self._file = open(self.tmp_path, 'wb')
+
+    def write(self, part):
+        blob = pickle.dumps(part, protocol=pickle.HIGHEST_PROTOCOL)
+        self.size += len(blob)
+
+        if self.parts is not None:
+            if self.size > self.cache.max_memory_bytes:
+                self.parts = None
+            else:
+                self.parts.append(blob)
+
+        if self._file:
+            self._file.write(blob)
+
+    def commit(self):
+        if self._file:
+            self._file.close()
+        self.cache._commit(self)
+
+    def abort(self):
+        if self._file:
+            self._file.close()
+            try: os.unlink(self.tmp_path)
+            except OSError: pass
+
+
+class ResponseCache(object):
+    """
+    Two-tier (memory, disk) cache of the pickled API responses;
+    the pickles are kept also in memory, so that each hit
+    yields a fresh copy, which the miners may safely massage in place
+    """
+    def __init__(self, cache_dir=None, ttl=DEFAULT_TTL, max_memory_bytes=DEFAULT_MEMORY_BYTES, max_disk_bytes=DEFAULT_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits, self.disk_hits, self.misses, self.evictions = 0, 0, 0, 0
+
+        if self.cache_dir and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def _remember(self, key, stored_at, blob):
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key)[1])
+
+        if len(blob) > self.max_memory_bytes:
+            return
+
+        self._memory[key] = (stored_at, blob)
+        self._memory_bytes += len(blob)
+
+        while self._memory_bytes > self.max_memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.evictions += 1
+
+    def _lookup(self, key):
+        """
+        Returns the memory tier blob, or the disk tier (path, mtime), or None;
+        called under the lock
+        """
+        stored = self._memory.get(key)
+        if stored and self._expired(stored[0]):
+            self._memory_bytes -= len(self._memory.pop(key)[1])
+            stored = None
+
+        if stored:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return stored[1]
+
+        if self.cache_dir:
+            path = self._path(key)
+            try:
+                stored_at = os.path.getmtime(path)
+                if self._expired(stored_at):
+                    os.unlink(path)
+                    raise OSError
+            except OSError:
+                pass
+            else:
+                self.disk_hits += 1
+                return path, stored_at
+
+        self.misses += 1
+        return None
+
+    def get(self, key):
+        """
+        Returns the cached response or None
+        """
+        with self._lock:
+            stored = self._lookup(key)
+            if stored is None:
+                return None
+
+            if isinstance(stored, tuple):
+                path, stored_at = stored
+                try:
+                    with open(path, 'rb') as f:
+                        blob = f.read()
+                except OSError:
+                    self.disk_hits -= 1
+                    self.misses += 1
+                    return None
+                self._remember(key, stored_at, blob)
+            else:
+                blob = stored
+
+        return _join_parts(list(_iter_parts(io.BytesIO(blob))))
+
+    def iter_parts(self, key):
+        """
+        Returns the iterator over the parts of the cached response or None;
+        the disk tier is read part by part
+        """
+        with self._lock:
+            stored = self._lookup(key)
+            if stored is None:
+                return None
+
+            if isinstance(stored, tuple):
+                try:
+                    return _iter_parts(open(stored[0], 'rb'))
+                except OSError:
+                    self.disk_hits -= 1
+                    self.misses += 1
+                    return None
+
+            return _iter_parts(io.BytesIO(stored))
+
+    def writer(self, key):
+        return CacheWriter(self, key)
+
+    def put(self, key, value):
+        writer = self.writer(key)
+        writer.write(value)
+        writer.commit()
+
+    def _commit(self, writer):
+        with self._lock:
+            if writer.parts is not None:
+                self._remember(writer.key, time.time(), b''.join(writer.parts))
+
+            if not writer.tmp_path:
+                return
+
+            os.replace(writer.tmp_path, self._path(writer.key))
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """
+        Removes the expired responses, and then the oldest ones
+        until the disk tier fits its size limit
+        """
+        stored = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pkl'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try: stat = os.stat(path)
+            except OSError: continue
+            stored.append((stat.st_mtime, stat.st_size, path))
+
+        stored.sort()
+        total = sum(item[1] for item in stored)
+
+        for mtime, size, path in stored:
+            if not self._expired(mtime) and (self.max_disk_bytes is None or total <= self.max_disk_bytes):
+                break
+            try: os.unlink(path)
+            except OSError: continue
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            if self.cache_dir:
+                for name in os.listdir(self.cache_dir):
+                    if name.endswith('.pkl'):
+                        os.unlink(os.path.join(self.cache_dir, name))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'memory_items': len(self._memory),
+            'memory_bytes': self._memory_bytes
+        }
+
+
+def default_cache(cache_dir=None, ttl=DEFAULT_TTL):
+    """
+    The cache at the MPDS_CACHE_DIR location, to be shared by several clients
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get('MPDS_CACHE_DIR', DEFAULT_CACHE_DIR)
+    return ResponseCache(cache_dir=cache_dir, ttl=ttl)
+
+
+class CachedMPDSDataRetrieval(MPDSDataRetrieval):
+    """
+    MPDSDataRetrieval reusing the already downloaded responses;
+    get_dataframe is served from the cache, too
+    """
+    def __init__(self, *args, **kwargs):
+        cache = kwargs.pop('cache', None)
+        cache_dir = kwargs.pop('cache_dir', None)
+        ttl = kwargs.pop('ttl', DEFAULT_TTL)
+
+        super(CachedMPDSDataRetrieval, self).__init__(*args, **kwargs)
+
+        self.cache = cache or default_cache(cache_dir, ttl)
+
+    def get_data(self, search, phases=None, fields=_DEFAULT):
+        key = cache_key(search, phases=phases, fields=fields, dtype=self.dtype, api_key=self.api_key)
+
+        output = self.cache.get(key)
+        if output is not None:
+            if not output:
+                raise APIError('No hits', 204)
+            return output
+
+        try:
+            if fields is _DEFAULT:
+                output = super(CachedMPDSDataRetrieval, self).get_data(search, phases=phases)
+            else:
+                output = super(CachedMPDSDataRetrieval, self).get_data(search, phases=phases, fields=fields)
+
+        except APIError as error:
+            if error.code == 204:
+                self.cache.put(key, [])
+            raise
+
+        output = list(output)
+        self.cache.put(key, output)
+        return output
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+MPDS API kickoff: the single entry point for all the examples
+
+    python mpds_kickoff.py <miner> [args]
+    python mpds_kickoff.py <miner> --help
+
+The miner modules (and hence pandas, ase, matplotlib, etc.)
+are only imported when the corresponding subcommand is run.
+"""
+import sys
+import argparse
+import importlib
+
+
+# subcommand: (module, help); each module provides main(argv)
+MINERS = {
+    'bgkmeans': ('miner_bgkmeans', 'clustering the band gaps of binary compounds'),
+    'bondlength': ('miner_bondlength', 'chemical bond length distribution'),
+    'bond_atlas': ('bond_atlas', 'bond length distributions of all the element pairs'),
+    'liquidus': ('miner_liquidus', 'liquidus lines for a given binary system'),
+    'nonformers': ('miner_nonformers', 'binary systems producing no compounds'),
+    'pb_ratio': ('miner_pb_ratio', 'Pilling-Bedworth ratio of a metal'),
+    'propstruct': ('miner_propstruct', 'relationship of physical property and crystalline structure'),
+    'twofold_props': ('miner_twofold_props', 'more than one properties according to criteria'),
+    'ab_etransport': ('miner_ab_etransport', 'raw ab initio electronic transport data analysis'),
+    'cmp_ab_pr': ('miner_cmp_ab_pr_data', 'ab initio vs. peer-reviewed data comparison'),
+    'ml_scan': ('ml_scan', 'unusual materials phases from the machine learning'),
+    'eos_fit': ('eos_fit', 'equation of state fitting for the phases with pVT-data'),
+    'nightly': ('nightly', 'several miners at once, downloading each dataset once'),
+}
+
+
+def get_miner(name):
+    """
+    Imports the miner module on demand
+    """
+    return importlib.import_module(MINERS[name][0])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='mpds_kickoff', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='miner', metavar='<miner>')
+    subparsers.required = True
+    for name in sorted(MINERS):
+        # the own options of the miner are parsed by its main()
+        subparsers.add_parser(name, help=MINERS[name][1], add_help=False)
+
+    args, miner_argv = parser.parse_known_args(argv)
+    return get_miner(args.miner).main(miner_argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+"""
+Pipelined retrieval of the paginated MPDS API results:
+while the consumer processes page N, the page N+1 is already downloaded
+in a background thread. The API rate policy is kept,
+i.e. the requests are started not more often than
+once per MPDSDataRetrieval.chillouttime, and only one request
+is in flight at a time, so the retrieval is bounded by the bandwidth,
+not by the latency plus sleep.
+
+    client = PrefetchingMPDSDataRetrieval()
+    for deck in client.get_data({"elements": "U-O", "props": "atomic structure"}, fields={...}):
+        ...
+
+The fields are compiled with field_paths, so the unknown ones
+fail at once, and the numeric fields can be also retrieved
+as the NumPy arrays, see get_columns.
+
+CachedPrefetchingMPDSDataRetrieval keeps the raw pages in the mpds_cache.ResponseCache:
+the hits are read from it page by page, the misses are stored as they stream by,
+and the same pages serve any fields.
+
+NB one client should run only one retrieval at a time;
+the clients working in parallel should share a RateLimiter.
+"""
+import sys
+import math
+import time
+import json
+import threading
+from queue import Queue, Full
+from urllib.parse import urlencode
+
+from mpds_client import MPDSDataRetrieval, APIError
+
+from mpds_cache import default_cache, cache_key, DEFAULT_TTL
+from field_paths import loads, compile_fields, extract, fill_columns, concat_columns
+
+
+_DONE = object()
+
+
+class RateLimiter(object):
+    """
+    Keeps the API rate policy for several clients together
+    (e.g. in the threads): all their requests are started
+    not more often than once per interval
+
+        limiter = RateLimiter()
+        client = limiter.attach(instrument(CachedMPDSDataRetrieval()))
+    """
+    def __init__(self, interval=MPDSDataRetrieval.chillouttime):
+        self.interval = interval
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def attach(self, client):
+        request = client._request
+
+        def _request(*args, **kwargs):
+            self.wait()
+            return request(*args, **kwargs)
+
+        client._request = _request
+        client.chillouttime = 0 # the pauses are kept by the limiter
+        return client
+
+
+class PrefetchingMPDSDataRetrieval(MPDSDataRetrieval):
+    """
+    MPDSDataRetrieval yielding the decks as soon as their page arrives,
+    with the next pages fetched ahead
+    """
+    prefetch_depth = 2 # pages kept ready ahead of the consumer
+
+    @staticmethod
+    def _put(queue, item, stop):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _fetch_pages(self, search, all_phases, queue, stop):
+        last_request = 0
+        try:
+            for step, current_phases in enumerate(all_phases, start=1):
+                page, npages, hits_count = 0, 1, 0
+
+                while page < npages:
+                    wait = last_request + self.chillouttime - time.time()
+                    if wait > 0 and stop.wait(wait):
+                        return
+
+                    last_request = time.time()
+                    result = self._request(search, phases=current_phases, page=page)
+                    if result['error']:
+                        raise APIError(result['error'], result.get('code', 0))
+
+                    if result['npages'] > self.maxnpages:
+                        raise APIError(
+                            "Too many hits (%s > %s), please, be more specific" % \
+                            (result['count'], self.maxnpages * self.pagesize),
+                            2
+                        )
+
+                    if hits_count and hits_count != result['count']:
+                        raise APIError("API error: hits count has been changed during the query")
+
+                    hits_count, npages = result['count'], result['npages']
+                    page += 1
+
+                    if not self._put(queue, (step, page, npages, hits_count if page == npages else 0, result['out']), stop):
+                        return
+
+        except Exception as error:
+            self._put(queue, error, stop)
+
+        finally:
+            self._put(queue, _DONE, stop)
+
+    def iter_pages(self, search, phases=None):
+        """
+        Yields the raw pages of the entries as soon as they arrive
+        """
+        phases = list(set(phases)) if phases else []
+        nsteps = max(int(math.ceil(len(phases) / self.maxnphases)), 1)
+        all_phases = [phases[n::nsteps] for n in range(nsteps)]
+
+        queue, stop = Queue(maxsize=self.prefetch_depth), threading.Event()
+        fetcher = threading.Thread(target=self._fetch_pages, args=(search, all_phases, queue, stop), daemon=True)
+        fetcher.start()
+
+        tot_count, got_count = 0, 0
+        try:
+            while True:
+                item = queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                step, page, npages, declared_count, array = item
+                tot_count += declared_count
+                got_count += len(array)
+
+                if self.verbose:
+                    sys.stdout.write("\r\t%d%% of step %s from %s" % ((page / npages) * 100, step, nsteps))
+                    sys.stdout.flush()
+
+                yield array
+
+        finally:
+            stop.set()
+            fetcher.join()
+
+        if got_count != tot_count:
+            raise APIError("API error: collected and declared counts of hits differ")
+
+        if self.verbose:
+            sys.stdout.write(" Got %s hits\r\n" % tot_count)
+            sys.stdout.flush()
+
+    def iter_data(self, search, phases=None, fields=MPDSDataRetrieval.default_fields):
+        """
+        The generator version of MPDSDataRetrieval.get_data,
+        see its documentation for the arguments
+        """
+        # NB the unknown fields fail here, before the download
+        fields = compile_fields(fields) if fields else None
+        return self._iter_decks(self.iter_pages(search, phases=phases), fields)
+
+    @staticmethod
+    def _iter_decks(pages, fields):
+        try:
+            for array in pages:
+                for deck in extract(array, fields):
+                    yield deck
+        finally:
+            pages.close() # stops the fetcher if the consumer quits early
+
+    def _request(self, query, phases=None, page=0, pagesize=None):
+        """
+        The same as MPDSDataRetrieval._request, with the faster JSON decoding
+        """
+        phases = ','.join([str(int(x)) for x in phases]) if phases else ''
+
+        uri = self.endpoint + '?' + urlencode({
+            'q': json.dumps(query),
+            'phases': phases,
+            'page': page,
+            'pagesize': pagesize or self.pagesize,
+            'dtype': self.dtype
+        })
+
+        if self.debug:
+            print('curl -XGET -HKey:%s \'%s\'' % (self.api_key, uri))
+
+        response, content = self.network.request(
+            uri=uri,
+            method='GET',
+            headers={'Key': self.api_key}
+        )
+
+        if response.status != 200:
+            return {'error': content, 'code': response.status}
+
+        try:
+            content = loads(content)
+        except ValueError:
+            return {'error': 'Unreadable data obtained'}
+
+        if content.get('error'):
+            return {'error': content['error']}
+
+        if not content['out']:
+            return {'error': 'No hits', 'code': 204}
+
+        return content
+
+    def get_columns(self, search, paths, phases=None, object_type='P', dtypes=None):
+        """
+        Retrieves the fields of the object type entries
+        as the typed NumPy arrays, filled page by page,
+        see field_paths.fill_columns
+
+        Returns: dict of arrays per path
+        """
+        parts = []
+        for page in self.iter_pages(search, phases=phases):
+            parts.append(fill_columns(page, paths, object_type=object_type, dtypes=dtypes))
+        return concat_columns(parts, paths)
+
+    def get_data(self, search, phases=None, fields=MPDSDataRetrieval.default_fields):
+        return self.iter_data(search, phases=phases, fields=fields)
+
+    def get_dataframe(self, *args, **kwargs):
+        import pandas as pd
+
+        columns = kwargs.pop('columns', None) or self.default_titles
+        return pd.DataFrame(list(self.iter_data(*args, **kwargs)), columns=columns)
+
+
+class CachedPrefetchingMPDSDataRetrieval(PrefetchingMPDSDataRetrieval):
+    """
+    PrefetchingMPDSDataRetrieval reusing the already downloaded pages,
+    see mpds_cache.CachedMPDSDataRetrieval for the arguments
+    """
+    def __init__(self, *args, **kwargs):
+        cache = kwargs.pop('cache', None)
+        cache_dir = kwargs.pop('cache_dir', None)
+        ttl = kwargs.pop('ttl', DEFAULT_TTL)
+
+        super(CachedPrefetchingMPDSDataRetrieval, self).__init__(*args, **kwargs)
+
+        self.cache = cache or default_cache(cache_dir, ttl)
+
+    def iter_pages(self, search, phases=None):
+        # NB the raw pages are the same as the get_data output without fields
+        key = cache_key(search, phases=phases, fields=None, dtype=self.dtype, api_key=self.api_key)
+
+        pages = self.cache.iter_parts(key)
+        if pages is None:
+            return self._store_pages(key, super(CachedPrefetchingMPDSDataRetrieval, self).iter_pages(search, phases=phases))
+
+        return self._cached_pages(pages)
+
+    @staticmethod
+    def _cached_pages(pages):
+        try:
+            empty = True
+            for array in pages:
+                if array:
+                    empty = False
+                    yield array
+            if empty:
+                raise APIError('No hits', 204)
+        finally:
+            pages.close()
+
+    def _store_pages(self, key, pages):
+        """
+        Passes the pages through, the complete response is committed to the cache
+        """
+        writer = self.cache.writer(key)
+        written = False
+        try:
+            for array in pages:
+                writer.write(array)
+                written = True
+                yield array
+
+        except APIError as error:
+            if error.code == 204 and not written: # "No hits" is the answer
+                writer.commit()
+            else:
+                writer.abort() # incl. "No hits" for a later chunk of phases, not to keep a truncated answer
+            raise
+
+        except BaseException:
+            writer.abort() # incl. the consumer quitting early
+            raise
+
+        else:
+            writer.commit()
+
+        finally:
+            pages.close()
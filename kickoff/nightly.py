@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Nightly run of the miners at once: their queries are planned together
+(see fetch_planner.py), so that each dataset is downloaded once,
+e.g. the U-O structures of bondlength are shared with propstruct,
+and the Fe-Cr phase diagrams of liquidus come from the nonformers download.
+The results are saved into the output folder, one file per miner.
+The response cache is not used, so that every run sees the new MPDS entries.
+
+    python nightly.py [miners] [--liquidus Fe-Cr] [--metal Fe]
+
+The miners needing the external files or the per-phase downloads
+(bond_atlas, twofold_props, ab_etransport, cmp_ab_pr) are run on their own.
+"""
+import os
+import time
+import json
+import argparse
+import importlib
+
+from profiling import stage
+
+
+# name: (module, job function, number of rounds)
+JOBS = {
+    'bgkmeans': ('miner_bgkmeans', 'band_gap_job', 1),
+    'bondlength': ('miner_bondlength', 'bond_length_job', 1),
+    'eos_fit': ('eos_fit', 'eos_fit_job', 3),
+    'liquidus': ('miner_liquidus', 'liquidus_job', 1),
+    'ml_scan': ('ml_scan', 'ml_scan_job', 1),
+    'nonformers': ('miner_nonformers', 'nonformers_job', 1),
+    'pb_ratio': ('miner_pb_ratio', 'pb_ratio_job', 1),
+    'propstruct': ('miner_propstruct', 'prop_struct_job', 2),
+}
+
+
+def _to_json(obj):
+    if hasattr(obj, 'to_dict'): # dataframe
+        return obj.to_dict()
+    if hasattr(obj, 'tolist'): # numpy
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    raise TypeError('%s is not JSON serializable' % obj.__class__.__name__)
+
+
+def save_result(result, path):
+    """
+    Saves the dataframe into CSV, anything else into JSON;
+    the pictures are saved by the miners, and their paths returned
+
+    Returns: path to the saved file
+    """
+    if isinstance(result, str) and os.path.exists(result):
+        return result
+    if hasattr(result, 'to_csv'):
+        path += '.csv'
+        result.to_csv(path, index=False)
+    else:
+        path += '.json'
+        with open(path, 'w') as f:
+            f.write(json.dumps(result, indent=4, default=_to_json))
+    return path
+
+
+def run_nightly(options, output_dir='mpds_nightly', client_class=None):
+    """
+    Args:
+        options: dict of name -> keyword arguments of the miner job, see JOBS
+        output_dir: (str) folder to save the results
+        client_class: see FetchPlanner.run, the uncached PrefetchingMPDSDataRetrieval by default
+
+    Returns: dict of name -> path to the saved result
+    """
+    from fetch_planner import run_jobs
+
+    if client_class is None:
+        # NB not the cached one, which would replay the pages of the previous runs
+        from mpds_prefetch import PrefetchingMPDSDataRetrieval as client_class
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    jobs = {}
+    for name, kwargs in options.items():
+        module, function, rounds = JOBS[name]
+        jobs[name] = (rounds, getattr(importlib.import_module(module), function)(**kwargs))
+
+    results, report = run_jobs(jobs, client_class=client_class)
+
+    for fetch, count in report:
+        print("%s: %s items" % (fetch, count))
+
+    saved = {}
+    with stage('save'):
+        for name in sorted(results):
+            saved[name] = save_result(results[name], os.path.join(output_dir, name))
+    return saved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('miners', nargs='*', help='miners to run, all by default: %s' % ', '.join(sorted(JOBS)))
+    parser.add_argument('-o', '--output-dir', default='mpds_nightly', help='folder to save the results')
+    parser.add_argument('--liquidus', metavar='SYSTEM', help='binary system for liquidus, e.g. Fe-Cr, skipped if not given')
+    parser.add_argument('--metal', help='metal for pb_ratio, skipped if not given')
+    parser.add_argument('--bondlength', metavar='SYSTEM', default='U-O', help='element pair for bondlength')
+    parser.add_argument('--state-dir', help='folder of the incremental states of nonformers, bondlength, propstruct, see their --state')
+    parser.add_argument('--processes', type=int, help='worker processes of the miners, all cores by default')
+    args = parser.parse_args(argv)
+
+    for name in args.miners:
+        if name not in JOBS:
+            parser.error('Unknown miner %s' % name)
+    names = args.miners or sorted(JOBS)
+
+    def state_path(name):
+        if not args.state_dir:
+            return None
+        os.makedirs(args.state_dir, exist_ok=True)
+        return os.path.join(args.state_dir, '%s.state' % name)
+
+    options = {
+        'bgkmeans': dict(processes=args.processes),
+        'bondlength': dict(
+            zip(('elA', 'elB'), args.bondlength.split('-')), processes=args.processes,
+            state_path=state_path('bondlength_%s' % args.bondlength)
+        ),
+        'eos_fit': dict(),
+        'ml_scan': dict(),
+        'nonformers': dict(state_path=state_path('nonformers')),
+        'propstruct': dict(processes=args.processes, state_path=state_path('propstruct')),
+    }
+    if args.liquidus:
+        ela, elb = args.liquidus.split('-')
+        options['liquidus'] = dict(ela=ela, elb=elb, output=os.path.join(args.output_dir, 'liquidus_%s.png' % args.liquidus))
+    if args.metal:
+        options['pb_ratio'] = dict(metal=args.metal, processes=args.processes)
+
+    for name in names:
+        if name not in options:
+            print("Skipping %s, see --%s" % (name, 'liquidus' if name == 'liquidus' else 'metal'))
+
+    starttime = time.time()
+
+    saved = run_nightly({name: options[name] for name in names if name in options}, args.output_dir)
+    for name in sorted(saved):
+        print("%s: %s" % (name, saved[name]))
+
+    print("Done in %1.2f sc" % (time.time() - starttime))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Registry of the MPDS distinct phases metadata:
+phase_id -> (short formula, crystal system), with the formulae interned
+and the rows kept in the compact arrays; the normalization is done
+only once per formula spelling, and the registry persists between the runs.
+
+    registry = PhaseRegistry.load('mpds_phases.pkl')
+    registry.add(deck[2], deck[0], deck[1])
+    formula, system = registry[phase_id]
+    registry.save('mpds_phases.pkl')
+"""
+import os
+import pickle
+from array import array
+from functools import lru_cache
+
+
+CRYSTAL_SYSTEMS = ('tricl', 'monocl', 'orth', 'tet', 'trig', 'hex', 'cub')
+
+
+def sg_to_label(num):
+    if   195 <= num <= 230: return 'cub'
+    elif 168 <= num <= 194: return 'hex'
+    elif 143 <= num <= 167: return 'trig'
+    elif 75  <= num <= 142: return 'tet'
+    elif 16  <= num <= 74:  return 'orth'
+    elif 3   <= num <= 15:  return 'monocl'
+    elif 1   <= num <= 2:   return 'tricl'
+    else: raise RuntimeError(f'Space group number {num} is invalid')
+
+
+def short_formula(given_string, round_brackets_strip=True):
+    given_string = given_string.split()[0].strip().replace("x", "")
+
+    if given_string.startswith("[") and len(given_string.split("[")) == 2 and given_string.endswith("]"):
+        given_string = given_string.strip("[]")
+
+    if round_brackets_strip:
+        given_string = given_string.strip("()")
+
+    given_string = given_string.replace("(", "[").replace(")", "]")
+    return given_string
+
+
+_sg_to_code = [None] + [CRYSTAL_SYSTEMS.index(sg_to_label(num)) for num in range(1, 231)]
+
+
+@lru_cache(maxsize=None)
+def _normalized_formula(given_string):
+    return short_formula(given_string)
+
+
+class PhaseRegistry(object):
+    """
+    Array-backed phase_id -> (formula, crystal system) mapping
+    """
+    def __init__(self):
+        self._rows = {}
+        self.phase_ids = array('q')
+        self._formula_codes = array('l')
+        self._system_codes = array('b')
+
+        self.formulae = []
+        self._formula_index = {}
+
+    def __len__(self):
+        return len(self.phase_ids)
+
+    def __contains__(self, phase_id):
+        return phase_id in self._rows
+
+    def __getitem__(self, phase_id):
+        row = self._rows[phase_id]
+        return self.formulae[self._formula_codes[row]], CRYSTAL_SYSTEMS[self._system_codes[row]]
+
+    def get(self, phase_id, default=None):
+        if phase_id not in self._rows:
+            return default
+        return self[phase_id]
+
+    def _intern(self, formula):
+        code = self._formula_index.get(formula)
+        if code is None:
+            code = self._formula_index[formula] = len(self.formulae)
+            self.formulae.append(formula)
+        return code
+
+    def add(self, phase_id, formula, sg_n):
+        """
+        Registers a phase, or updates it if already known
+        (the last formula and crystal system seen are kept);
+        the formula is normalized with short_formula and
+        the space group number is turned into the crystal system
+
+        Returns: row number of the phase
+        """
+        sg_n = int(sg_n)
+        if not 1 <= sg_n <= 230:
+            raise RuntimeError(f'Space group number {sg_n} is invalid')
+
+        formula_code = self._intern(_normalized_formula(formula))
+
+        row = self._rows.get(phase_id)
+        if row is not None:
+            self._formula_codes[row] = formula_code
+            self._system_codes[row] = _sg_to_code[sg_n]
+            return row
+
+        row = self._rows[phase_id] = len(self.phase_ids)
+        self.phase_ids.append(int(phase_id))
+        self._formula_codes.append(formula_code)
+        self._system_codes.append(_sg_to_code[sg_n])
+        return row
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({
+                'phase_ids': self.phase_ids,
+                'formula_codes': self._formula_codes,
+                'system_codes': self._system_codes,
+                'formulae': self.formulae
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the registry saved at the path, or an empty one
+        """
+        registry = cls()
+        if not os.path.exists(path):
+            return registry
+
+        with open(path, 'rb') as f:
+            stored = pickle.load(f)
+
+        registry.phase_ids = stored['phase_ids']
+        registry._formula_codes = stored['formula_codes']
+        registry._system_codes = stored['system_codes']
+        registry.formulae = stored['formulae']
+        registry._formula_index = {formula: code for code, formula in enumerate(registry.formulae)}
+        registry._rows = {phase_id: row for row, phase_id in enumerate(registry.phase_ids)}
+        return registry
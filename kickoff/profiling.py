@@ -0,0 +1,309 @@
+"""
+Hot-path instrumentation of the miners: per-stage wall and CPU time (incl. the worker processes),
+record counts, bytes transferred, and peak memory, emitted as JSON.
+
+Switched on by the MPDS_PROFILE environment variable:
+- unset or empty: everything here is a no-op
+- "1" or "-": the JSON report goes to stderr at exit
+- otherwise: the JSON report is appended as a line to the file MPDS_PROFILE
+
+    client = instrument(MPDSDataRetrieval())        # network, JSON decoding, bytes
+    for item in profiled_iter(client.get_data(...), 'get_data'):
+        crystal = compile_crystal(item, 'ase')      # profiled compilation
+        with stage('analysis') as st:
+            ...
+            st.count()
+
+NB the peak memory is the process high-water mark (maxrss) at the end of a stage.
+The cpu is the time of the measuring thread only (e.g. not of the prefetching thread),
+and children_cpu is the time of the child processes finished during the stage,
+i.e. of the process pools (eos_fit, kmeans_vec) shut down in it.
+The pool shared by the stages (crystal_stage) is not shut down, so its workers
+measure themselves instead, and send their stages back with the results:
+
+    result = collect(executor.submit(worker_call, 'compile_chunk', func, task).result())
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+try: import resource
+except ImportError: resource = None # not available on Windows
+
+
+PROFILE_TARGET = os.environ.get('MPDS_PROFILE', '')
+enabled = bool(PROFILE_TARGET)
+
+
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0
+
+
+def _children_cpu():
+    """
+    User and system time of the terminated and waited for child processes
+    """
+    if not resource:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _clock():
+    return time.perf_counter(), time.thread_time(), _children_cpu()
+
+
+def _elapsed(started):
+    """
+    Returns: wall, cpu, children_cpu since the _clock() reading
+    """
+    return tuple(now - then for now, then in zip(_clock(), started))
+
+
+class _Stats(object):
+    """
+    Aggregated measurements of the stages, safe to update from several threads
+    """
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def record(self, name, elapsed, records=0, nbytes=0):
+        """
+        Args:
+            elapsed: (tuple) wall, cpu, children_cpu, see _elapsed
+        """
+        wall, cpu, children_cpu = elapsed
+        peak_rss = _peak_rss()
+        with self.lock:
+            entry = self._entry(name)
+            entry['calls'] += 1
+            entry['wall'] += wall
+            entry['cpu'] += cpu
+            entry['children_cpu'] += children_cpu
+            entry['records'] += records
+            entry['bytes'] += nbytes
+            entry['peak_rss_kb'] = max(entry['peak_rss_kb'], peak_rss)
+
+    def _entry(self, name):
+        return self.stages.setdefault(name, {
+            'stage': name, 'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'children_cpu': 0.0, 'records': 0, 'bytes': 0, 'peak_rss_kb': 0
+        })
+
+    def take(self):
+        """
+        Returns and forgets the measured stages, e.g. to be sent from a worker
+        """
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return list(stages.values())
+
+    def merge(self, stages):
+        """
+        Adds the stages measured elsewhere, e.g. in a worker
+        (its peak memory is of another process, so it is not taken)
+        """
+        with self.lock:
+            for other in stages:
+                entry = self._entry(other['stage'])
+                for key in ('calls', 'wall', 'cpu', 'children_cpu', 'records', 'bytes'):
+                    entry[key] += other[key]
+
+    def report(self):
+        with self.lock:
+            return {
+                'script': os.path.basename(sys.argv[0]) if sys.argv else None,
+                'pid': os.getpid(),
+                'started': self.started,
+                'wall': time.time() - self.started,
+                'peak_rss_kb': _peak_rss(),
+                'stages': [
+                    dict(entry, wall=round(entry['wall'], 6), cpu=round(entry['cpu'], 6), children_cpu=round(entry['children_cpu'], 6))
+                    for entry in self.stages.values()
+                ]
+            }
+
+
+stats = _Stats()
+
+
+class _Stage(object):
+    def __init__(self):
+        self.records, self.nbytes = 0, 0
+
+    def count(self, n=1):
+        self.records += n
+
+    def add_bytes(self, n):
+        self.nbytes += n
+
+
+class _NullStage(object):
+    def count(self, n=1):
+        pass
+
+    def add_bytes(self, n):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+@contextmanager
+def stage(name):
+    """
+    Measures a block of code
+    """
+    if not enabled:
+        yield _null_stage
+        return
+
+    current = _Stage()
+    started = _clock()
+    try:
+        yield current
+    finally:
+        stats.record(name, _elapsed(started), current.records, current.nbytes)
+
+
+def profiled(name=None):
+    """
+    Measures each call of the decorated function
+    """
+    def decorator(func):
+        if not enabled:
+            return func
+
+        stage_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = _clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.record(stage_name, _elapsed(started), 1)
+
+        return wrapper
+    return decorator
+
+
+def profiled_iter(iterable, name):
+    """
+    Measures the time spent waiting for the items
+    of e.g. the get_data generator, and counts the items
+    """
+    if not enabled:
+        return iterable
+
+    def generator():
+        iterator = iter(iterable)
+        while True:
+            started = _clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                stats.record(name, _elapsed(started))
+                return
+            stats.record(name, _elapsed(started), 1)
+            yield item
+
+    return generator()
+
+
+def worker_call(name, func, *args):
+    """
+    Calls func in a pool worker, measured as the name stage, its cpu being the worker process time
+
+    Returns: func result and the stages measured in the worker during the call,
+    as the worker report is not emitted at exit, see collect
+    """
+    if not enabled:
+        return func(*args), None
+
+    started = time.perf_counter(), time.process_time()
+    result = func(*args)
+    stats.record(name, (time.perf_counter() - started[0], time.process_time() - started[1], 0.0), 1)
+    return result, stats.take()
+
+
+def collect(output):
+    """
+    Returns the worker_call result, adding its stages to the report
+    """
+    result, stages = output
+    if stages:
+        stats.merge(stages)
+    return result
+
+
+class _CountingHttp(object):
+    """
+    Proxy of the httplib2.Http measuring the network time and the bytes
+    """
+    def __init__(self, network):
+        self._network = network
+
+    def request(self, *args, **kwargs):
+        started = _clock()
+        response, content = self._network.request(*args, **kwargs)
+        stats.record('network', _elapsed(started), 1, len(content or b''))
+        return response, content
+
+    def __getattr__(self, attr):
+        return getattr(self._network, attr)
+
+
+def instrument(client):
+    """
+    Measures the API pages retrieval of the client:
+    network time and bytes, and the whole page request including JSON decoding
+    (the decoding time is the difference of the two)
+    """
+    if not enabled:
+        return client
+
+    client.network = _CountingHttp(client.network)
+    request = client._request
+
+    def _request(*args, **kwargs):
+        started = _clock()
+        result = request(*args, **kwargs)
+        stats.record('get_data.page', _elapsed(started), len(result.get('out') or []))
+        return result
+
+    client._request = _request
+    return client
+
+
+@profiled()
+def compile_crystal(datarow, flavor='pmg'):
+    """
+    MPDSDataRetrieval.compile_crystal, see its documentation
+    """
+    from mpds_client import MPDSDataRetrieval
+
+    return MPDSDataRetrieval.compile_crystal(datarow, flavor)
+
+
+def emit():
+    if not stats.stages:
+        return
+
+    output = json.dumps(stats.report())
+
+    if PROFILE_TARGET in ('1', '-'):
+        sys.stderr.write(output + '\n')
+    else:
+        with open(PROFILE_TARGET, 'a') as f:
+            f.write(output + '\n')
+
+
+if enabled:
+    atexit.register(emit)
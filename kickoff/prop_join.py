@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+Joining any number of physical properties on the phase_id:
+the phases found for a property constrain the query for the next one,
+large phase filters are split into chunks downloaded in parallel
+(sharing one cache and one rate limit),
+and the values are reduced per phase with the vectorized group operations.
+
+    phase_ids, formulae, values = join_properties([
+        {'search': {'props': 'temperature for congruent melting', 'classes': 'oxide'}, 'select': lambda v: v > 2073},
+        {'search': {'props': 'linear thermal expansion coefficient'}, 'scale': 1E5}
+    ], dtype=MPDSDataTypes.MACHINE_LEARNING)
+"""
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from mpds_client import MPDSDataRetrieval, APIError
+
+from mpds_cache import CachedMPDSDataRetrieval, default_cache
+from mpds_prefetch import RateLimiter
+from profiling import instrument, stage
+
+
+VALUE_PATH = 'sample.measurement[0].property.scalar'
+
+
+def chunk_phases(phases, chunk_size=None):
+    phases = sorted(set(int(x) for x in phases))
+    chunk_size = chunk_size or MPDSDataRetrieval.maxnphases
+    return [phases[i:i + chunk_size] for i in range(0, len(phases), chunk_size)]
+
+
+def fetch_chunked(search, fields, phases=None, dtype=None, workers=4, chunk_size=None, client_class=CachedMPDSDataRetrieval, cache=None, limiter=None):
+    """
+    Downloads the query results for the phases split into chunks,
+    each chunk by its own client in a separate thread
+
+    Args:
+        cache: (mpds_cache.ResponseCache) shared by the clients, if they are the cached ones
+        limiter: (mpds_prefetch.RateLimiter) shared by the clients, created if not given
+
+    Returns: list of decks
+    """
+    limiter = limiter or RateLimiter()
+    if cache is None and issubclass(client_class, CachedMPDSDataRetrieval):
+        cache = default_cache()
+    client_kwargs = {'cache': cache} if cache is not None else {}
+
+    def fetch(chunk):
+        client = limiter.attach(instrument(client_class(dtype=dtype, **client_kwargs)))
+        client.verbose = False
+        try:
+            return client.get_data(search, phases=chunk, fields=fields)
+        except APIError as error:
+            if getattr(error, 'code', None) == 204: # no hits for this chunk
+                return []
+            raise
+
+    if phases is None:
+        return fetch(None)
+
+    chunks = chunk_phases(phases, chunk_size)
+    if not chunks:
+        return []
+
+    output = []
+    with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        for decks in executor.map(fetch, chunks):
+            output.extend(decks)
+    return output
+
+
+def _to_float(value):
+    try: return float(value)
+    except (TypeError, ValueError): return math.nan
+
+
+def decks_to_columns(decks):
+    """
+    Converts the (phase_id, formula, value) decks into the arrays,
+    dropping the records without a phase or a numeric value
+    """
+    phase_ids = np.array([deck[0] if deck[0] is not None else -1 for deck in decks], dtype=np.int64)
+    formulae = np.array([deck[1] for deck in decks], dtype=object)
+    values = np.array([_to_float(deck[2]) for deck in decks], dtype=np.float64)
+
+    mask = (phase_ids >= 0) & np.isfinite(values)
+    return phase_ids[mask], formulae[mask], values[mask]
+
+
+def group_reduce(keys, values, how='median'):
+    """
+    Reduces values per key without the Python-level loop over the groups
+
+    Returns: unique keys (sorted), reduced values, group sizes
+    """
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    uniq, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+
+    if not len(uniq):
+        return uniq, values, counts
+
+    if how == 'median':
+        reduced = 0.5 * (values[starts + (counts - 1) // 2] + values[starts + counts // 2])
+    elif how == 'mean':
+        reduced = np.add.reduceat(values, starts) / counts
+    elif how == 'min':
+        reduced = values[starts]
+    elif how == 'max':
+        reduced = values[starts + counts - 1]
+    else:
+        raise RuntimeError('Unknown reduction %s' % how)
+
+    return uniq, reduced, counts
+
+
+def last_index(keys):
+    """
+    Index of the last occurrence of each unique key (sorted),
+    e.g. the formula of a phase is the last one seen, as a dict keeps
+    """
+    _, index = np.unique(keys[::-1], return_index=True)
+    return len(keys) - 1 - index
+
+
+def join_properties(props, dtype=None, reduce='median', phases=None, workers=4, client_class=CachedMPDSDataRetrieval):
+    """
+    Inner join of the properties on the phase_id
+
+    Args:
+        props: (list) dicts with the keys:
+            search: the MPDS query
+            value: (optional) path of the value field, the scalar by default
+            select: (optional) vectorized predicate on the values array
+            scale: (optional) factor applied to the values
+            reduce: (optional) median, mean, min, or max, overrides the common one
+        dtype: MPDS data type
+        reduce: (str) common per phase reduction
+        phases: (iterable) optional initial phase_id constraint
+        workers: (int) parallel downloads of the phase chunks
+
+    Returns: phase_ids array, formulae array, values 2D array (phases x props)
+    """
+    joined_ids, formulae, columns = None, None, []
+
+    limiter = RateLimiter()
+    cache = default_cache() if issubclass(client_class, CachedMPDSDataRetrieval) else None
+
+    for prop in props:
+        decks = fetch_chunked(
+            prop['search'],
+            {'P': [
+                'sample.material.phase_id',
+                'sample.material.chemical_formula',
+                prop.get('value', VALUE_PATH)
+            ]},
+            phases=phases,
+            dtype=dtype,
+            workers=workers,
+            client_class=client_class,
+            cache=cache,
+            limiter=limiter
+        )
+        phase_ids, prop_formulae, values = decks_to_columns(decks)
+
+        if prop.get('scale'):
+            values = values * prop['scale']
+
+        if prop.get('select'):
+            mask = prop['select'](values)
+            phase_ids, prop_formulae, values = phase_ids[mask], prop_formulae[mask], values[mask]
+
+        with stage('group_reduce') as st:
+            uniq, reduced, _ = group_reduce(phase_ids, values, prop.get('reduce', reduce))
+            st.count(len(values))
+
+        if joined_ids is None:
+            joined_ids, formulae = uniq, prop_formulae[last_index(phase_ids)]
+            columns.append(reduced)
+
+        else:
+            common, left_idx, right_idx = np.intersect1d(joined_ids, uniq, assume_unique=True, return_indices=True)
+            joined_ids, formulae = common, formulae[left_idx]
+            columns = [column[left_idx] for column in columns] + [reduced[right_idx]]
+
+        phases = joined_ids.tolist()
+        if not phases:
+            break
+
+    if len(columns) < len(props):
+        return np.array([], dtype=np.int64), np.array([], dtype=object), np.empty((0, len(props)))
+
+    return joined_ids, formulae, np.column_stack(columns)
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+"""
+Grouping the equivalent crystal structures before any geometry analysis:
+many S-entries describe the same phase with nearly the same cell,
+so the expensive descriptors are calculated once per unique structure,
+optionally weighted by the number of its entries.
+
+    groups = StructureGroups()
+    for datarow in client.get_data({...}, fields={'S': ['entry', 'cell_abc', 'sg_n', 'basis_noneq', 'els_noneq']}):
+        groups.add(datarow)
+    for group in groups:
+        descriptor(standard_crystal(group.representative)), group.multiplicity
+
+or, compiling the new groups while downloading, see CrystalStage:
+
+    stage = CrystalStage(flavor=STANDARD)
+    for group, crystal in stage(groups.stream(client.get_data(...)), datarow=lambda group: group.representative):
+        ...
+
+The datarows end with cell_abc, sg_n, basis_noneq, els_noneq
+as for MPDSDataRetrieval.compile_crystal. The structures are compared
+in a standard form: the basis is expanded with the space group operations
+(as ase does compiling), reduced to the primitive cell, and its lattice
+is Minkowski-reduced. So the different cell choices, unique axes, origins,
+and representative Wyckoff positions of the same structure are the same in this form,
+as well as the centered and primitive descriptions (e.g. the hexagonal
+and rhombohedral axes). Two structures are equivalent if some proper change
+of the reduced basis (with the -1, 0, 1 coefficients) and some origin shift
+match their cell lengths within LENGTH_TOL (relative), angles within ANGLE_TOL (degrees),
+and every atom to an atom of the same element within COORD_TOL (fractional).
+The candidates are looked up by the composition and the cell volume bin,
+the neighbouring bins included, so that nothing is lost at the bin edges.
+
+NB a group member only shares the descriptors of its representative
+if they do not depend on the setting, i.e. they are calculated
+on the standard form (standard_crystal) with the periodic images.
+"""
+from itertools import product
+from functools import lru_cache
+from collections import Counter
+
+import numpy as np
+
+from profiling import profiled
+
+
+LENGTH_TOL = 0.01 # relative
+ANGLE_TOL = 0.5   # degrees
+COORD_TOL = 0.01  # fractional
+SYMPREC = 1e-3    # fractional, merging the symmetry images of a site, as in ase
+
+
+def volume_tol(length_tol=LENGTH_TOL, angle_tol=ANGLE_TOL):
+    """
+    Largest change of the log volume of a reduced cell
+    (the angles within 60 - 120 degrees) within the tolerances
+    """
+    return 3 * length_tol + 6 * np.radians(angle_tol)
+
+
+@lru_cache(maxsize=None)
+def _symmetry_ops(sg_n):
+    from ase.spacegroup import Spacegroup
+
+    return Spacegroup(sg_n).get_op()
+
+
+@lru_cache(maxsize=None)
+def _proper_unimodular():
+    """
+    Integer matrices with the -1, 0, 1 coefficients and determinant 1
+    """
+    matrices = np.array(list(product((-1, 0, 1), repeat=9)), dtype=np.int64).reshape(-1, 3, 3)
+    return matrices[np.rint(np.linalg.det(matrices)) == 1]
+
+
+def _periodic_close(points, others, tol):
+    """
+    (n, m) matrix of the fractional points within tol per coordinate, modulo the cell
+    """
+    diff = points[:, None, :] - others[None, :, :]
+    diff -= np.round(diff)
+    return (np.abs(diff) < tol).all(axis=2)
+
+
+def _unique(positions, tol, codes=None, block=256):
+    """
+    Mask of the positions without a later duplicate (of the same code)
+    """
+    keep = np.ones(len(positions), dtype=bool)
+    order = np.arange(len(positions))
+    for start in range(0, len(positions), block):
+        close = _periodic_close(positions[start:start + block], positions, tol)
+        close &= order[None, :] > order[start:start + block, None]
+        if codes is not None:
+            close &= codes[start:start + block, None] == codes[None, :]
+        keep[start:start + block] = ~close.any(axis=1)
+    return keep
+
+
+def _covered(points, codes, positions, position_codes, tol, block=256):
+    """
+    Whether every point has a position of the same code within tol
+    """
+    start, size = 0, 8 # a few points first, as most of the candidates fail at once
+    while start < len(points):
+        close = _periodic_close(points[start:start + size], positions, tol)
+        close &= codes[start:start + size, None] == position_codes[None, :]
+        if not close.any(axis=1).all():
+            return False
+        start, size = start + size, block
+    return True
+
+
+def expand_basis(sg_n, basis_noneq, els_noneq):
+    """
+    All the atoms of the conventional cell, as ase.spacegroup.crystal makes them:
+    a later site replaces an earlier one at the same position
+
+    Returns: (n, 3) fractional positions, list of n elements
+    """
+    rotations, translations = _symmetry_ops(int(sg_n))
+    positions, elements = [], []
+    for site, el in zip(np.asarray(basis_noneq, dtype=np.float64).reshape(-1, 3), els_noneq):
+        images = (rotations @ site + translations) % 1.0
+        images = images[_unique(images, SYMPREC)]
+        positions.append(images)
+        elements.extend([el] * len(images))
+
+    positions = np.concatenate(positions)
+    keep = _unique(positions, SYMPREC)
+    return positions[keep], [el for el, kept in zip(elements, keep) if kept]
+
+
+def _lattice_basis(rows):
+    """
+    Basis of the integer lattice spanned by the rows (full rank),
+    by the Euclidean row reduction column by column
+    """
+    rows = [list(row) for row in rows if any(row)]
+    basis = []
+    for col in range(3):
+        while sum(1 for row in rows if row[col]) > 1:
+            pivot = min((row for row in rows if row[col]), key=lambda row: abs(row[col]))
+            for row in rows:
+                if row is not pivot and row[col]:
+                    factor = row[col] // pivot[col]
+                    for n in range(3):
+                        row[n] -= factor * pivot[n]
+            rows = [row for row in rows if any(row)]
+        pivot = next(row for row in rows if row[col])
+        rows.remove(pivot)
+        basis.append(pivot)
+    return basis
+
+
+def primitive(cell, positions, elements, tol=COORD_TOL):
+    """
+    Reduces the cell by its lattice translations (e.g. of the centering)
+
+    Returns: primitive cell (3, 3), its fractional positions, elements
+    """
+    index = {el: n for n, el in enumerate(sorted(set(elements)))}
+    codes = np.array([index[el] for el in elements])
+    rare = np.flatnonzero(codes == np.argmin(np.bincount(codes)))
+
+    translations = [
+        shift for shift in (positions[rare] - positions[rare[0]]) % 1.0
+        if _covered(positions + shift, codes, positions, codes, tol)
+    ]
+    order = len(translations) # including zero
+    if order == 1 or len(positions) % order:
+        return cell, positions, elements
+
+    # the translations group of the order n has the vectors in Z^3 / n
+    rows = np.rint(np.vstack([np.eye(3), translations]) * order).astype(np.int64)
+    basis = np.array(_lattice_basis(rows.tolist()), dtype=np.float64) / order
+    if abs(abs(np.linalg.det(basis)) * order - 1) > 1e-6: # not a group within the tolerance
+        return cell, positions, elements
+    prim_cell = basis @ cell
+
+    positions = (positions @ cell @ np.linalg.inv(prim_cell)) % 1.0
+    keep = _unique(positions, tol, codes)
+    return prim_cell, positions[keep], [el for el, kept in zip(elements, keep) if kept]
+
+
+def standardize(datarow, coord_tol=COORD_TOL):
+    """
+    The primitive structure in the right-handed Minkowski-reduced cell
+
+    Returns: cell (3, 3), fractional positions, elements,
+    or None if this is not a complete structure
+    Raises: ValueError and the like for the inconsistent data
+    """
+    from ase.geometry import cellpar_to_cell, minkowski_reduce
+
+    if not datarow or len(datarow) < 4 or not datarow[-1] or not datarow[-4]:
+        return None
+    cell_abc, sg_n, basis_noneq, els_noneq = datarow[-4:]
+
+    positions, elements = expand_basis(sg_n, basis_noneq, els_noneq)
+    cell, positions, elements = primitive(cellpar_to_cell(cell_abc), positions, elements, coord_tol)
+
+    reduced, op = minkowski_reduce(cell)
+    reduced, op = np.asarray(reduced), np.asarray(op)
+    if np.linalg.det(reduced) < 0:
+        reduced, op = -reduced, -op
+
+    # the same cartesian positions in the reduced = op @ cell
+    return reduced, (positions @ np.linalg.inv(op)) % 1.0, elements
+
+
+@profiled()
+def standard_crystal(datarow, coord_tol=COORD_TOL):
+    """
+    The standardized structure as the periodic ase Atoms,
+    see standardize; None if this is not a complete structure
+    """
+    from ase import Atoms
+
+    standard = standardize(datarow, coord_tol)
+    if standard is None:
+        return None
+    cell, positions, elements = standard
+    return Atoms(symbols=elements, scaled_positions=positions, cell=cell, pbc=True)
+
+
+def fingerprint(standard):
+    """
+    The exact part of the structure identity, and the volume
+
+    Returns: composition of the primitive cell, its volume
+    """
+    cell, _, elements = standard
+    return tuple(sorted(Counter(elements).items())), abs(np.linalg.det(cell))
+
+
+def cells_match(cell, other, length_tol=LENGTH_TOL, angle_tol=ANGLE_TOL):
+    """
+    Compares the a, b, c, alpha, beta, gamma of two cells
+    """
+    for n in range(3):
+        if abs(cell[n] - other[n]) > length_tol * max(abs(cell[n]), abs(other[n])):
+            return False
+    for n in range(3, 6):
+        if abs(cell[n] - other[n]) > angle_tol:
+            return False
+    return True
+
+
+def _cellpars(cells):
+    """
+    a, b, c, alpha, beta, gamma of the (k, 3, 3) cells
+    """
+    metric = cells @ cells.transpose(0, 2, 1)
+    lengths = np.sqrt(np.einsum('kii->ki', metric))
+    cosines = np.stack([
+        metric[:, 1, 2] / (lengths[:, 1] * lengths[:, 2]),
+        metric[:, 0, 2] / (lengths[:, 0] * lengths[:, 2]),
+        metric[:, 0, 1] / (lengths[:, 0] * lengths[:, 1])
+    ], axis=1)
+    return np.hstack([lengths, np.degrees(np.arccos(np.clip(cosines, -1, 1)))])
+
+
+def structures_match(standard, other, length_tol=LENGTH_TOL, angle_tol=ANGLE_TOL, coord_tol=COORD_TOL):
+    """
+    Whether some proper change of the reduced basis and some origin shift
+    map the other standardized structure onto the first one within the tolerances
+    """
+    cell, positions, elements = standard
+    other_cell, other_positions, other_elements = other
+    if len(elements) != len(other_elements) or Counter(elements) != Counter(other_elements):
+        return False
+
+    reference = _cellpars(cell[None])[0]
+    transforms = _proper_unimodular()
+    cellpars = _cellpars(transforms @ other_cell)
+    fits = (np.abs(cellpars[:, :3] - reference[:3]) <= length_tol * np.maximum(cellpars[:, :3], reference[:3])).all(axis=1) & \
+        (np.abs(cellpars[:, 3:] - reference[3:]) <= angle_tol).all(axis=1)
+
+    index = {el: n for n, el in enumerate(sorted(set(elements)))}
+    codes = np.array([index[el] for el in elements])
+    other_codes = np.array([index[el] for el in other_elements])
+    rare = np.argmin(np.bincount(codes))
+    anchor = positions[np.flatnonzero(codes == rare)[0]]
+
+    for transform in transforms[fits]:
+        # the same cartesian positions in the transform @ other_cell
+        moved = other_positions @ np.rint(np.linalg.inv(transform))
+        for site in moved[other_codes == rare]:
+            if _covered(moved + (anchor - site), other_codes, positions, codes, coord_tol):
+                return True
+    return False
+
+
+class StructureGroup(object):
+    """
+    Equivalent structures: the first seen is the representative
+    """
+    __slots__ = ('representative', 'standard', 'multiplicity', 'entries')
+
+    def __init__(self, datarow, standard):
+        self.representative = datarow
+        self.standard = standard
+        self.multiplicity = 0
+        self.entries = []
+
+
+class StructureGroups(object):
+    """
+    Streaming grouping of the structures by the composition and volume,
+    the candidates are then matched with the tolerances;
+    a structure which cannot be standardized makes its own group
+    """
+    def __init__(self, length_tol=LENGTH_TOL, angle_tol=ANGLE_TOL, coord_tol=COORD_TOL):
+        self.length_tol, self.angle_tol, self.coord_tol = length_tol, angle_tol, coord_tol
+        self.volume_bin = volume_tol(length_tol, angle_tol)
+        self.groups = []
+        self.skipped = 0
+        self._by_key = {}
+
+    def _find(self, standard):
+        """
+        Returns: the matching group or None, and the key for a new group
+        """
+        composition, volume = fingerprint(standard)
+        nbin = int(np.floor(np.log(volume) / self.volume_bin))
+        for n in (nbin, nbin - 1, nbin + 1):
+            for group in self._by_key.get((composition, n), ()):
+                if structures_match(group.standard, standard, self.length_tol, self.angle_tol, self.coord_tol):
+                    return group, None
+        return None, (composition, nbin)
+
+    @profiled('fingerprint')
+    def add(self, datarow, entry=None):
+        """
+        Returns: the group of the datarow, or None if it has no complete structure
+        """
+        key = None
+        try:
+            standard = standardize(datarow, self.coord_tol)
+        except Exception: # inconsistent data, left to the compilation to report
+            standard, group = None, None
+        else:
+            if standard is None:
+                self.skipped += 1
+                return None
+            group, key = self._find(standard)
+
+        if group is None:
+            group = StructureGroup(datarow, standard)
+            if key is not None:
+                self._by_key.setdefault(key, []).append(group)
+            self.groups.append(group)
+
+        group.multiplicity += 1
+        if entry is not None:
+            group.entries.append(entry)
+        return group
+
+    def stream(self, datarows, entry=None):
+        """
+        Adds the datarows, yielding the new groups as soon as they appear,
+        e.g. into CrystalStage while downloading;
+        NB their multiplicities and entries are final only at the end
+
+        Args:
+            entry: (callable) getting the entry of a datarow
+        """
+        for datarow in datarows:
+            group = self.add(datarow, entry(datarow) if entry else None)
+            if group is not None and group.multiplicity == 1:
+                yield group
+
+    def consumer(self, push, entry=None):
+        """
+        The stream for the pushing producers (e.g. FetchPlanner):
+        returns a function adding a datarow and pushing its group if new
+        """
+        def add(datarow):
+            group = self.add(datarow, entry(datarow) if entry else None)
+            if group is not None and group.multiplicity == 1:
+                push(group)
+        return add
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    @property
+    def total(self):
+        return sum(group.multiplicity for group in self.groups)
+
+
+def analyze_unique(datarows, analysis, weighted=False, groups=None):
+    """
+    Runs the analysis once per unique structure
+
+    Args:
+        datarows: (iterable) S-entries data, see above
+        analysis: (callable) taking the representative datarow
+        weighted: (bool) whether to return the multiplicities or just 1
+        groups: (StructureGroups) to use other tolerances
+
+    Returns: list of (result, weight)
+    """
+    groups = groups if groups is not None else StructureGroups()
+    for datarow in datarows:
+        groups.add(datarow)
+    return [(analysis(group.representative), group.multiplicity if weighted else 1) for group in groups]
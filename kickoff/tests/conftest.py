@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the kickoff modules are imported as flat ones, see the examples
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,78 @@
+import numpy as np
+from ase.geometry import cellpar_to_cell, cell_to_cellpar
+
+from bond_atlas import bond_atlas, build_atlas
+from crystal_stage import CrystalStage, STANDARD
+from miner_bondlength import bond_length_distribution
+from miner_propstruct import get_descriptors
+
+
+def datarow(entry, cell_abc, sg_n, basis, els):
+    return [1, entry, 'NaCl', cell_abc, sg_n, basis, els]
+
+
+def rhombohedral(entry, shift):
+    """
+    The rocksalt in its primitive cell, P1, shifted by the fractional origin
+    """
+    a = 5.64 / np.sqrt(2)
+    return datarow(entry, [a, a, a, 60, 60, 60], 1, [list(np.add([0, 0, 0], shift) % 1), list(np.add([0.5, 0.5, 0.5], shift) % 1)], ['Na', 'Cl'])
+
+
+def reoriented(entry, cell_abc, basis, els, matrix):
+    cell = cellpar_to_cell(cell_abc)
+    new_cell = np.array(matrix, dtype=np.float64) @ cell
+    positions = np.array(basis) @ cell @ np.linalg.inv(new_cell) % 1.0
+    return datarow(entry, cell_to_cellpar(new_cell).tolist(), 1, positions.tolist(), els)
+
+
+# the same structure in the different settings, the first entry is the group representative
+CONVENTIONAL = datarow('S1', [5.64, 5.64, 5.64, 90, 90, 90], 225, [[0, 0, 0], [0.5, 0.5, 0.5]], ['Na', 'Cl'])
+ROWS = [CONVENTIONAL, rhombohedral('S2', [0.13, 0.27, 0.71]), rhombohedral('S3', [0, 0, 0])]
+
+TRICLINIC = ([4.1, 5.3, 6.2, 81, 97, 104], [[0.1, 0.2, 0.3], [0.45, 0.7, 0.15]], ['Na', 'Cl'])
+
+
+class FakeClient(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_data(self, search, phases=None, fields=None):
+        return iter([list(row) for row in self.rows])
+
+
+def test_dedup_same_as_every_entry():
+    rows = ROWS + [
+        reoriented('S4', *TRICLINIC, matrix=np.eye(3)),
+        reoriented('S5', *TRICLINIC, matrix=[[1, 0, 0], [1, 1, 0], [0, 1, 1]])
+    ]
+    every = bond_length_distribution('Na', 'Cl', processes=0, dedup=False, api_client=FakeClient(rows))
+    weighted = bond_length_distribution('Na', 'Cl', processes=0, dedup=True, weighted=True, api_client=FakeClient(rows))
+
+    assert len(every) > 1 and every.equals(weighted)
+    assert every['occurrence'].sum() % 3 == 0 # the rocksalt lengths per entry are the same
+
+    # the same as in the atlas of every entry
+    atlas = build_atlas([row[1:] for row in rows], processes=0)
+    lengths, occurrence = atlas.distribution('Cl', 'Na')
+    assert np.allclose(lengths, every['length']) and (occurrence == every['occurrence']).all()
+
+
+def test_atlas_streamed():
+    client = FakeClient([row[1:] for row in ROWS] + [['S4', [4.1, 5.3, 6.2, 81, 97, 104], 1, [[0.1, 0.2, 0.3]], ['Na']]])
+
+    every = bond_atlas({"elements": "Na-Cl"}, dedup=False, processes=0, api_client=client)
+    assert every.structures == 4
+    weighted = bond_atlas({"elements": "Na-Cl"}, weighted=True, processes=0, api_client=client)
+    unique = bond_atlas({"elements": "Na-Cl"}, processes=0, api_client=client)
+    assert weighted.structures == 4 and unique.structures == 2
+
+    for pair in [('Na', 'Cl'), ('Na', 'Na'), ('Cl', 'Cl')]:
+        assert (every[pair] == weighted[pair]).all()
+        assert (every[pair] - unique[pair] == 2 * build_atlas([CONVENTIONAL[1:]], processes=0)[pair]).all()
+
+
+def test_descriptors_setting_independent():
+    results = CrystalStage(flavor=STANDARD, processes=0).map(get_descriptors, [row[1:] for row in ROWS])
+    descriptors = np.array([result for _, result in results])
+    assert len(descriptors) == 3 and np.allclose(descriptors, descriptors[0])
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+import crystal_stage
+from crystal_stage import CrystalStage
+from structure_fingerprint import StructureGroups
+
+
+def structure(entry, a):
+    return [entry, [a, a, a, 90, 90, 90], 225, [[0, 0, 0], [0.5, 0.5, 0.5]], ['Na', 'Cl']]
+
+
+ROWS = [structure('S1', 5.64), structure('S2', 5.8), structure('S3', 5.64), structure('S4', 5.641)]
+
+
+def volume(crystal):
+    return round(crystal.get_volume(), 3)
+
+
+def test_inline_below_threshold():
+    output = list(CrystalStage(processes=4, inline_below=len(ROWS) + 1).map(volume, ROWS))
+    assert output == [(row, round(row[1][0] ** 3 / 4, 3)) for row in ROWS]
+    assert 4 not in crystal_stage._executors # no pool spawned
+
+
+def test_groups_streamed():
+    groups = StructureGroups()
+    output = list(CrystalStage(processes=0).map(volume, groups.stream(ROWS, entry=lambda row: row[0]), datarow=lambda group: group.representative))
+
+    assert [(group.representative[0], value) for group, value in output] == [('S1', 44.852), ('S2', 48.778)]
+    assert [group.entries for group, _ in output] == [['S1', 'S3', 'S4'], ['S2']]
+
+
+def test_feed():
+    groups = StructureGroups()
+    stage = CrystalStage(processes=0)
+    push, finish = stage.feed(volume, datarow=lambda group: group.representative)
+    consumer = groups.consumer(push, entry=lambda row: row[0])
+    for row in ROWS:
+        consumer(row)
+
+    assert [(group.entries, value) for group, value in finish()] == [(['S1', 'S3', 'S4'], 44.852), (['S2'], 48.778)]
+
+
+def test_feed_bounded():
+    release, pushed = threading.Event(), []
+    push, finish = CrystalStage(processes=0, chunksize=2, max_chunks=1).feed(lambda crystal: release.wait())
+
+    def producer():
+        for row in ROWS * 3:
+            push(row)
+            pushed.append(row)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    thread.join(0.5)
+    assert len(pushed) == 4 # the chunk being compiled and the full queue
+
+    release.set()
+    thread.join()
+    assert len(finish()) == 12
+
+
+def test_feed_error():
+    push, finish = CrystalStage(processes=0, chunksize=1, max_chunks=1).feed(lambda crystal: 1 / 0)
+    for row in ROWS * 3: # not blocked by the failed stage
+        push(row)
+    with pytest.raises(ZeroDivisionError):
+        finish()
@@ -0,0 +1,123 @@
+from mpds_client import APIError
+
+from field_paths import compile_fields, extract
+from fetch_planner import FetchPlanner, run_jobs
+
+
+ENTRIES = [
+    {'object_type': 'S', 'prop': 'atomic structure', 'entry': 'S%s' % n, 'phase_id': phase_id, 'els_noneq': els}
+    for n, (phase_id, els) in enumerate([
+        (1, ['U', 'O']), (1, ['U', 'O']), (2, ['O', 'U', 'O']), (3, ['U', 'O', 'Fe']),
+        (4, ['Fe', 'O']), (5, ['Ni', 'O']), (5, ['Ni', 'O']), (6, ['Fe'])
+    ])
+] + [
+    {'object_type': 'C', 'prop': 'phase diagram', 'entry': 'C%s' % n, 'chemical_elements': els}
+    for n, els in enumerate([['Fe', 'Cr'], ['Cr', 'Fe'], ['La', 'Mn'], ['Au', 'Cu']])
+]
+
+STRUCTURE_FIELDS = {'S': ['entry', 'phase_id', lambda: 'S']}
+
+
+class FakeClient(object):
+    queries = []
+
+    def __init__(self, dtype=None):
+        self.dtype = dtype
+
+    def get_data(self, search, phases=None, fields=None):
+        FakeClient.queries.append((dict(search), sorted(phases) if phases is not None else None))
+        elements = set(search['elements'].split('-')) if 'elements' in search else set()
+        hits = [
+            entry for entry in ENTRIES
+            if entry['prop'] == search['props']
+            and elements <= set(entry.get('els_noneq') or entry.get('chemical_elements'))
+            and (phases is None or entry.get('phase_id') in phases)
+        ]
+        if not hits:
+            raise APIError('No hits', 204)
+        return iter(extract(hits, compile_fields(fields, validate=False)) if fields else hits)
+
+
+def direct(search, phases=None, fields=STRUCTURE_FIELDS):
+    try:
+        return list(FakeClient().get_data(search, phases=phases, fields=fields))
+    except APIError:
+        return []
+
+
+def test_covered_queries_merged():
+    FakeClient.queries = []
+    planner = FetchPlanner()
+    nonformers, liquidus = [], []
+    planner.add({"props": "phase diagram"}, nonformers.append, fields={})
+    planner.add({"props": "phase diagram", "elements": "Fe-Cr"}, liquidus.append, fields={})
+    report = planner.run(client_class=FakeClient)
+
+    assert len(FakeClient.queries) == 1 and len(report) == 1
+    assert nonformers == direct({"props": "phase diagram"}, fields={})
+    assert liquidus == direct({"props": "phase diagram", "elements": "Fe-Cr"}, fields={})
+
+
+def test_phases_served_by_elements_fetch():
+    FakeClient.queries = []
+    planner = FetchPlanner()
+    bondlength, propstruct = [], []
+    planner.add({"props": "atomic structure", "elements": "U-O"}, bondlength.append, fields=STRUCTURE_FIELDS)
+    planner.add({"props": "atomic structure"}, propstruct.append, phases={1, 2, 5}, fields=STRUCTURE_FIELDS)
+    planner.run(client_class=FakeClient)
+
+    # the U-O phases 1 and 2 are not downloaded twice
+    assert FakeClient.queries == [
+        ({"props": "atomic structure", "elements": "O-U"}, None),
+        ({"props": "atomic structure"}, [5])
+    ]
+    assert bondlength == direct({"props": "atomic structure", "elements": "U-O"})
+    assert sorted(propstruct) == sorted(direct({"props": "atomic structure"}, phases={1, 2, 5}))
+
+
+def test_phases_served_once_by_several_fetches():
+    FakeClient.queries = []
+    planner = FetchPlanner()
+    uranium, iron, phases = [], [], []
+    planner.add({"props": "atomic structure", "elements": "U"}, uranium.append, fields=STRUCTURE_FIELDS)
+    planner.add({"props": "atomic structure", "elements": "Fe"}, iron.append, fields=STRUCTURE_FIELDS)
+    planner.add({"props": "atomic structure"}, phases.append, phases={3, 4}, fields=STRUCTURE_FIELDS)
+    report = planner.run(client_class=FakeClient)
+
+    # the phases are met in the elements fetches, the U-O-Fe phase 3 in both, but is passed once
+    assert len(FakeClient.queries) == 2 and report[-1][1] == 0
+    assert sorted(phases) == sorted(direct({"props": "atomic structure"}, phases={3, 4}))
+
+
+def test_jobs_aligned_by_last_round():
+    FakeClient.queries = []
+
+    def two_rounds():
+        found = []
+        yield [dict(search={"props": "phase diagram", "elements": "La"}, consumer=found.append, fields={})]
+        structures = []
+        yield [dict(search={"props": "atomic structure"}, phases={1, 5}, consumer=structures.append, fields=STRUCTURE_FIELDS)]
+        return len(found), len(structures)
+
+    def one_round():
+        structures = []
+        yield [dict(search={"props": "atomic structure", "elements": "U-O"}, consumer=structures.append, fields=STRUCTURE_FIELDS)]
+        return len(structures)
+
+    results, report = run_jobs({'first': (2, two_rounds()), 'second': (1, one_round())}, client_class=FakeClient)
+
+    assert results == {'first': (1, 4), 'second': 4}
+    assert FakeClient.queries[1:] == [
+        ({"props": "atomic structure", "elements": "O-U"}, None),
+        ({"props": "atomic structure"}, [5])
+    ]
+
+
+def test_no_phases_no_download():
+    FakeClient.queries = []
+    planner = FetchPlanner()
+    found = []
+    planner.add({"props": "atomic structure"}, found.append, phases=set(), fields=STRUCTURE_FIELDS)
+    planner.run(client_class=FakeClient)
+
+    assert FakeClient.queries == [] and found == []
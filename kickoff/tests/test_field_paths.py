@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+from field_paths import compile_fields, extract, column_dtype
+
+
+def test_pb_ratio_fields():
+    # the cell volume is served by the API, but absent in the schema
+    fields = compile_fields({'S': ['phase_id', 'v', 'condition', 'cell_abc']})
+    page = [{'object_type': 'S', 'phase_id': 7, 'v': 40.5, 'condition': [300], 'cell_abc': [1, 2, 3, 90, 90, 90]}]
+    assert extract(page, fields) == [[7, 40.5, [300], [1, 2, 3, 90, 90, 90]]]
+    assert column_dtype('v', 'S') == np.float64
+
+
+def test_unknown_field():
+    with pytest.raises(ValueError):
+        compile_fields({'S': ['no_such_field']})
+    with pytest.raises(ValueError):
+        compile_fields({'S': ['phase_id', 'v.x']})
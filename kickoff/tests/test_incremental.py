@@ -0,0 +1,89 @@
+from operator import itemgetter
+
+from incremental import IncrementalState
+from crystal_stage import CrystalStage
+from miner_bondlength import bond_length_distribution
+from mpds_prefetch import PrefetchingMPDSDataRetrieval
+
+
+def structure(entry, a, els=('Na', 'Cl')):
+    return [entry, [a, a, a, 90, 90, 90], 225, [[0, 0, 0], [0.5, 0.5, 0.5]], list(els)]
+
+
+def test_process_and_prune(tmp_path):
+    path = str(tmp_path / 'test.state')
+    calls = []
+
+    def func(content):
+        calls.append(content)
+        return content['value'] * 2
+
+    state = IncrementalState.load(path, tag=1)
+    assert [state.process(entry, {'value': value}, func) for entry, value in [('a', 1), ('b', 2), ('c', 3)]] == [2, 4, 6]
+    state.save(path)
+
+    state = IncrementalState.load(path, tag=1)
+    assert len(state) == 3
+    assert state.process('a', {'value': 1}, func) == 2 # unchanged
+    assert state.process('b', {'value': 5}, func) == 10 # the digest differs
+    assert state.process('d', {'value': 4}, func) == 8
+    state.prune() # c is gone
+
+    assert len(calls) == 5
+    assert state.counts == {'new': 1, 'changed': 1, 'unchanged': 1, 'removed': 1}
+    assert sorted(state.results()) == [2, 8, 10] and 'c' not in state
+
+
+def test_tag_invalidates(tmp_path):
+    path = str(tmp_path / 'test.state')
+    state = IncrementalState.load(path, tag=('bondlength', 'U', 'O', 4))
+    state.process('a', {'value': 1}, lambda content: 1)
+    state.save(path)
+
+    assert len(IncrementalState.load(path, tag=('bondlength', 'U', 'O', 4))) == 1
+    assert len(IncrementalState.load(path, tag=('bondlength', 'U', 'O', 3))) == 0
+
+
+def test_crystal_stage_compiles_changed_only(tmp_path):
+    path = str(tmp_path / 'test.state')
+    rows = [structure('S1', 5.64), structure('S2', 5.8), structure('S3', 5.64, els=())]
+
+    def run(rows):
+        state = IncrementalState.load(path, tag='volume')
+        stage = CrystalStage(processes=0)
+        output = sorted(stage.map(lambda crystal: round(crystal.get_volume(), 3), rows, state=state, entry=itemgetter(0)))
+        state.prune()
+        state.save(path)
+        return output, stage, state
+
+    output, stage, state = run(rows)
+    assert output == [(rows[0], 44.852), (rows[1], 48.778)]
+    assert stage.compiled == 2 and len(stage.failures) == 1 and len(state) == 3
+
+    # only the changed S2 is compiled, the failed S3 is retried and reported again, the S1 is removed
+    rows = [structure('S2', 6.0), structure('S3', 5.64, els=())]
+    output, stage, state = run(rows)
+    assert output == [(rows[0], 54.0)]
+    assert stage.compiled == 1 and stage.failures == [(rows[1], 'no structure')]
+    assert state.counts == {'new': 0, 'changed': 1, 'unchanged': 1, 'removed': 1}
+
+
+def test_incremental_run_sees_changes(tmp_path, monkeypatch):
+    upstream = [dict(
+        object_type='S', phase_id=1, entry='S1', chemical_formula='NaCl',
+        cell_abc=[5.64, 5.64, 5.64, 90, 90, 90], sg_n=225, basis_noneq=[[0, 0, 0], [0.5, 0.5, 0.5]], els_noneq=['Na', 'Cl']
+    )]
+
+    def fake_request(self, query, phases=None, page=0, pagesize=None):
+        return {'error': None, 'count': len(upstream), 'npages': 1, 'out': [dict(entry) for entry in upstream]}
+
+    monkeypatch.setenv('MPDS_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(PrefetchingMPDSDataRetrieval, '_request', fake_request)
+
+    def run():
+        dfrm = bond_length_distribution('Na', 'Cl', limit=3, processes=0, state_path=str(tmp_path / 'test.state'))
+        return dfrm['length'].tolist()
+
+    assert run() == [2.82]
+    upstream[0]['cell_abc'] = [5.8, 5.8, 5.8, 90, 90, 90]
+    assert run() == [2.9]
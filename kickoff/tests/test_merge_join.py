@@ -0,0 +1,64 @@
+import os
+import random
+
+from merge_join import SortedRuns, merge_join
+
+
+def make_records(n, nkeys, seed):
+    rng = random.Random(seed)
+    return [(rng.randrange(nkeys), {'value': rng.random(), 'n': n}) for n in range(n)]
+
+
+def in_memory_join(left, right):
+    left_by_key, right_by_key = {}, {}
+    for key, payload in left:
+        left_by_key.setdefault(key, []).append(payload)
+    for key, payload in right:
+        right_by_key.setdefault(key, []).append(payload)
+    return [
+        (key, left_by_key[key], right_by_key[key])
+        for key in sorted(set(left_by_key) & set(right_by_key))
+    ]
+
+
+def fill(runs, records):
+    for key, payload in records:
+        runs.add(key, payload)
+
+
+def test_spilled_join_matches_in_memory(tmp_path):
+    left, right = make_records(5000, 700, 1), make_records(3000, 900, 2)
+
+    with SortedRuns(run_bytes=4096, tmp_dir=str(tmp_path)) as left_runs, \
+        SortedRuns(run_size=250, tmp_dir=str(tmp_path)) as right_runs:
+
+        fill(left_runs, left)
+        fill(right_runs, right)
+
+        assert left_runs.spilled() > 10
+        assert right_runs.spilled() == 12
+        assert len(os.listdir(str(tmp_path))) == left_runs.spilled() + right_runs.spilled()
+
+        assert list(merge_join(left_runs, right_runs)) == in_memory_join(left, right)
+
+    assert not os.listdir(str(tmp_path))
+
+
+def test_not_spilled_join_matches_in_memory(tmp_path):
+    left, right = make_records(500, 50, 3), make_records(500, 80, 4)
+
+    with SortedRuns(tmp_dir=str(tmp_path)) as left_runs, SortedRuns(tmp_dir=str(tmp_path)) as right_runs:
+        fill(left_runs, left)
+        fill(right_runs, right)
+
+        assert left_runs.spilled() == right_runs.spilled() == 0
+        assert list(merge_join(left_runs, right_runs)) == in_memory_join(left, right)
+
+
+def test_sorted_runs_order(tmp_path):
+    records = make_records(2000, 100, 5)
+
+    with SortedRuns(run_bytes=1024, tmp_dir=str(tmp_path)) as runs:
+        fill(runs, records)
+        assert runs.count == len(records)
+        assert list(runs) == sorted(records, key=lambda record: record[0])
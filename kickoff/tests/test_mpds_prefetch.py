@@ -0,0 +1,52 @@
+import pytest
+from mpds_client import APIError
+
+from mpds_cache import ResponseCache
+from mpds_prefetch import CachedPrefetchingMPDSDataRetrieval
+
+
+class FakeClient(CachedPrefetchingMPDSDataRetrieval):
+    """
+    Only the phases chunk with the phase 1 has the hits
+    """
+    chillouttime = 0
+    maxnphases = 2
+
+    def __init__(self, *args, **kwargs):
+        super(FakeClient, self).__init__(*args, api_key='key', verbose=False, **kwargs)
+        self.requests = []
+
+    def _request(self, query, phases=None, page=0, pagesize=None):
+        self.requests.append(sorted(phases or []))
+        if phases and 1 in phases:
+            return {'error': None, 'count': 2, 'npages': 1, 'out': [['S1'], ['S3']]}
+        return {'error': 'No hits', 'code': 204}
+
+
+def fetch(client, phases):
+    return list(client.get_data({"props": "atomic structure"}, phases=phases, fields=None))
+
+
+def test_truncated_answer_not_cached(tmp_path):
+    client = FakeClient(cache=ResponseCache(cache_dir=str(tmp_path)))
+
+    # the second chunk of the phases has no hits
+    for _ in range(2):
+        with pytest.raises(APIError) as error:
+            fetch(client, [1, 2, 3, 4])
+        assert error.value.code == 204
+
+    assert client.requests == [[1, 3], [2, 4]] * 2
+
+
+def test_no_hits_cached(tmp_path):
+    client = FakeClient(cache=ResponseCache(cache_dir=str(tmp_path)))
+
+    for _ in range(2):
+        with pytest.raises(APIError) as error:
+            fetch(client, [2, 4])
+        assert error.value.code == 204
+
+    assert client.requests == [[2, 4]]
+    assert fetch(client, [1, 3]) == fetch(client, [1, 3]) == [['S1'], ['S3']]
+    assert len(client.requests) == 2
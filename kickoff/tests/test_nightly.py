@@ -0,0 +1,37 @@
+import json
+
+import nightly
+from mpds_prefetch import PrefetchingMPDSDataRetrieval
+
+
+UPSTREAM = []
+
+
+def diagrams_job():
+    """
+    A miner job counting the phase diagrams
+    """
+    rows = []
+    yield [dict(search={"props": "phase diagram"}, consumer=rows.append, fields={})]
+    return sorted(row['entry'] for row in rows)
+
+
+def fake_request(self, query, phases=None, page=0, pagesize=None):
+    return {'error': None, 'count': len(UPSTREAM), 'npages': 1, 'out': [dict(entry) for entry in UPSTREAM]}
+
+
+def test_second_run_sees_changes(tmp_path, monkeypatch):
+    monkeypatch.setenv('MPDS_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(PrefetchingMPDSDataRetrieval, '_request', fake_request)
+    monkeypatch.setitem(nightly.JOBS, 'diagrams', ('test_nightly', 'diagrams_job', 1))
+
+    def run():
+        saved = nightly.run_nightly({'diagrams': {}}, str(tmp_path / 'output'))
+        with open(saved['diagrams']) as f:
+            return json.load(f)
+
+    UPSTREAM[:] = [{'entry': 'C1', 'object_type': 'C'}]
+    assert run() == ['C1']
+
+    UPSTREAM.append({'entry': 'C2', 'object_type': 'C'})
+    assert run() == ['C1', 'C2']
@@ -0,0 +1,17 @@
+from phase_registry import PhaseRegistry
+
+
+def test_last_formula_wins(tmp_path):
+    registry = PhaseRegistry()
+    registry.add(1, 'Fe2O3 rt', 167)
+    registry.add(2, 'FeO', 225)
+    registry.add(1, '(Fe2O3)', 62) # another spelling and setting of the same phase
+
+    assert len(registry) == 2
+    assert registry[1] == ('Fe2O3', 'orth') and registry[2] == ('FeO', 'cub')
+
+    path = str(tmp_path / 'phases.pkl')
+    registry.save(path)
+    loaded = PhaseRegistry.load(path)
+    loaded.add(2, 'Fe1O1', 225)
+    assert loaded[1] == ('Fe2O3', 'orth') and loaded[2] == ('Fe1O1', 'cub')
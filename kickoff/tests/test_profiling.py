@@ -0,0 +1,31 @@
+import profiling
+from profiling import worker_call, collect, profiled
+
+
+def busy(n):
+    return sum(x * x for x in range(n))
+
+
+def test_worker_stages_sent_back(monkeypatch):
+    monkeypatch.setattr(profiling, 'enabled', True)
+    worker_stats, parent_stats = profiling._Stats(), profiling._Stats()
+
+    # in the worker
+    monkeypatch.setattr(profiling, 'stats', worker_stats)
+    inner = profiled('busy')(busy)
+    output = worker_call('chunk', lambda n: inner(n) + inner(n), 200000)
+    assert not worker_stats.stages # taken
+
+    # in the parent
+    monkeypatch.setattr(profiling, 'stats', parent_stats)
+    assert collect(output) == 2 * busy(200000)
+    collect(worker_call('chunk', lambda n: n, 1)) # another worker call
+
+    stages = parent_stats.stages
+    assert stages['chunk']['calls'] == 2 and stages['busy']['calls'] == 2
+    assert stages['chunk']['cpu'] > 0 and stages['chunk']['cpu'] >= stages['busy']['cpu'] * 0.9
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.setattr(profiling, 'enabled', False)
+    assert collect(worker_call('chunk', busy, 10)) == busy(10)
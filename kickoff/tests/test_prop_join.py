@@ -0,0 +1,26 @@
+from mpds_client import MPDSDataRetrieval
+
+from prop_join import join_properties
+
+
+DECKS = {
+    'temperature for congruent melting': [[1, 'Al2O3', 2300], [2, 'MgO', 3100], [1, 'Al2O3 alpha', 2330], [3, 'SiO2', 1900]],
+    'linear thermal expansion coefficient': [[1, 'Al2O3', 8E-6], [2, 'Mg1O1', 1.3E-5], [2, 'MgO', 1.1E-5]]
+}
+
+
+class FakeClient(MPDSDataRetrieval):
+    def get_data(self, search, phases=None, fields=None):
+        return [deck for deck in DECKS[search['props']] if phases is None or deck[0] in phases]
+
+
+def test_join_keeps_last_formula():
+    phase_ids, formulae, values = join_properties([
+        {'search': {'props': 'temperature for congruent melting'}, 'select': lambda v: v > 2073},
+        {'search': {'props': 'linear thermal expansion coefficient'}, 'scale': 1E5}
+    ], client_class=FakeClient)
+
+    # the formula of a phase is the last one seen, as in the original dict
+    assert phase_ids.tolist() == [1, 2]
+    assert formulae.tolist() == ['Al2O3 alpha', 'MgO']
+    assert values.round(3).tolist() == [[2315.0, 0.8], [3100.0, 1.2]]
@@ -0,0 +1,109 @@
+import numpy as np
+from ase.geometry import cellpar_to_cell, cell_to_cellpar
+from ase.spacegroup import crystal
+
+from structure_fingerprint import standardize, structures_match, StructureGroups
+
+
+def datarow(cell_abc, sg_n, basis, els):
+    return ['entry', cell_abc, sg_n, basis, els]
+
+
+def equivalent(one, other):
+    return structures_match(standardize(one), standardize(other))
+
+
+def transformed(cell_abc, basis, els, matrix, shift=(0, 0, 0)):
+    """
+    The same P1 structure in the cell matrix @ cell, shifted by the cartesian origin
+    """
+    cell = cellpar_to_cell(cell_abc)
+    new_cell = np.array(matrix, dtype=np.float64) @ cell
+    positions = (np.array(basis) @ cell + np.array(shift) @ cell) @ np.linalg.inv(new_cell) % 1.0
+    return datarow(cell_to_cellpar(new_cell).tolist(), 1, positions.tolist(), els)
+
+
+ROCKSALT = datarow([5.64, 5.64, 5.64, 90, 90, 90], 225, [[0, 0, 0], [0.5, 0.5, 0.5]], ['Na', 'Cl'])
+
+TRICLINIC = ([4.1, 5.3, 6.2, 81, 97, 104], [[0.1, 0.2, 0.3], [0.45, 0.7, 0.15], [0.8, 0.35, 0.6]], ['Ti', 'O', 'O'])
+
+
+def test_origin_and_wyckoff_choice():
+    shifted = datarow([5.64, 5.64, 5.64, 90, 90, 90], 225, [[0.5, 0.5, 0.5], [0, 0, 0]], ['Na', 'Cl'])
+    other_site = datarow([5.64, 5.64, 5.64, 90, 90, 90], 225, [[0, 0, 0], [0.5, 0, 0]], ['Na', 'Cl']) # the same 4b orbit
+    assert equivalent(ROCKSALT, shifted)
+    assert equivalent(ROCKSALT, other_site)
+
+    inverted = datarow([4.1, 5.3, 6.2, 81, 97, 104], 2, [[-0.1, -0.2, -0.3], [0.45, 0.7, 0.15]], ['Ti', 'O'])
+    assert equivalent(datarow([4.1, 5.3, 6.2, 81, 97, 104], 2, [[0.1, 0.2, 0.3], [0.45, 0.7, 0.15]], ['Ti', 'O']), inverted)
+
+
+def test_centered_vs_primitive_cell():
+    # the rocksalt in the rhombohedral primitive cell, P1
+    a = 5.64 / np.sqrt(2)
+    primitive = datarow([a, a, a, 60, 60, 60], 1, [[0, 0, 0], [0.5, 0.5, 0.5]], ['Na', 'Cl'])
+    assert equivalent(ROCKSALT, primitive)
+
+    # the hexagonal and rhombohedral axes of the same R-3m structure
+    hexagonal = datarow([4.38, 4.38, 30.5, 90, 90, 120], 166, [[0, 0, 0], [0, 0, 0.4], [0, 0, 0.21]], ['Bi', 'Te', 'Se'])
+    atoms = crystal(hexagonal[-1], hexagonal[-2], spacegroup=166, cellpar=hexagonal[1], primitive_cell=True)
+    rhombohedral = datarow(atoms.cell.cellpar().tolist(), 1, atoms.get_scaled_positions().tolist(), atoms.get_chemical_symbols())
+    assert len(atoms) == 5 and abs(rhombohedral[1][3] - rhombohedral[1][5]) < 1e-6 # a = b = c, alpha = beta = gamma
+    assert equivalent(hexagonal, rhombohedral)
+    assert len(standardize(hexagonal)[2]) == 5
+
+
+def test_cell_choice_and_origin_p1():
+    cell_abc, basis, els = TRICLINIC
+    one = datarow(cell_abc, 1, basis, els)
+    assert equivalent(one, transformed(cell_abc, basis, els, [[1, 0, 0], [0, 1, 0], [1, 0, 1]]))
+    assert equivalent(one, transformed(cell_abc, basis, els, [[0, 1, 0], [0, 0, 1], [1, 0, 0]], shift=(0.3, 0.1, 0.7)))
+    assert equivalent(one, transformed(cell_abc, basis, els, [[1, 1, 0], [0, 1, 0], [0, -1, 1]]))
+
+
+def test_monoclinic_cell_choice():
+    # P2_1/c and its (a + c, b, c) cell choice, expanded to P1
+    monoclinic = datarow([5.1, 6.3, 7.4, 90, 103, 90], 14, [[0.12, 0.31, 0.27], [0.4, 0.05, 0.33]], ['Zr', 'O'])
+    atoms = crystal(monoclinic[-1], monoclinic[-2], spacegroup=14, cellpar=monoclinic[1])
+    assert len(atoms) == 8
+    other = transformed(monoclinic[1], atoms.get_scaled_positions().tolist(), atoms.get_chemical_symbols(), [[1, 0, 1], [0, 1, 0], [0, 0, 1]])
+    assert equivalent(monoclinic, other)
+
+
+def test_tolerance_across_bins():
+    # the old 0.01 grid snapped these apart
+    cell_abc, basis, els = TRICLINIC
+    one = datarow(cell_abc, 1, [[0.0149, 0.2, 0.3]] + basis[1:], els)
+    other = datarow([x * 1.004 for x in cell_abc[:3]] + [x + 0.3 for x in cell_abc[3:]], 1, [[0.0151, 0.2, 0.3]] + basis[1:], els)
+    assert equivalent(one, other)
+
+
+def test_not_equivalent():
+    # the same composition and volume, but the CsCl type
+    cesium_chloride = datarow([(5.64 ** 3 / 4) ** (1 / 3.)] * 3 + [90, 90, 90], 221, [[0, 0, 0], [0.5, 0.5, 0.5]], ['Na', 'Cl'])
+    assert not equivalent(ROCKSALT, cesium_chloride)
+
+    assert not equivalent(ROCKSALT, datarow([5.8, 5.8, 5.8, 90, 90, 90], 225, [[0, 0, 0], [0.5, 0.5, 0.5]], ['Na', 'Cl']))
+
+    cell_abc, basis, els = TRICLINIC
+    moved = [basis[0], [0.45, 0.75, 0.15], basis[2]]
+    assert not equivalent(datarow(cell_abc, 1, basis, els), datarow(cell_abc, 1, moved, els))
+    assert not equivalent(datarow(cell_abc, 1, basis, els), datarow(cell_abc, 1, basis, ['O', 'Ti', 'O']))
+
+
+def test_groups():
+    cell_abc, basis, els = TRICLINIC
+    groups = StructureGroups()
+    rows = [
+        ROCKSALT,
+        datarow([5.64, 5.64, 5.64, 90, 90, 90], 225, [[0.5, 0.5, 0.5], [0, 0, 0]], ['Na', 'Cl']),
+        datarow([5.8, 5.8, 5.8, 90, 90, 90], 225, [[0, 0, 0], [0.5, 0.5, 0.5]], ['Na', 'Cl']),
+        datarow(cell_abc, 1, basis, els),
+        transformed(cell_abc, basis, els, [[0, 1, 0], [0, 0, 1], [1, 0, 0]], shift=(0.3, 0.1, 0.7)),
+        datarow([5.64, 5.64, 5.64, 90, 90, 90], 225, [], []), # no basis
+    ]
+    for n, row in enumerate(rows):
+        groups.add(row, entry=n)
+
+    assert [group.entries for group in groups] == [[0, 1], [2], [3, 4]]
+    assert groups.total == 5 and groups.skipped == 1